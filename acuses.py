@@ -0,0 +1,165 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from protocolo import desempaquetar_campos, ErrorProtocolo, Trama, F_ACUSE, T_MSG_ALL, T_MSG_PRIVADO
+
+# IDS DE MENSAJE, ACUSES Y RECIBOS DE ENTREGA
+# Antes un mensaje no tenía identidad: el servidor no distinguía un reintento de un mensaje nuevo y el
+# cliente nunca sabía si lo que mandó llegó a alguien. Ahora el cliente elige un id para cada mensaje
+# (T_MSG_ALL / T_MSG_PRIVADO con el flag F_ACUSE: el id va como primer campo de la carga) y:
+#   - procesar_mensajes lo acusa con T_ACUSE (id, ACEPTADO / RECHAZADO, detalle) una vez repartido y
+#     encolado para el disco. Con ACEPTADO el cliente deja de reintentarlo.
+#   - Un privado le llega al destinatario como T_MSG_CON_ID (remitente, id, texto) y su cliente contesta
+#     T_RECIBO (remitente, id). El servidor se lo pasa al remitente como T_ACUSE (id, ENTREGADO,
+#     destinatario): es el recibo de punta a punta, y de ahí sale chat_entrega_segundos.
+#   - Los ids ya vistos quedan en una VentanaIds por alias: si el mismo id vuelve (un reintento porque
+#     el acuse no llegó, o porque se cortó la conexión), no se reparte otra vez, solo se repite el acuse.
+# Los mensajes a "Todos" y a salas se acusan pero no tienen recibos: serían uno por miembro para el remitente.
+# Con cluster.py cada trabajador tiene su ventana: un reintento que entra por otro trabajador después de
+# reconectarse no se reconoce como repetido.
+
+ACEPTADO = "aceptado"
+ENTREGADO = "entregado"
+RECHAZADO = "rechazado"
+EN_BUZON = "buzon"  # detalle de ACEPTADO: el destinatario no está conectado y lo recibe al volver
+
+MAX_ID = 64          # caracteres de un id (el cliente usa 16 bytes al azar en hexadecimal)
+DURACION = 300.0     # segundos que se recuerda un id (para reconocer reintentos y para aceptar su recibo)
+MAXIMO_IDS = 100000  # ids recordados a la vez; al pasarse se olvidan los más viejos
+
+TIPOS_CON_ID = (T_MSG_ALL, T_MSG_PRIVADO)
+
+
+def separar_id(trama):
+    # Devuelve (id, trama sin el id); ("", trama) si el mensaje no trae id
+    if not trama.flags & F_ACUSE or trama.tipo not in TIPOS_CON_ID:
+        return "", trama
+    id_mensaje, resto = desempaquetar_campos(trama.carga, 2)
+    if not id_mensaje or len(id_mensaje) > MAX_ID:
+        raise ErrorProtocolo("Id de mensaje inválido")
+    return id_mensaje, Trama(trama.tipo, trama.flags & ~F_ACUSE, resto)
+
+
+class _Visto:
+    __slots__ = ("instante", "acuse", "destinatario", "entregado")
+
+    def __init__(self, instante, acuse, destinatario):
+        self.instante = instante
+        self.acuse = acuse
+        self.destinatario = destinatario
+        self.entregado = False
+
+
+class VentanaIds:
+    # Conjunto acotado de (alias, id) indexado por tiempo: el OrderedDict está en orden de llegada, que
+    # es también orden de instante, así que lo vencido (o lo que sobra) siempre está al principio.
+    # Lo usan procesar_mensajes (registrar/buscar) y los lectores o el bus (recibos): lleva su propio lock.
+    def __init__(self, duracion=DURACION, maximo=MAXIMO_IDS):
+        self.duracion = duracion
+        self.maximo = maximo
+        self._lock = threading.Lock()
+        self._vistos = OrderedDict()  # (alias, id) -> _Visto
+
+    def __len__(self):
+        return len(self._vistos)
+
+    def buscar(self, alias, id_mensaje):
+        # El acuse que ya se le dio a ese id, o None si es nuevo (o ya se olvidó)
+        with self._lock:
+            self._purgar(time.monotonic())
+            visto = self._vistos.get((alias, id_mensaje))
+            return None if visto is None else visto.acuse
+
+    def registrar(self, alias, id_mensaje, destinatario=None):
+        # Antes de repartir el mensaje, así su recibo nunca llega antes que el registro.
+        # `destinatario` solo para los privados: es el único que puede mandar el recibo.
+        ahora = time.monotonic()
+        with self._lock:
+            self._vistos[(alias, id_mensaje)] = _Visto(ahora, b"", destinatario)
+            self._vistos.move_to_end((alias, id_mensaje))
+            self._purgar(ahora)
+
+    def acusar(self, alias, id_mensaje, acuse):
+        # La carga del T_ACUSE que se le dio: es la que se repite si el mismo id vuelve
+        with self._lock:
+            visto = self._vistos.get((alias, id_mensaje))
+            if visto is not None:
+                visto.acuse = acuse
+
+    def entregar(self, alias, id_mensaje, destinatario):
+        # Recibo del destinatario: devuelve los segundos desde que se aceptó el mensaje, o None si no
+        # corresponde (id desconocido o vencido, otro destinatario, o un recibo repetido)
+        with self._lock:
+            visto = self._vistos.get((alias, id_mensaje))
+            if visto is None or visto.entregado or visto.destinatario != destinatario:
+                return None
+            visto.entregado = True
+            return time.monotonic() - visto.instante
+
+    def _purgar(self, ahora):
+        limite = ahora - self.duracion
+        while self._vistos:
+            visto = next(iter(self._vistos.values()))
+            if visto.instante > limite and len(self._vistos) <= self.maximo:
+                break
+            self._vistos.popitem(last=False)
+
+
+# LADO CLIENTE
+ESPERA_ACUSE = 5.0   # segundos sin ACEPTADO antes de reintentar
+INTENTOS = 5
+RECORDADOS = 1000    # mensajes ya aceptados cuyo recibo todavía puede llegar
+
+
+class PendientesCliente:
+    # Mensajes mandados con id que todavía no tienen ACEPTADO, para reintentarlos con el mismo id
+    # (el servidor reconoce el repetido), y la hora de envío de los ya aceptados para medir el recibo.
+    def __init__(self, espera=ESPERA_ACUSE, intentos=INTENTOS):
+        self.espera = espera
+        self.intentos = intentos
+        self._lock = threading.Lock()
+        self._sin_acuse = OrderedDict()  # id -> [tipo, carga, primer envío, último envío, intentos]
+        self._aceptados = OrderedDict()  # id -> primer envío
+
+    def nuevo(self, tipo, carga):
+        id_mensaje = os.urandom(16).hex()
+        ahora = time.monotonic()
+        with self._lock:
+            self._sin_acuse[id_mensaje] = [tipo, carga, ahora, ahora, 1]
+        return id_mensaje
+
+    def acusar(self, id_mensaje, estado):
+        # Devuelve los segundos desde el primer envío, o None si el id no estaba pendiente
+        ahora = time.monotonic()
+        with self._lock:
+            if estado == ENTREGADO and id_mensaje in self._aceptados:
+                return ahora - self._aceptados.pop(id_mensaje)
+            # El recibo puede adelantarse al ACEPTADO (con cluster.py vienen de trabajadores distintos)
+            pendiente = self._sin_acuse.pop(id_mensaje, None)
+            if pendiente is None:
+                return None
+            if estado == ACEPTADO:
+                self._aceptados[id_mensaje] = pendiente[2]
+                while len(self._aceptados) > RECORDADOS:
+                    self._aceptados.popitem(last=False)
+            return ahora - pendiente[2]
+
+    def para_reintentar(self, todos=False):
+        # [(id, tipo, carga)] a mandar de nuevo: los que pasaron `espera` sin acuse (o todos, al reconectar),
+        # y [(tipo, carga)] de los que se quedaron sin intentos y se abandonan
+        ahora = time.monotonic()
+        reintentos, abandonados = [], []
+        with self._lock:
+            for id_mensaje, pendiente in list(self._sin_acuse.items()):
+                if not todos and ahora - pendiente[3] < self.espera:
+                    continue
+                if pendiente[4] >= self.intentos:
+                    del self._sin_acuse[id_mensaje]
+                    abandonados.append((pendiente[0], pendiente[1]))
+                    continue
+                pendiente[3] = ahora
+                pendiente[4] += 1
+                reintentos.append((id_mensaje, pendiente[0], pendiente[1]))
+        return reintentos, abandonados
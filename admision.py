@@ -0,0 +1,174 @@
+import time
+import threading
+
+# ADMISIÓN Y LÍMITES POR CLIENTE
+# Sin límites, un solo cliente ruidoso (o malicioso) podía abrir conexiones sin fin, quedarse a mitad del
+# handshake ocupando un hilo, o mandar más de lo que procesar_mensajes alcanza a repartir y hacer crecer
+# la memoria del servidor. Acá están las piezas que lo frenan; servidor.py las aplica en cada modo:
+#   - Admision: tope de conexiones abiertas en total y por IP. Se chequea apenas se acepta el socket,
+#     antes de crear el hilo o la tarea; el rechazo se contesta en texto plano (RECHAZO) y se cierra.
+#   - Limitador: cubetas de fichas por alias y por IP, una de mensajes por segundo y otra de bytes por
+#     segundo. El mensaje que no tiene ficha se descarta y se le avisa al cliente (T_LIMITE). Los bytes
+#     nunca se descartan: si se pasa, el lector del cliente deja de leer el tiempo que haga falta y TCP
+#     frena al que manda (así una subida por bloques sigue andando, solo que más despacio).
+# El límite por IP es más alto que el de alias: detrás de una misma IP puede haber varios usuarios.
+# Un valor 0 desactiva ese límite (los benchmarks miden el servidor sin ninguno).
+# En modo multiproceso cada trabajador aplica los suyos: los topes valen por proceso.
+
+RECHAZO = "RECHAZADO:"  # prefijo del texto con que se rechaza una conexión antes del handshake
+
+# Segundos de tráfico que una cubeta deja pasar de golpe (la ráfaga) antes de empezar a limitar
+RAFAGA = 2.0
+
+# Motivos (etiqueta de la métrica chat_limites_total y primer campo de T_LIMITE)
+MENSAJES = "mensajes"
+MENSAJES_IP = "mensajes_ip"
+BYTES = "bytes"
+BYTES_IP = "bytes_ip"
+COLA_LLENA = "cola_llena"
+CONEXIONES = "conexiones"
+CONEXIONES_IP = "conexiones_ip"
+HANDSHAKE = "handshake"
+
+TEXTOS = {
+    MENSAJES: "Estás mandando demasiados mensajes: se descartó uno.",
+    MENSAJES_IP: "Demasiados mensajes desde tu dirección: se descartó uno.",
+    BYTES: "Estás mandando demasiados datos: se recibe más despacio.",
+    BYTES_IP: "Demasiados datos desde tu dirección: se recibe más despacio.",
+    COLA_LLENA: "El servidor está sobrecargado: se descartó tu mensaje.",
+    CONEXIONES: "El servidor está lleno. Intenta más tarde.",
+    CONEXIONES_IP: "Demasiadas conexiones desde tu dirección. Intenta más tarde.",
+}
+
+
+class Cubeta:
+    # Se llena a `tasa` fichas por segundo hasta `capacidad`
+    __slots__ = ("tasa", "capacidad", "fichas", "instante")
+
+    def __init__(self, tasa, capacidad, ahora):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.fichas = capacidad
+        self.instante = ahora
+
+    def llenar(self, ahora):
+        self.fichas = min(self.capacidad, self.fichas + (ahora - self.instante) * self.tasa)
+        self.instante = ahora
+
+    def espera(self, cantidad=0):
+        # Segundos que faltan para tener `cantidad` fichas (0 si ya están)
+        return max(0.0, (cantidad - self.fichas) / self.tasa)
+
+    def llena(self, ahora):
+        # Una cubeta que ya se habría vuelto a llenar es igual a una nueva: se puede olvidar
+        return self.fichas + (ahora - self.instante) * self.tasa >= self.capacidad
+
+
+class Limitador:
+    LIMPIAR_CADA = 30.0  # segundos entre barridas de las cubetas que ya no hacen falta
+    AVISAR_CADA = 2.0    # a lo sumo un aviso por cliente y motivo en este tiempo
+
+    def __init__(self, mensajes=0, datos=0, mensajes_ip=0, datos_ip=0):
+        self._lock = threading.Lock()
+        self._tasas = {
+            (MENSAJES, "alias"): mensajes, (MENSAJES, "ip"): mensajes_ip,
+            (BYTES, "alias"): datos, (BYTES, "ip"): datos_ip,
+        }
+        self._cubetas = {}  # (tipo, "alias"/"ip", valor) -> Cubeta
+        self._avisos = {}   # (alias, motivo) -> instante del último aviso
+        self._limpieza = time.monotonic() + self.LIMPIAR_CADA
+
+    def _cubeta(self, tipo, clase, valor, ahora):
+        tasa = self._tasas[(tipo, clase)]
+        if not tasa:
+            return None
+        clave = (tipo, clase, valor)
+        cubeta = self._cubetas.get(clave)
+        if cubeta is None:
+            cubeta = self._cubetas[clave] = Cubeta(tasa, tasa * RAFAGA, ahora)
+        else:
+            cubeta.llenar(ahora)
+        return cubeta
+
+    def mensaje(self, alias, ip):
+        # Toma una ficha de mensaje del alias y de la IP. Devuelve (None, 0) si alcanzó, o el motivo del
+        # rechazo y en cuántos segundos habrá lugar (en ese caso no se gasta ninguna de las dos)
+        ahora = time.monotonic()
+        with self._lock:
+            self._limpiar(ahora)
+            cubetas = ((MENSAJES, self._cubeta(MENSAJES, "alias", alias, ahora)),
+                       (MENSAJES_IP, self._cubeta(MENSAJES, "ip", ip, ahora)))
+            for motivo, cubeta in cubetas:
+                if cubeta is not None and cubeta.fichas < 1:
+                    return motivo, cubeta.espera(1)
+            for _, cubeta in cubetas:
+                if cubeta is not None:
+                    cubeta.fichas -= 1
+        return None, 0.0
+
+    def datos(self, alias, ip, cantidad):
+        # Descuenta los bytes recibidos (pueden quedar en negativo: ya llegaron) y devuelve
+        # (segundos que el lector tiene que esperar, motivo) con la más restrictiva de las dos
+        ahora = time.monotonic()
+        espera, motivo = 0.0, None
+        with self._lock:
+            self._limpiar(ahora)
+            for clase, nombre in (("alias", BYTES), ("ip", BYTES_IP)):
+                cubeta = self._cubeta(BYTES, clase, alias if clase == "alias" else ip, ahora)
+                if cubeta is None:
+                    continue
+                cubeta.fichas -= cantidad
+                segundos = cubeta.espera()
+                if segundos > espera:
+                    espera, motivo = segundos, nombre
+        return espera, motivo
+
+    def avisar(self, alias, motivo):
+        # True si corresponde avisarle al cliente (no más de uno cada AVISAR_CADA por motivo)
+        ahora = time.monotonic()
+        with self._lock:
+            if ahora - self._avisos.get((alias, motivo), 0.0) < self.AVISAR_CADA:
+                return False
+            self._avisos[(alias, motivo)] = ahora
+        return True
+
+    def _limpiar(self, ahora):
+        if ahora < self._limpieza:
+            return
+        self._limpieza = ahora + self.LIMPIAR_CADA
+        self._cubetas = {clave: c for clave, c in self._cubetas.items() if not c.llena(ahora)}
+        self._avisos = {clave: t for clave, t in self._avisos.items() if ahora - t < self.AVISAR_CADA}
+
+    def estadisticas(self):
+        with self._lock:
+            return {"cubetas": len(self._cubetas)}
+
+
+class Admision:
+    def __init__(self, maximo=0, por_ip=0):
+        self.maximo = maximo
+        self.por_ip = por_ip
+        self._lock = threading.Lock()
+        self._por_ip = {}  # ip -> conexiones abiertas
+        self.abiertas = 0
+
+    def entrar(self, ip):
+        # Devuelve None si la conexión entra (y la cuenta), o el motivo del rechazo
+        with self._lock:
+            if self.maximo and self.abiertas >= self.maximo:
+                return CONEXIONES
+            actuales = self._por_ip.get(ip, 0)
+            if self.por_ip and actuales >= self.por_ip:
+                return CONEXIONES_IP
+            self._por_ip[ip] = actuales + 1
+            self.abiertas += 1
+        return None
+
+    def salir(self, ip):
+        with self._lock:
+            restantes = self._por_ip.get(ip, 0) - 1
+            if restantes > 0:
+                self._por_ip[ip] = restantes
+            else:
+                self._por_ip.pop(ip, None)
+            self.abiertas -= 1
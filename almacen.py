@@ -0,0 +1,136 @@
+import os
+import re
+import time
+import threading
+
+# ALMACÉN DE ARCHIVOS DIRECCIONADO POR CONTENIDO
+# Cada archivo subido se guarda una sola vez con su SHA-256 como nombre (almacen/ab/abcdef...).
+# Si dos usuarios suben el mismo archivo, o uno lo manda a todos, hay una única copia en disco.
+# Los objetos se expulsan por antigüedad de uso (ttl) o, si se pasa del presupuesto de bytes,
+# empezando por los menos usados; los usados hace menos de `gracia` segundos nunca se tocan.
+# Con cluster.py varios procesos comparten el directorio y cada uno tiene su propio índice: cada uso
+# se marca también en el mtime del archivo, y antes de borrar se mira el disco, no solo el índice.
+
+_SHA_VALIDO = re.compile(r"^[0-9a-f]{64}$")
+
+
+def validar_sha(sha256):
+    if not _SHA_VALIDO.match(sha256):
+        raise ValueError(f"SHA-256 inválido: {sha256!r}")
+    return sha256
+
+
+def _tocar(ruta):
+    # Marca el uso en el disco, donde lo ven los demás procesos del cluster
+    try:
+        os.utime(ruta)
+    except OSError:
+        pass
+
+
+class AlmacenContenido:
+    def __init__(self, directorio="almacen", max_bytes=2 * 1024 ** 3, ttl=7 * 24 * 3600, gracia=300):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.gracia = gracia
+        self._objetos = {}  # sha256 -> [tamaño, último uso]
+        self._total = 0
+        self._lock = threading.Lock()
+        self.deduplicados = 0
+        self.expulsados = 0
+        self._cargar()
+
+    def _cargar(self):
+        # Reconstruye el índice desde el disco (el almacén sobrevive a reinicios del servidor)
+        os.makedirs(self.directorio, exist_ok=True)
+        for prefijo in os.listdir(self.directorio):
+            carpeta = os.path.join(self.directorio, prefijo)
+            if not os.path.isdir(carpeta):
+                continue
+            for sha256 in os.listdir(carpeta):
+                if _SHA_VALIDO.match(sha256):
+                    estado = os.stat(os.path.join(carpeta, sha256))
+                    self._objetos[sha256] = [estado.st_size, estado.st_mtime]
+                    self._total += estado.st_size
+
+    def ruta(self, sha256):
+        return os.path.join(self.directorio, sha256[:2], validar_sha(sha256))
+
+    def guardar(self, ruta_origen, sha256):
+        # Mueve el archivo al almacén (o lo descarta si ya había una copia) y devuelve su ruta final
+        destino = self.ruta(sha256)
+        with self._lock:
+            if sha256 in self._objetos and os.path.exists(destino):
+                os.remove(ruta_origen)
+                self._objetos[sha256][1] = time.time()
+                _tocar(destino)
+                self.deduplicados += 1
+            else:
+                os.makedirs(os.path.dirname(destino), exist_ok=True)
+                os.replace(ruta_origen, destino)
+                tamano = os.path.getsize(destino)
+                self._objetos[sha256] = [tamano, time.time()]
+                self._total += tamano
+            self._expulsar()
+        return destino
+
+    def abrir(self, sha256):
+        # Abre un objeto para leerlo y lo marca como usado. FileNotFoundError si no está.
+        ruta = self.ruta(sha256)
+        with self._lock:
+            if sha256 not in self._objetos:
+                # Puede haberlo guardado otro proceso que comparte el directorio (cluster.py)
+                if not os.path.exists(ruta):
+                    raise FileNotFoundError(sha256)
+                self._objetos[sha256] = [os.path.getsize(ruta), 0]
+                self._total += self._objetos[sha256][0]
+            self._objetos[sha256][1] = time.time()
+            _tocar(ruta)
+        return open(ruta, "rb")
+
+    def tamano(self, sha256):
+        with self._lock:
+            return self._objetos[sha256][0] if sha256 in self._objetos else None
+
+    def _expulsar(self):
+        ahora = time.time()
+        # Primero los vencidos por ttl, después los menos usados hasta entrar en el presupuesto
+        candidatos = sorted(self._objetos.items(), key=lambda item: item[1][1])
+        for sha256, (tamano, ultimo_uso) in candidatos:
+            if ahora - ultimo_uso < self.gracia:
+                break
+            if ahora - ultimo_uso <= self.ttl and self._total <= self.max_bytes:
+                break
+            ruta = self.ruta(sha256)
+            try:
+                estado = os.stat(ruta)
+            except FileNotFoundError:
+                estado = None
+            if estado is not None and estado.st_mtime > ultimo_uso:
+                # Otro proceso lo guardó o lo usó después: se toma su uso y se juzga con ese
+                self._objetos[sha256] = [estado.st_size, estado.st_mtime]
+                self._total += estado.st_size - tamano
+                if ahora - estado.st_mtime < self.gracia or (ahora - estado.st_mtime <= self.ttl and self._total <= self.max_bytes):
+                    continue
+                tamano = estado.st_size
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+            del self._objetos[sha256]
+            self._total -= tamano
+            self.expulsados += 1
+
+    def limpiar(self):
+        with self._lock:
+            self._expulsar()
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "objetos": len(self._objetos),
+                "bytes": self._total,
+                "deduplicados": self.deduplicados,
+                "expulsados": self.expulsados,
+            }
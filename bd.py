@@ -0,0 +1,214 @@
+import logging
+import sqlite3
+import threading
+from queue import Queue, Empty
+from contextlib import contextmanager
+from datetime import datetime
+
+# ACCESO A LA BASE DE DATOS (historial.db)
+# - Conexiones persistentes y reutilizadas (pool) en lugar de abrir y cerrar una por operación.
+# - Las sentencias son siempre las mismas cadenas SQL: sqlite3 guarda cada sentencia compilada en
+#   la caché de la conexión (cached_statements), así que reusar la conexión equivale a tenerlas preparadas.
+# - El esquema se versiona con PRAGMA user_version y se actualiza con la lista MIGRACIONES.
+
+RUTA_BD = "historial.db"
+
+log = logging.getLogger("chat.bd")
+
+# Cada migración es (versión, descripción, sentencias). Solo se agregan al final, nunca se editan.
+MIGRACIONES = [
+    (1, "tabla historial_conexiones", [
+        """
+        CREATE TABLE IF NOT EXISTS historial_conexiones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            alias TEXT NOT NULL,
+            codigo TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            fecha_conexion TEXT NOT NULL,
+            fecha_desconexion TEXT
+        );
+        """,
+    ]),
+    (2, "índices de historial_conexiones", [
+        "CREATE INDEX IF NOT EXISTS idx_conexiones_alias ON historial_conexiones(alias, fecha_conexion)",
+        # Índice parcial: solo las sesiones abiertas, que es lo que busca SQL_CERRAR_CONEXION
+        "CREATE INDEX IF NOT EXISTS idx_conexiones_abiertas ON historial_conexiones(alias) WHERE fecha_desconexion IS NULL",
+    ]),
+    (3, "tabla mensajes", [
+        """
+        CREATE TABLE IF NOT EXISTS mensajes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            remitente TEXT NOT NULL,
+            destinatario TEXT NOT NULL,
+            mensaje TEXT NOT NULL,
+            fecha TEXT NOT NULL
+        );
+        """,
+    ]),
+    # Clave de conversación: "Todos" o el par de alias ordenado ("ana|beto"), para leer una conversación
+    # entera por índice en vez de juntar archivos por remitente. El id (creciente) hace de cursor.
+    (4, "conversaciones e índices de mensajes", [
+        "ALTER TABLE mensajes ADD COLUMN conversacion TEXT",
+        """
+        UPDATE mensajes SET conversacion = CASE
+            WHEN lower(destinatario) = 'todos' THEN 'Todos'
+            WHEN remitente < destinatario THEN remitente || '|' || destinatario
+            ELSE destinatario || '|' || remitente
+        END
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_mensajes_conversacion ON mensajes(conversacion, id)",
+        "CREATE INDEX IF NOT EXISTS idx_mensajes_remitente ON mensajes(remitente, id)",
+        "CREATE INDEX IF NOT EXISTS idx_mensajes_destinatario ON mensajes(destinatario, id)",
+    ]),
+    # Índice de texto completo (FTS5) sobre el texto de los mensajes, mantenido por triggers
+    (5, "búsqueda de texto completo en mensajes", [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS mensajes_fts USING fts5(
+            mensaje, content='mensajes', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS mensajes_fts_insertar AFTER INSERT ON mensajes BEGIN
+            INSERT INTO mensajes_fts(rowid, mensaje) VALUES (new.id, new.mensaje);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS mensajes_fts_borrar AFTER DELETE ON mensajes BEGIN
+            INSERT INTO mensajes_fts(mensajes_fts, rowid, mensaje) VALUES ('delete', old.id, old.mensaje);
+        END
+        """,
+        "INSERT INTO mensajes_fts(mensajes_fts) VALUES ('rebuild')",
+    ]),
+    # Buzón de mensajes privados y archivos para usuarios desconectados (ver buzon.py)
+    (6, "buzón de entregas pendientes", [
+        """
+        CREATE TABLE IF NOT EXISTS buzon (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            destinatario TEXT NOT NULL,
+            tipo INTEGER NOT NULL,
+            carga BLOB NOT NULL,
+            tamano INTEGER NOT NULL,
+            fecha TEXT NOT NULL,
+            vence REAL NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_buzon_destinatario ON buzon(destinatario, id)",
+        "CREATE INDEX IF NOT EXISTS idx_buzon_vence ON buzon(vence)",
+    ]),
+]
+
+SQL_INSERTAR_CONEXION = """
+    INSERT INTO historial_conexiones(alias, codigo, ip, fecha_conexion)
+    VALUES (?, ?, ?, ?)
+"""
+SQL_CERRAR_CONEXION = """
+    UPDATE historial_conexiones
+    SET fecha_desconexion = ?
+    WHERE alias = ? AND fecha_desconexion IS NULL
+"""
+
+
+def conversacion_de(remitente, destinatario):
+    # Misma regla que la migración 4; además cada sala (#nombre) es su propia conversación
+    if destinatario.lower() == "todos":
+        return "Todos"
+    if destinatario.startswith("#"):
+        return destinatario
+    return "|".join(sorted((remitente, destinatario)))
+
+
+def ahora():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def abrir(ruta=RUTA_BD):
+    # Conexión configurada para uso concurrente: WAL (lectores no bloquean al escritor)
+    # y espera en vez de fallar si otra conexión tiene el lock de escritura.
+    conn = sqlite3.connect(ruta, check_same_thread=False, timeout=10.0, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    return conn
+
+
+def version_esquema(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrar(conn):
+    # Aplica en orden las migraciones pendientes; cada una en su propia transacción.
+    # El BEGIN es explícito: sqlite3 solo abre una transacción sola antes de un INSERT/UPDATE/DELETE, así que
+    # sin él un CREATE o un ALTER quedaban aplicados aunque fallara una sentencia posterior de la misma migración.
+    actual = version_esquema(conn)
+    for version, descripcion, sentencias in MIGRACIONES:
+        if version <= actual:
+            continue
+        with conn:
+            conn.execute("BEGIN")
+            for sql in sentencias:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+        log.info("BD: migración %s aplicada (%s)", version, descripcion)
+    return version_esquema(conn)
+
+
+def init_db(ruta=RUTA_BD):
+    conn = abrir(ruta)
+    try:
+        return migrar(conn)
+    finally:
+        conn.close()
+
+
+class PoolConexiones:
+    # Pool chico de conexiones persistentes. Cada hilo toma una, la usa y la devuelve.
+    def __init__(self, ruta=RUTA_BD, tamano=4):
+        self.ruta = ruta
+        self.tamano = tamano
+        self._libres = Queue()
+        self._creadas = 0
+        self._lock = threading.Lock()
+
+    def _tomar(self):
+        try:
+            return self._libres.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if self._creadas < self.tamano:
+                self._creadas += 1
+                return abrir(self.ruta)
+        return self._libres.get()
+
+    @contextmanager
+    def conexion(self):
+        conn = self._tomar()
+        try:
+            yield conn
+        finally:
+            self._libres.put(conn)
+
+    @contextmanager
+    def transaccion(self):
+        # Toma una conexión y confirma (o revierte) todo lo hecho dentro del bloque de una vez
+        with self.conexion() as conn:
+            with conn:
+                yield conn
+
+    def cerrar(self):
+        while True:
+            try:
+                self._libres.get_nowait().close()
+            except Empty:
+                break
+
+
+# REGISTRO DE CONEXIONES
+def aplicar_conexiones(conn, operaciones):
+    # Aplica en orden una lista de ("conexion", (alias, codigo, ip, fecha)) y
+    # ("desconexion", (fecha, alias)). No confirma: eso lo decide quien llama.
+    for tipo, datos in operaciones:
+        if tipo == "conexion":
+            conn.execute(SQL_INSERTAR_CONEXION, datos)
+        else:
+            conn.execute(SQL_CERRAR_CONEXION, datos)
@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import socket
+import tempfile
+import argparse
+import subprocess
+import statistics
+
+from comun import RAIZ, SIN_LIMITES, lanzar_servidor, guardar_json, puerto_libre
+from bench_carga import percentil
+from historial import HistorialSQLite
+from protocolo import Conexion, empaquetar_campos, T_ALIAS, T_BIENVENIDA, T_HISTORIAL_PEDIR, T_HISTORIAL_PAGINA, T_SALIR
+
+# BENCHMARK DE ARRANQUE Y DE LAS PRIMERAS PÁGINAS DEL HISTORIAL
+#   - importación: cuánto tarda `import servidor` en un intérprete nuevo y si arrastra tkinter o http.server
+#   - arranque:    desde que se lanza el proceso hasta que el puerto acepta conexiones, con un historial
+#                  ya cargado de --mensajes mensajes (el arranque no debería depender de su tamaño)
+#   - historial:   cada usuario entra y pide su primera página dos veces; la primera carga sus colas
+#                  (fría) y la segunda debería salir de memoria (tibia). Con --cache-mb 0 se compara
+#                  contra leer siempre de la BD.
+
+
+def medir_importacion(repeticiones):
+    codigo = ("import sys, time; t = time.perf_counter(); import servidor; "
+              "print(time.perf_counter() - t, 'tkinter' in sys.modules, 'http.server' in sys.modules)")
+    tiempos = []
+    for _ in range(repeticiones):
+        salida = subprocess.run([sys.executable, "-c", codigo], cwd=tempfile.gettempdir(), capture_output=True,
+                                text=True, env=dict(os.environ, PYTHONPATH=RAIZ), check=True).stdout.split()
+        tiempos.append(float(salida[0]))
+    resultado = {"import_ms": round(statistics.median(tiempos) * 1000, 1),
+                 "tkinter": salida[1] == "True", "http_server": salida[2] == "True"}
+    print(f"import servidor: {resultado['import_ms']} ms (mediana de {repeticiones}); "
+          f"tkinter={resultado['tkinter']} http.server={resultado['http_server']}")
+    return resultado
+
+
+def cargar_historial(ruta, mensajes, usuarios):
+    historial = HistorialSQLite(ruta)
+    lote = []
+    for i in range(mensajes):
+        destinatario = "Todos" if i % 3 == 0 else f"u{(i * 7) % usuarios}"
+        lote.append((f"u{i % usuarios}", f"mensaje de prueba número {i}", destinatario))
+        if len(lote) == 5000:
+            historial.guardar_lote(lote)
+            lote = []
+    historial.guardar_lote(lote)
+    historial.cerrar()
+
+
+def medir_arranque(modo, ruta_bd, repeticiones):
+    codigo = (f"import sys, servicio; servicio.main(['--modo', '{modo}', '--host', '127.0.0.1', "
+              f"'--metricas', '', '--bd', {ruta_bd!r}] + sys.argv[1:])")
+    tiempos = []
+    for _ in range(repeticiones):
+        puerto = puerto_libre()
+        inicio = time.perf_counter()
+        proceso = subprocess.Popen([sys.executable, "-c", codigo, "--puerto", str(puerto)],
+                                   cwd=os.path.dirname(ruta_bd), env=dict(os.environ, PYTHONPATH=RAIZ),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", puerto), timeout=1).close()
+                    break
+                except OSError:
+                    time.sleep(0.001)
+            tiempos.append(time.perf_counter() - inicio)
+        finally:
+            proceso.terminate()
+            proceso.wait()
+    resultado = {"modo": modo, "arranque_ms": round(statistics.median(tiempos) * 1000, 1)}
+    print(f"{modo:8} hasta aceptar conexiones: {resultado['arranque_ms']} ms (mediana de {repeticiones})")
+    return resultado
+
+
+def pedir_pagina(conexion):
+    inicio = time.perf_counter()
+    conexion.enviar(T_HISTORIAL_PEDIR, empaquetar_campos("", "", "50", ""))
+    while conexion.recibir().tipo != T_HISTORIAL_PAGINA:
+        pass
+    return time.perf_counter() - inicio
+
+
+def medir_historial(modo, ruta_bd, usuarios, cache_mb):
+    proceso, puerto = lanzar_servidor(modo, extra_args=("--bd", ruta_bd, "--cache-mb", str(cache_mb)))
+    frias, tibias = [], []
+    try:
+        for i in range(usuarios):
+            sock = socket.create_connection(("127.0.0.1", puerto))
+            sock.recv(1024)
+            conexion = Conexion(sock)
+            conexion.enviar(T_ALIAS, f"u{i}")
+            while conexion.recibir().tipo != T_BIENVENIDA:
+                pass
+            frias.append(pedir_pagina(conexion))
+            tibias.append(pedir_pagina(conexion))
+            conexion.enviar(T_SALIR)
+            sock.close()
+    finally:
+        proceso.terminate()
+        proceso.wait()
+    frias.sort()
+    tibias.sort()
+    resultado = {"modo": modo, "cache_mb": cache_mb, "usuarios": usuarios}
+    for nombre, tiempos in (("fria", frias), ("tibia", tibias)):
+        resultado[f"{nombre}_p50_ms"] = round(percentil(tiempos, 0.50) * 1000, 3)
+        resultado[f"{nombre}_p99_ms"] = round(percentil(tiempos, 0.99) * 1000, 3)
+    print(f"{modo:8} cache={cache_mb:>4} MB  primera página fría p50={resultado['fria_p50_ms']} ms "
+          f"p99={resultado['fria_p99_ms']} ms | tibia p50={resultado['tibia_p50_ms']} ms p99={resultado['tibia_p99_ms']} ms")
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiempo de importación y arranque, y primeras páginas del historial")
+    parser.add_argument("--modos", default="hilos,asyncio")
+    parser.add_argument("--repeticiones", type=int, default=10)
+    parser.add_argument("--mensajes", type=int, default=200000, help="mensajes precargados en el historial")
+    parser.add_argument("--usuarios", type=int, default=200)
+    parser.add_argument("--cache-mb", default="16,0", help="presupuestos de la caché a comparar")
+    parser.add_argument("--json", help="ruta donde guardar los resultados")
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp(prefix="bench_arranque_")
+    ruta_bd = os.path.join(directorio, "historial.db")
+    cargar_historial(ruta_bd, args.mensajes, args.usuarios)
+    os.environ.update(SIN_LIMITES)
+
+    resultados = [medir_importacion(args.repeticiones)]
+    for modo in args.modos.split(","):
+        resultados.append(medir_arranque(modo, ruta_bd, args.repeticiones))
+    for modo in args.modos.split(","):
+        for cache_mb in map(float, args.cache_mb.split(",")):
+            resultados.append(medir_historial(modo, ruta_bd, args.usuarios, cache_mb))
+    guardar_json(resultados, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+import time
+import sqlite3
+import argparse
+import tempfile
+
+import comun  # noqa: F401  (agrega la raíz del repo al path)
+import bd
+from historial import HistorialJSON
+from persistencia import EtapaPersistencia
+
+# BENCHMARK DE TORMENTAS DE CONEXIÓN/DESCONEXIÓN CONTRA historial.db
+# Precarga un historial de sesiones ya cerradas y luego repite N conexiones + N desconexiones con:
+#   - "original": sqlite3.connect() por operación y sin índices (como era servidor.py)
+#   - "pool":     conexiones reutilizadas del pool + índices, un commit por operación (aplicar_conexiones,
+#                 lo mismo que escribe la etapa de persistencia, pero sin agrupar)
+#   - "lotes":    la etapa de persistencia, que agrupa las operaciones en transacciones (lo que usa el servidor)
+
+
+def preparar(ruta, historicas, con_indices):
+    conn = sqlite3.connect(ruta)
+    if con_indices:
+        bd.migrar(conn)
+    else:
+        conn.execute(bd.MIGRACIONES[0][2][0])
+    filas = [(f"viejo{i % 5000}", "100", "127.0.0.1", "2024-01-01 00:00:00", "2024-01-01 01:00:00")
+             for i in range(historicas)]
+    conn.executemany("""
+        INSERT INTO historial_conexiones(alias, codigo, ip, fecha_conexion, fecha_desconexion)
+        VALUES (?, ?, ?, ?, ?)
+    """, filas)
+    conn.commit()
+    conn.close()
+
+
+def tormenta_original(ruta, alias):
+    # Réplica del código viejo: abre y cierra la BD en cada llamada
+    for a in alias:
+        conn = sqlite3.connect(ruta)
+        conn.execute(bd.SQL_INSERTAR_CONEXION, (a, "123", "127.0.0.1", bd.ahora()))
+        conn.commit()
+        conn.close()
+    for a in alias:
+        conn = sqlite3.connect(ruta)
+        conn.execute(bd.SQL_CERRAR_CONEXION, (bd.ahora(), a))
+        conn.commit()
+        conn.close()
+
+
+def tormenta_pool(ruta, alias):
+    pool = bd.PoolConexiones(ruta)
+    for a in alias:
+        with pool.transaccion() as conn:
+            bd.aplicar_conexiones(conn, [("conexion", (a, "123", "127.0.0.1", bd.ahora()))])
+    for a in alias:
+        with pool.transaccion() as conn:
+            bd.aplicar_conexiones(conn, [("desconexion", (bd.ahora(), a))])
+    pool.cerrar()
+
+
+def tormenta_lotes(ruta, alias):
+    etapa = EtapaPersistencia(HistorialJSON(os.path.dirname(ruta)), ruta_bd=ruta).iniciar()
+    for a in alias:
+        etapa.registrar_conexion(a, "123", "127.0.0.1")
+    for a in alias:
+        etapa.registrar_desconexion(a)
+    etapa.detener()
+
+
+MODOS = {
+    "original": (tormenta_original, False),
+    "pool": (tormenta_pool, True),
+    "lotes": (tormenta_lotes, True),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tormentas de conexión/desconexión contra historial_conexiones")
+    parser.add_argument("--usuarios", type=int, default=2000)
+    parser.add_argument("--historicas", type=int, default=200_000, help="sesiones cerradas precargadas")
+    parser.add_argument("--modos", default="original,pool,lotes")
+    parser.add_argument("--json", help="ruta donde guardar los resultados")
+    args = parser.parse_args()
+
+    alias = [f"bot{i}" for i in range(args.usuarios)]
+    resultados = []
+    for modo in args.modos.split(","):
+        funcion, con_indices = MODOS[modo]
+        ruta = os.path.join(tempfile.mkdtemp(prefix="bench_bd_"), "historial.db")
+        preparar(ruta, args.historicas, con_indices)
+        inicio = time.perf_counter()
+        funcion(ruta, alias)
+        duracion = time.perf_counter() - inicio
+
+        conn = sqlite3.connect(ruta)
+        abiertas = conn.execute("SELECT COUNT(*) FROM historial_conexiones WHERE fecha_desconexion IS NULL").fetchone()[0]
+        conn.close()
+        operaciones = 2 * args.usuarios
+        resultado = {
+            "modo": modo,
+            "operaciones": operaciones,
+            "segundos": round(duracion, 3),
+            "operaciones_por_segundo": round(operaciones / duracion, 1),
+            "sesiones_abiertas_al_final": abiertas,
+        }
+        resultados.append(resultado)
+        print(f"{modo:9} {operaciones} ops en {resultado['segundos']} s "
+              f"({resultado['operaciones_por_segundo']} ops/s), abiertas al final: {abiertas}")
+    comun.guardar_json(resultados, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import re
+import time
+import base64
+import random
+import asyncio
+import argparse
+
+from comun import lanzar_servidor, estado_arbol, guardar_json, subir_limite_archivos
+from protocolo import (
+    DecodificadorTramas, codificar_trama, empaquetar_campos,
+    T_ALIAS, T_BIENVENIDA, T_MSG_ALL, T_MSG_PRIVADO, T_ARCHIVO, T_SALIR
+)
+
+# BENCHMARK DE CARGA Y LATENCIA
+# Levanta el servidor sin interfaz y lo maneja con N bots que hablan el protocolo de verdad:
+# handshake de alias, mensajes públicos, privados, archivos y salida, con el protocolo de tramas o con
+# el de texto viejo (MSG_ALL:, MSG_PRIVATE:, FILE:, salir). Cada mensaje lleva la hora de envío
+# (@nanosegundos@, en el texto o en el nombre del archivo) y quien lo recibe calcula la latencia de punta a punta.
+# Con el protocolo viejo el servidor toma cada recv() como un mensaje: si dos envíos se juntan en el
+# socket cuentan como uno solo, así que para comparar corridas conviene usar tramas.
+
+MARCA = re.compile(rb"@(\d{19})@")
+
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return None
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+class Bot:
+    def __init__(self, alias, protocolo, latencias):
+        self.alias = alias
+        self.protocolo = protocolo
+        self.latencias = latencias
+        self.enviados = 0
+        self.recibidos = 0
+
+    async def conectar(self, host, puerto):
+        self.reader, self.writer = await asyncio.open_connection(host, puerto)
+        await self.reader.read(1024)  # pedido de alias en texto plano
+        if self.protocolo == "tramas":
+            self.writer.write(codificar_trama(T_ALIAS, self.alias))
+            decodificador = DecodificadorTramas()
+            while True:
+                tramas = decodificador.alimentar(await self.reader.read(65536))
+                if any(t.tipo == T_BIENVENIDA for t in tramas):
+                    break
+        else:
+            self.writer.write(self.alias.encode("utf-8"))
+            await self.reader.read(1024)  # bienvenida
+
+    async def leer(self):
+        # Busca las marcas de tiempo en todo lo que llega; se guarda la cola del búfer por si una marca
+        # quedó partida entre dos lecturas
+        resto = b""
+        while True:
+            datos = await self.reader.read(1 << 20)
+            if not datos:
+                break
+            ahora = time.time_ns()
+            datos = resto + datos
+            fin = 0
+            for marca in MARCA.finditer(datos):
+                self.latencias.append((ahora - int(marca.group(1))) / 1e6)
+                self.recibidos += 1
+                fin = marca.end()
+            resto = datos[max(fin, len(datos) - 20):]
+
+    def enviar(self, tipo, destinatario, relleno, archivo):
+        marca = f"@{time.time_ns()}@"
+        if self.protocolo == "tramas":
+            if tipo == "todos":
+                datos = codificar_trama(T_MSG_ALL, marca + relleno)
+            elif tipo == "privado":
+                datos = codificar_trama(T_MSG_PRIVADO, empaquetar_campos(destinatario, marca + relleno))
+            else:
+                datos = codificar_trama(T_ARCHIVO, empaquetar_campos("Todos", f"bench{marca}.bin", archivo))
+        else:
+            if tipo == "todos":
+                datos = f"MSG_ALL:{marca}{relleno}".encode("utf-8")
+            elif tipo == "privado":
+                datos = f"MSG_PRIVATE:{destinatario}:{marca}{relleno}".encode("utf-8")
+            else:
+                datos = f"FILE:Todos:bench{marca}.bin:{base64.b64encode(archivo).decode()}".encode("utf-8")
+        self.writer.write(datos)
+        self.enviados += 1
+
+    async def salir(self):
+        self.writer.write(codificar_trama(T_SALIR) if self.protocolo == "tramas" else b"salir")
+        await self.writer.drain()
+        self.writer.close()
+
+
+async def medir(modo, args):
+    proceso, puerto = lanzar_servidor(modo)
+    base = estado_arbol(proceso.pid)
+    latencias = []
+    bots = [Bot(f"bot{i}", args.protocolo, latencias) for i in range(args.bots)]
+    pico = dict(base)
+
+    try:
+        # Handshake de todos los bots, de a `lote` en paralelo
+        inicio = time.perf_counter()
+        for i in range(0, len(bots), args.lote):
+            await asyncio.gather(*(b.conectar("127.0.0.1", puerto) for b in bots[i:i + args.lote]))
+        segundos_conexion = time.perf_counter() - inicio
+        lectores = [asyncio.create_task(b.leer()) for b in bots]
+        await asyncio.sleep(1.0)  # que se asiente la presencia de todos
+        latencias.clear()
+
+        # Mezcla de mensajes: cada tic, cada bot emisor manda uno con la probabilidad que corresponda
+        tipos, pesos = zip(*args.mezcla.items())
+        relleno = "x" * args.tamano
+        archivo = random.randbytes(args.tamano_archivo)
+        emisores = bots[:args.emisores or len(bots)]
+        intervalo = 1.0 / args.tasa
+        inicio = time.perf_counter()
+        siguiente = inicio
+        while time.perf_counter() - inicio < args.duracion:
+            for bot in emisores:
+                tipo = random.choices(tipos, pesos)[0]
+                bot.enviar(tipo, random.choice(bots).alias, relleno, archivo)
+            siguiente += intervalo
+            espera = siguiente - time.perf_counter()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            else:
+                await asyncio.sleep(0)
+            estado = estado_arbol(proceso.pid)
+            for clave in ("rss_kb", "vm_kb", "hilos"):
+                pico[clave] = max(pico[clave], estado[clave])
+        segundos_envio = time.perf_counter() - inicio
+
+        # Se espera a que lleguen las entregas pendientes y los bots salen con "salir"
+        await asyncio.sleep(args.espera)
+        final = estado_arbol(proceso.pid)
+        await asyncio.gather(*(b.salir() for b in bots), return_exceptions=True)
+        for lector in lectores:
+            lector.cancel()
+    finally:
+        proceso.terminate()
+        proceso.wait()
+
+    ordenadas = sorted(latencias)
+    enviados = sum(b.enviados for b in bots)
+    resultado = {
+        "modo": modo,
+        "protocolo": args.protocolo,
+        "bots": args.bots,
+        "emisores": len(emisores),
+        "mezcla": args.mezcla,
+        "tamano": args.tamano,
+        "tamano_archivo": args.tamano_archivo,
+        "segundos_conexion": round(segundos_conexion, 3),
+        "segundos_envio": round(segundos_envio, 3),
+        "enviados": enviados,
+        "entregas": len(ordenadas),
+        "enviados_por_segundo": round(enviados / segundos_envio, 1),
+        "entregas_por_segundo": round(len(ordenadas) / (segundos_envio + args.espera), 1),
+        "latencia_ms": {
+            "p50": percentil(ordenadas, 0.50),
+            "p99": percentil(ordenadas, 0.99),
+            "p999": percentil(ordenadas, 0.999),
+            "max": ordenadas[-1] if ordenadas else None,
+        },
+        "servidor_base": base,
+        "servidor_pico": pico,
+        "servidor_final": final,
+    }
+    lat = resultado["latencia_ms"]
+    formato = lambda v: "-" if v is None else f"{v:.1f}"
+    print(f"{modo:8} bots={args.bots} enviados={enviados} entregas={len(ordenadas)} "
+          f"({resultado['entregas_por_segundo']}/s) p50={formato(lat['p50'])} ms p99={formato(lat['p99'])} ms "
+          f"p999={formato(lat['p999'])} ms rss pico={pico['rss_kb']} KB hilos pico={pico['hilos']}")
+    return resultado
+
+
+def leer_mezcla(texto):
+    # "todos=80,privado=18,archivo=2"
+    mezcla = {}
+    for parte in texto.split(","):
+        tipo, peso = parte.split("=")
+        if tipo not in ("todos", "privado", "archivo"):
+            raise argparse.ArgumentTypeError(f"Tipo de mensaje desconocido: {tipo}")
+        mezcla[tipo] = float(peso)
+    return mezcla
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga con bots y latencia de entrega de punta a punta")
+    parser.add_argument("--bots", type=int, default=200)
+    parser.add_argument("--emisores", type=int, default=20, help="bots que mandan mensajes (0 = todos)")
+    parser.add_argument("--tasa", type=float, default=1.0, help="mensajes por segundo de cada emisor")
+    parser.add_argument("--duracion", type=float, default=10.0, help="segundos mandando mensajes")
+    parser.add_argument("--espera", type=float, default=3.0, help="segundos para que terminen de llegar")
+    parser.add_argument("--mezcla", type=leer_mezcla, default=leer_mezcla("todos=80,privado=18,archivo=2"))
+    parser.add_argument("--tamano", type=int, default=100, help="bytes de relleno de cada mensaje")
+    parser.add_argument("--tamano-archivo", type=int, default=10_000)
+    parser.add_argument("--protocolo", choices=("tramas", "legado"), default="tramas")
+    parser.add_argument("--lote", type=int, default=100, help="handshakes en paralelo")
+    parser.add_argument("--modos", default="hilos,asyncio")
+    parser.add_argument("--json", help="ruta donde guardar los resultados")
+    args = parser.parse_args()
+
+    subir_limite_archivos()
+    resultados = [asyncio.run(medir(modo, args)) for modo in args.modos.split(",")]
+    guardar_json(resultados, args.json)
+
+
+if __name__ == "__main__":
+    main()
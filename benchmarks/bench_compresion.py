@@ -0,0 +1,232 @@
+import time
+import random
+import asyncio
+import argparse
+
+from comun import lanzar_servidor, guardar_json, subir_limite_archivos, cpu_arbol
+import compresion
+from protocolo import (
+    DecodificadorTramas, codificar_para, codificar_trama, empaquetar_campos, MODO_TRAMAS,
+    T_ALIAS, T_BIENVENIDA, T_MSG_ALL, T_ARCHIVO, T_ARCHIVO_BLOQUE, T_ARCHIVO_FIN, T_TEXTO,
+    T_PRESENCIA_FOTO, T_HISTORIAL_PAGINA
+)
+from transferencias import empaquetar_bloque, TAMANO_BLOQUE
+
+# BENCHMARK DE COMPRESIÓN
+# Dos partes:
+#   - "codecs": cada tipo de carga típica del chat (mensajes cortos y largos, foto de presencia, página de
+#     historial, bloques de archivos de texto, JPG y binarios) codificada como trama con cada códec:
+#     bytes en la red, CPU para comprimir y CPU para descomprimir. Sin red, en este mismo proceso.
+#   - "red": el servidor de verdad con N clientes que negocian (o no) compresión en el handshake y
+#     un emisor que manda una mezcla de mensajes y archivos. Mide bytes que llegan a los clientes y
+#     CPU del proceso servidor: el ahorro de red contra el costo de comprimir una vez por destinatario.
+
+PALABRAS = ("hola che cómo andás bien todo tranquilo mañana nos vemos en la facu a las diez "
+            "ya subí el archivo del proyecto final revisen la parte de sockets y el informe "
+            "dale perfecto gracias alguien tiene los apuntes de redes del martes jaja sí "
+            "el servidor se cayó de nuevo reinicialo porfa ok listo ahora anda").split()
+
+
+def frase(rng, minimo=3, maximo=25):
+    return " ".join(rng.choice(PALABRAS) for _ in range(rng.randint(minimo, maximo)))
+
+
+def texto_archivo(rng, tamano):
+    # CSV/log con columnas repetitivas, como un export o un informe
+    lineas = []
+    total = 0
+    while total < tamano:
+        linea = f"{rng.randint(1, 10**6)},{rng.choice(PALABRAS)},{rng.random():.6f},2024-05-{rng.randint(1, 28):02d},{frase(rng, 2, 6)}\n"
+        lineas.append(linea)
+        total += len(linea)
+    return "".join(lineas).encode("utf-8")[:tamano]
+
+
+def cargas(rng, tamano_archivo):
+    # (nombre, tipo, [cargas]) con el contenido realista de cada caso
+    jpg = b"\xff\xd8\xff\xe0" + rng.randbytes(tamano_archivo - 4)
+    binario = rng.randbytes(tamano_archivo)
+    texto = texto_archivo(rng, tamano_archivo)
+    presencia = empaquetar_campos("1", *(f"{rng.randint(100, 999)}|usuario{i}" for i in range(500)))
+    pagina = empaquetar_campos("", "123", *(f"{1000 + i}|2024-05-10 12:{i % 60:02d}:00|usuario{i % 7}|Todos|{frase(rng)}"
+                                          for i in range(50)))
+    return [
+        ("chat_corto", T_MSG_ALL, [frase(rng).encode() for _ in range(2000)]),
+        ("chat_largo", T_TEXTO, [f"ana (Todos): {frase(rng, 150, 300)}".encode() for _ in range(200)]),
+        ("presencia_500", T_PRESENCIA_FOTO, [presencia] * 20),
+        ("historial_50", T_HISTORIAL_PAGINA, [pagina] * 50),
+        ("archivo_texto", T_ARCHIVO_BLOQUE, _bloques(texto)),
+        ("archivo_jpg", T_ARCHIVO_BLOQUE, _bloques(jpg)),
+        ("archivo_binario", T_ARCHIVO_BLOQUE, _bloques(binario)),
+    ]
+
+
+def _bloques(datos):
+    return [empaquetar_bloque("b" * 32, i, datos[i:i + TAMANO_BLOQUE]) for i in range(0, len(datos), TAMANO_BLOQUE)]
+
+
+def variantes(nombres):
+    # "ninguna", "zlib1", "zlib6", "zstd3"... -> Codec (o None)
+    resultado = {}
+    for nombre in nombres:
+        if nombre == "ninguna":
+            resultado[nombre] = None
+        elif nombre.startswith("zstd") and compresion.zstandard is None:
+            print(f"{nombre}: falta el paquete zstandard, se omite")
+        else:
+            tipo, nivel = nombre[:4], int(nombre[4:])
+            bandera = compresion.F_ZSTD if tipo == "zstd" else compresion.F_ZLIB
+            resultado[nombre] = compresion.Codec(tipo, bandera, nivel)
+    return resultado
+
+
+def medir_codecs(args):
+    rng = random.Random(1)
+    resultados = []
+    for caso, tipo, lista in cargas(rng, args.tamano_archivo):
+        original = sum(len(c) for c in lista)
+        for nombre, codec in variantes(args.codecs.split(",")).items():
+            if codec is not None:
+                compresion.CODECS[codec.bandera] = codec  # el decodificador usa el mismo nivel
+            inicio = time.process_time()
+            tramas = [codificar_para(MODO_TRAMAS, tipo, c, codec=codec) for c in lista]
+            segundos_comprimir = time.process_time() - inicio
+            red = sum(len(t) for t in tramas)
+
+            decodificador = DecodificadorTramas()
+            inicio = time.process_time()
+            for trama in tramas:
+                decodificador.alimentar(trama)
+            segundos_descomprimir = time.process_time() - inicio
+
+            resultado = {
+                "parte": "codecs", "caso": caso, "codec": nombre, "mensajes": len(lista),
+                "bytes_originales": original, "bytes_red": red, "ratio": round(red / original, 3),
+                "comprimir_us_por_kb": round(segundos_comprimir * 1e6 / (original / 1024), 2),
+                "descomprimir_us_por_kb": round(segundos_descomprimir * 1e6 / (original / 1024), 2),
+            }
+            resultados.append(resultado)
+            print(f"{caso:16} {nombre:8} red={red:>10} ({resultado['ratio']:.3f}) "
+                  f"comprimir={resultado['comprimir_us_por_kb']:>7} µs/KB "
+                  f"descomprimir={resultado['descomprimir_us_por_kb']:>7} µs/KB")
+    return resultados
+
+
+# PARTE "red"
+class Receptor:
+    def __init__(self, alias, flags):
+        self.alias = alias
+        self.flags = flags
+        self.bytes = 0
+        self.mensajes = 0
+
+    async def conectar(self, puerto):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", puerto)
+        await self.reader.read(1024)
+        self.writer.write(codificar_trama(T_ALIAS, self.alias, self.flags))
+        self.decodificador = DecodificadorTramas()
+        pendientes = []
+        while not any(t.tipo == T_BIENVENIDA for t in pendientes):
+            pendientes += self.decodificador.alimentar(await self.reader.read(65536))
+        self.codec = compresion.CODECS.get(next(t for t in pendientes if t.tipo == T_BIENVENIDA).flags)
+
+    async def leer(self, esperados):
+        while self.mensajes < esperados:
+            datos = await self.reader.read(1 << 20)
+            if not datos:
+                break
+            self.bytes += len(datos)
+            for trama in self.decodificador.alimentar(datos):
+                if trama.tipo in (T_TEXTO, T_ARCHIVO_FIN):
+                    self.mensajes += 1
+
+
+async def medir_red(modo, flags, etiqueta, args):
+    proceso, puerto = lanzar_servidor(modo)
+    rng = random.Random(2)
+    try:
+        receptores = [Receptor(f"r{i}", flags) for i in range(args.clientes)]
+        for receptor in receptores:
+            await receptor.conectar(puerto)
+        emisor = Receptor("emisor", flags)
+        await emisor.conectar(puerto)
+        await asyncio.sleep(0.5)
+
+        # Mezcla: sobre todo chat, y cada tanto un archivo de texto o una foto a alguno de los clientes.
+        # Los archivos van privados: a "Todos" el servidor solo manda una referencia y no habría qué comprimir.
+        texto = texto_archivo(rng, args.tamano_archivo)
+        jpg = b"\xff\xd8\xff\xe0" + rng.randbytes(args.tamano_archivo - 4)
+        mensajes = []
+        esperados = {r.alias: 0 for r in receptores}
+        for i in range(args.mensajes):
+            r = rng.random()
+            if r < args.proporcion_archivos:
+                destinatario = f"r{i % args.clientes}"
+                nombre, contenido = (f"informe{i}.csv", texto) if r < args.proporcion_archivos / 2 else (f"foto{i}.jpg", jpg)
+                mensajes.append((T_ARCHIVO, empaquetar_campos(destinatario, nombre, contenido)))
+                esperados[destinatario] += 1
+            else:
+                mensajes.append((T_MSG_ALL, frase(rng, 3, 40 if rng.random() < 0.9 else 300).encode()))
+                for alias in esperados:
+                    esperados[alias] += 1
+
+        cpu_antes = cpu_arbol(proceso.pid)
+        lectores = [asyncio.create_task(r.leer(esperados[r.alias])) for r in receptores]
+        inicio = time.perf_counter()
+        enviados = 0
+        for tipo, carga in mensajes:
+            trama = codificar_para(MODO_TRAMAS, tipo, carga, codec=emisor.codec)
+            emisor.writer.write(trama)
+            enviados += len(trama)
+            await emisor.writer.drain()
+        await asyncio.wait_for(asyncio.gather(*lectores), args.espera)
+        segundos = time.perf_counter() - inicio
+        cpu = cpu_arbol(proceso.pid) - cpu_antes
+    finally:
+        proceso.terminate()
+        proceso.wait()
+
+    recibidos = sum(r.bytes for r in receptores)
+    resultado = {
+        "parte": "red", "modo": modo, "codec": etiqueta, "clientes": args.clientes, "mensajes": len(mensajes),
+        "bytes_subida": enviados, "bytes_bajada": recibidos, "segundos": round(segundos, 3),
+        "cpu_servidor_segundos": round(cpu, 3),
+        "cpu_servidor_ms_por_mensaje": round(cpu * 1000 / len(mensajes), 3),
+    }
+    print(f"{modo:8} {etiqueta:8} subida={enviados:>10} bajada={recibidos:>11} "
+          f"cpu servidor={resultado['cpu_servidor_segundos']} s ({resultado['cpu_servidor_ms_por_mensaje']} ms/msg) "
+          f"en {resultado['segundos']} s")
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ancho de banda contra CPU de la compresión de tramas")
+    parser.add_argument("--partes", default="codecs,red")
+    parser.add_argument("--codecs", default="ninguna,zlib1,zlib6,zlib9,zstd1,zstd3",
+                        help="variantes para la parte codecs")
+    parser.add_argument("--tamano-archivo", type=int, default=256 * 1024)
+    parser.add_argument("--clientes", type=int, default=50)
+    parser.add_argument("--mensajes", type=int, default=500)
+    parser.add_argument("--proporcion-archivos", type=float, default=0.04)
+    parser.add_argument("--espera", type=float, default=120.0, help="segundos máximos para recibir todo")
+    parser.add_argument("--modos", default="hilos,asyncio")
+    parser.add_argument("--json", help="ruta donde guardar los resultados")
+    args = parser.parse_args()
+
+    subir_limite_archivos()
+    resultados = []
+    partes = args.partes.split(",")
+    if "codecs" in partes:
+        resultados += medir_codecs(args)
+    if "red" in partes:
+        negociaciones = [("ninguna", 0), ("zlib", compresion.F_ZLIB)]
+        if compresion.zstandard is not None:
+            negociaciones.append(("zstd", compresion.F_ZSTD))
+        for modo in args.modos.split(","):
+            for etiqueta, flags in negociaciones:
+                resultados.append(asyncio.run(medir_red(modo, flags, etiqueta, args)))
+    guardar_json(resultados, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import time
+
+from comun import lanzar_servidor, estado_proceso, guardar_json, subir_limite_archivos
+from protocolo import codificar_trama, T_ALIAS
+
+# BENCHMARK DE CONEXIONES INACTIVAS
+# Abre N clientes que hacen el handshake de alias y se quedan quietos (solo leen lo que llega),
+# y compara memoria residente e hilos del servidor entre el modo hilos y el modo asyncio.
+
+
+async def cliente_inactivo(host, puerto, alias, listo, fin):
+    reader, writer = await asyncio.open_connection(host, puerto)
+    await reader.read(1024)  # pedido de alias en texto plano
+    writer.write(codificar_trama(T_ALIAS, alias))
+    await reader.read(1024)  # bienvenida
+    listo.release()
+    # Drena todo lo que mande el servidor (listas de usuarios) hasta que termine la prueba
+    while not fin.is_set():
+        try:
+            if not await asyncio.wait_for(reader.read(65536), timeout=0.5):
+                break
+        except asyncio.TimeoutError:
+            pass
+    writer.close()
+
+
+async def medir(modo, clientes, lote):
+    proceso, puerto = lanzar_servidor(modo)
+    base = estado_proceso(proceso.pid)
+    listo = asyncio.Semaphore(0)
+    fin = asyncio.Event()
+    tareas = []
+    inicio = time.perf_counter()
+    try:
+        for i in range(0, clientes, lote):
+            for j in range(i, min(i + lote, clientes)):
+                tareas.append(asyncio.create_task(cliente_inactivo("127.0.0.1", puerto, f"bot{j}", listo, fin)))
+            for _ in range(i, min(i + lote, clientes)):
+                await listo.acquire()
+        duracion = time.perf_counter() - inicio
+        await asyncio.sleep(1.0)
+        final = estado_proceso(proceso.pid)
+    finally:
+        fin.set()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        proceso.terminate()
+        proceso.wait()
+
+    resultado = {
+        "modo": modo,
+        "clientes": clientes,
+        "segundos_conexion": round(duracion, 3),
+        "rss_base_kb": base["rss_kb"],
+        "rss_final_kb": final["rss_kb"],
+        "kb_por_cliente": round((final["rss_kb"] - base["rss_kb"]) / clientes, 2),
+        "vm_final_kb": final["vm_kb"],
+        "hilos": final["hilos"],
+    }
+    print(f"{modo:8} clientes={clientes:6} rss={final['rss_kb']:8} KB "
+          f"({resultado['kb_por_cliente']} KB/cliente) vm={final['vm_kb']:9} KB hilos={final['hilos']:6} "
+          f"tiempo={resultado['segundos_conexion']} s")
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Conexiones inactivas: modo hilos vs asyncio")
+    parser.add_argument("--clientes", type=int, default=1000)
+    parser.add_argument("--lote", type=int, default=100, help="conexiones abiertas en paralelo")
+    parser.add_argument("--modos", default="hilos,asyncio")
+    parser.add_argument("--json", help="ruta donde guardar los resultados")
+    args = parser.parse_args()
+
+    subir_limite_archivos()
+    resultados = [asyncio.run(medir(modo, args.clientes, args.lote)) for modo in args.modos.split(",")]
+    guardar_json(resultados, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import re
+import time
+import random
+import asyncio
+import argparse
+import urllib.request
+
+from comun import lanzar_servidor, guardar_json, subir_limite_archivos, cpu_arbol, puerto_libre
+from bench_carga import MARCA, percentil
+from protocolo import (
+    DecodificadorTramas, codificar_trama, empaquetar_campos,
+    T_ALIAS, T_BIENVENIDA, T_MSG_ALL, T_MSG_PRIVADO, T_SALIR
+)
+
+# BENCHMARK DE CONTENCIÓN DEL REGISTRO DE CLIENTES
+# Para cada cantidad de clientes conectados: varios emisores mandan broadcasts y privados a la vez
+# mientras otros bots entran y salen todo el tiempo (cada entrada y salida modifica el registro).
+# Mide entregas por segundo, cuánto tarda el handshake de los que entran en plena carga y, desde
+# /metrics, cuántas veces se encontró ocupado el lock del registro y cuánto se esperó por él.
+# Si el registro no es un cuello de botella, las entregas por segundo crecen con los clientes
+# (cada broadcast reparte a más colas) y el lock casi nunca está disputado.
+
+DISPUTADO = re.compile(r'^chat_lock_adquisiciones_total\{estado="disputado"\} (\d+)', re.M)
+LIBRE = re.compile(r'^chat_lock_adquisiciones_total\{estado="libre"\} (\d+)', re.M)
+ESPERA = re.compile(r"^chat_lock_espera_segundos_sum (\S+)", re.M)
+
+
+def leer_lock(puerto_metricas):
+    with urllib.request.urlopen(f"http://127.0.0.1:{puerto_metricas}/metrics", timeout=5) as respuesta:
+        texto = respuesta.read().decode()
+    return _valor(LIBRE, texto, int), _valor(DISPUTADO, texto, int), _valor(ESPERA, texto, float)
+
+
+def _valor(patron, texto, tipo):
+    # Las series aparecen recién la primera vez que se usan
+    encontrado = patron.search(texto)
+    return tipo(encontrado.group(1)) if encontrado else tipo(0)
+
+
+class Bot:
+    def __init__(self, alias):
+        self.alias = alias
+        self.recibidos = 0
+
+    async def conectar(self, puerto):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", puerto)
+        await self.reader.read(1024)
+        inicio = time.perf_counter()
+        self.writer.write(codificar_trama(T_ALIAS, self.alias))
+        decodificador = DecodificadorTramas()
+        while not any(t.tipo == T_BIENVENIDA for t in decodificador.alimentar(await self.reader.read(65536))):
+            pass
+        return time.perf_counter() - inicio
+
+    async def leer(self, esperados):
+        resto = b""
+        while self.recibidos < esperados:
+            datos = await self.reader.read(1 << 20)
+            if not datos:
+                break
+            datos = resto + datos
+            fin = 0
+            for marca in MARCA.finditer(datos):
+                self.recibidos += 1
+                fin = marca.end()
+            resto = datos[max(fin, len(datos) - 20):]
+
+    async def salir(self):
+        self.writer.write(codificar_trama(T_SALIR))
+        await self.writer.drain()
+        self.writer.close()
+
+
+async def emitir(bot, receptores, args):
+    # Devuelve cuántas entregas generó: N por broadcast y una por privado
+    rng = random.Random(bot.alias)
+    entregas = {r.alias: 0 for r in receptores}
+    for i in range(args.mensajes):
+        marca = f"@{time.time_ns()}@ "
+        if rng.random() < args.proporcion_privados:
+            destinatario = rng.choice(receptores).alias
+            bot.writer.write(codificar_trama(T_MSG_PRIVADO, empaquetar_campos(destinatario, marca + "privado")))
+            entregas[destinatario] += 1
+        else:
+            bot.writer.write(codificar_trama(T_MSG_ALL, marca + "hola a todos"))
+            for alias in entregas:
+                entregas[alias] += 1
+        if (i + 1) % args.rafaga == 0:
+            await bot.writer.drain()
+            await asyncio.sleep(0)
+    await bot.writer.drain()
+    return entregas
+
+
+async def rotar(numero, puerto, tiempos, fin):
+    # Bots que entran y salen sin parar mientras dura la carga
+    i = 0
+    while not fin.is_set():
+        bot = Bot(f"rota{numero}_{i}")
+        i += 1
+        tiempos.append(await bot.conectar(puerto))
+        await bot.salir()
+
+
+async def medir(modo, clientes, args):
+    puerto_metricas = puerto_libre()
+    proceso, puerto = lanzar_servidor(modo, extra_args=("--metricas", f"127.0.0.1:{puerto_metricas}"))
+    tiempos = []
+    try:
+        receptores = [Bot(f"r{i}") for i in range(clientes)]
+        for i in range(0, clientes, 50):
+            await asyncio.gather(*(r.conectar(puerto) for r in receptores[i:i + 50]))
+        emisores = [Bot(f"e{i}") for i in range(args.emisores)]
+        await asyncio.gather(*(e.conectar(puerto) for e in emisores))
+        await asyncio.sleep(0.5)
+
+        libre_antes, disputado_antes, espera_antes = leer_lock(puerto_metricas)
+        cpu_antes = cpu_arbol(proceso.pid)
+        fin = asyncio.Event()
+        rotadores = [asyncio.create_task(rotar(n, puerto, tiempos, fin)) for n in range(args.rotadores)]
+        inicio = time.perf_counter()
+        repartos = await asyncio.gather(*(emitir(e, receptores, args) for e in emisores))
+        esperados = {r.alias: sum(reparto[r.alias] for reparto in repartos) for r in receptores}
+        await asyncio.wait_for(asyncio.gather(*(r.leer(esperados[r.alias]) for r in receptores)), args.espera)
+        segundos = time.perf_counter() - inicio
+        fin.set()
+        await asyncio.gather(*rotadores, return_exceptions=True)
+        cpu = cpu_arbol(proceso.pid) - cpu_antes
+        libre, disputado, espera = leer_lock(puerto_metricas)
+    finally:
+        proceso.terminate()
+        proceso.wait()
+
+    entregas = sum(r.recibidos for r in receptores)
+    libre, disputado, espera = libre - libre_antes, disputado - disputado_antes, espera - espera_antes
+    tiempos.sort()
+    resultado = {
+        "modo": modo, "clientes": clientes, "emisores": args.emisores, "rotadores": args.rotadores,
+        "mensajes": args.mensajes * args.emisores, "entregas": entregas,
+        "entregas_por_segundo": round(entregas / segundos, 1),
+        "handshakes": len(tiempos),
+        "handshake_p50_ms": round(percentil(tiempos, 0.50) * 1000, 2) if tiempos else None,
+        "handshake_p99_ms": round(percentil(tiempos, 0.99) * 1000, 2) if tiempos else None,
+        "lock_adquisiciones": libre + disputado,
+        "lock_disputado": disputado,
+        "lock_espera_ms": round(espera * 1000, 3),
+        "cpu_servidor_segundos": round(cpu, 3),
+        "segundos": round(segundos, 3),
+    }
+    print(f"{modo:8} clientes={clientes:>4} entregas={entregas:>8} ({resultado['entregas_por_segundo']}/s) "
+          f"handshakes={len(tiempos)} p50={resultado['handshake_p50_ms']} ms p99={resultado['handshake_p99_ms']} ms "
+          f"lock={libre + disputado} disputado={disputado} espera={resultado['lock_espera_ms']} ms "
+          f"cpu={resultado['cpu_servidor_segundos']} s")
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Escalado del reparto con la cantidad de clientes y contención del registro")
+    parser.add_argument("--modos", default="hilos,asyncio")
+    parser.add_argument("--clientes", default="10,50,100,200", help="cantidades de clientes conectados")
+    parser.add_argument("--emisores", type=int, default=8)
+    parser.add_argument("--mensajes", type=int, default=200, help="mensajes por emisor")
+    parser.add_argument("--proporcion-privados", type=float, default=0.3)
+    parser.add_argument("--rafaga", type=int, default=10, help="mensajes seguidos de un emisor antes de ceder")
+    parser.add_argument("--rotadores", type=int, default=2, help="bots entrando y saliendo a la vez")
+    parser.add_argument("--espera", type=float, default=120.0, help="segundos máximos para recibir todo")
+    parser.add_argument("--json", help="ruta donde guardar los resultados")
+    args = parser.parse_args()
+
+    subir_limite_archivos()
+    resultados = []
+    for modo in args.modos.split(","):
+        for clientes in map(int, args.clientes.split(",")):
+            resultados.append(asyncio.run(medir(modo, clientes, args)))
+    guardar_json(resultados, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+from comun import lanzar_servidor, guardar_json, subir_limite_archivos
+from bench_carga import percentil
+from acuses import ACEPTADO, ENTREGADO
+from protocolo import (
+    DecodificadorTramas, codificar_trama, empaquetar_campos, desempaquetar_campos,
+    T_ALIAS, T_BIENVENIDA, T_MSG_PRIVADO, T_SALIR, T_ACUSE, T_RECIBO, T_MSG_CON_ID, F_ACUSE
+)
+
+# BENCHMARK DE ACUSES Y RECIBOS DE ENTREGA
+# Parejas de bots: el emisor le manda privados con id a su pareja y el receptor contesta cada uno con
+# T_RECIBO, como el cliente. Cada mensaje se manda --repetir veces con el mismo id (un reintento porque
+# "no llegó el acuse"): el receptor tiene que verlo una sola vez. Se mide, desde el primer envío:
+#   - aceptado:  hasta el T_ACUSE ACEPTADO (el servidor lo repartió y lo encoló para el disco)
+#   - entregado: hasta el T_ACUSE ENTREGADO (el cliente destinatario lo recibió), la latencia de punta a punta
+
+
+class Bot:
+    def __init__(self, alias):
+        self.alias = alias
+        self.envios = {}       # id -> instante del primer envío
+        self.aceptados = {}    # id -> segundos hasta el ACEPTADO
+        self.entregados = {}   # id -> segundos hasta el ENTREGADO
+        self.acuses = 0
+        self.recibidos = Counter()  # id -> veces que llegó (como receptor)
+
+    async def conectar(self, host, puerto):
+        self.reader, self.writer = await asyncio.open_connection(host, puerto)
+        await self.reader.read(1024)  # pedido de alias en texto plano
+        self.writer.write(codificar_trama(T_ALIAS, self.alias, F_ACUSE))
+        self.decodificador = DecodificadorTramas()
+        while True:
+            for trama in self.decodificador.alimentar(await self.reader.read(65536)):
+                if trama.tipo == T_BIENVENIDA:
+                    if not trama.flags & F_ACUSE:
+                        raise RuntimeError("El servidor no maneja ids de mensaje")
+                    return
+
+    async def leer(self):
+        while True:
+            datos = await self.reader.read(1 << 20)
+            if not datos:
+                break
+            ahora = time.perf_counter()
+            for trama in self.decodificador.alimentar(datos):
+                if trama.tipo == T_ACUSE:
+                    id_mensaje, estado, _ = trama.carga.decode("utf-8").split("\x00", 2)
+                    self.acuses += 1
+                    destino = self.aceptados if estado == ACEPTADO else self.entregados if estado == ENTREGADO else None
+                    if destino is not None and id_mensaje not in destino:
+                        destino[id_mensaje] = ahora - self.envios[id_mensaje]
+                elif trama.tipo == T_MSG_CON_ID:
+                    remitente, id_mensaje, _ = desempaquetar_campos(trama.carga, 3)
+                    self.recibidos[id_mensaje] += 1
+                    self.writer.write(codificar_trama(T_RECIBO, empaquetar_campos(remitente, id_mensaje)))
+
+    def enviar(self, destinatario, relleno, repetir):
+        id_mensaje = os.urandom(16).hex()
+        self.envios[id_mensaje] = time.perf_counter()
+        trama = codificar_trama(T_MSG_PRIVADO, empaquetar_campos(id_mensaje, destinatario, relleno), F_ACUSE)
+        self.writer.write(trama * repetir)
+
+    async def salir(self):
+        self.writer.write(codificar_trama(T_SALIR))
+        await self.writer.drain()
+        self.writer.close()
+
+
+async def medir(modo, args):
+    proceso, puerto = lanzar_servidor(modo)
+    emisores = [Bot(f"emisor{i}") for i in range(args.parejas)]
+    receptores = [Bot(f"receptor{i}") for i in range(args.parejas)]
+    bots = emisores + receptores
+    try:
+        await asyncio.gather(*(b.conectar("127.0.0.1", puerto) for b in bots))
+        lectores = [asyncio.create_task(b.leer()) for b in bots]
+        await asyncio.sleep(0.5)
+
+        relleno = "x" * args.tamano
+        intervalo = 1.0 / args.tasa
+        inicio = time.perf_counter()
+        siguiente = inicio
+        while time.perf_counter() - inicio < args.duracion:
+            for emisor, receptor in zip(emisores, receptores):
+                emisor.enviar(receptor.alias, relleno, args.repetir)
+            siguiente += intervalo
+            await asyncio.sleep(max(0.0, siguiente - time.perf_counter()))
+        await asyncio.sleep(args.espera)
+        await asyncio.gather(*(b.salir() for b in bots), return_exceptions=True)
+        for lector in lectores:
+            lector.cancel()
+    finally:
+        proceso.terminate()
+        proceso.wait()
+
+    mensajes = sum(len(e.envios) for e in emisores)
+    recibidos = Counter()
+    for receptor in receptores:
+        recibidos.update(receptor.recibidos)
+    aceptados = sorted(s * 1000 for e in emisores for s in e.aceptados.values())
+    entregados = sorted(s * 1000 for e in emisores for s in e.entregados.values())
+    resultado = {
+        "modo": modo, "parejas": args.parejas, "repetir": args.repetir,
+        "mensajes": mensajes, "tramas_enviadas": mensajes * args.repetir,
+        "recibidos": len(recibidos), "recibidos_repetidos": sum(n - 1 for n in recibidos.values()),
+        "acuses": sum(e.acuses for e in emisores), "aceptados": len(aceptados), "entregados": len(entregados),
+        "aceptado_ms": {"p50": percentil(aceptados, 0.50), "p99": percentil(aceptados, 0.99)},
+        "entregado_ms": {"p50": percentil(entregados, 0.50), "p99": percentil(entregados, 0.99)},
+    }
+    formato = lambda v: "-" if v is None else f"{v:.2f}"
+    print(f"{modo:8} mensajes={mensajes} (x{args.repetir}) recibidos={resultado['recibidos']} "
+          f"repetidos={resultado['recibidos_repetidos']} aceptados={len(aceptados)} entregados={len(entregados)} | "
+          f"aceptado p50={formato(resultado['aceptado_ms']['p50'])} p99={formato(resultado['aceptado_ms']['p99'])} ms "
+          f"entregado p50={formato(resultado['entregado_ms']['p50'])} p99={formato(resultado['entregado_ms']['p99'])} ms")
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Acuses, recibos de entrega y reintentos sin duplicados")
+    parser.add_argument("--parejas", type=int, default=50)
+    parser.add_argument("--tasa", type=float, default=10.0, help="mensajes por segundo de cada emisor")
+    parser.add_argument("--duracion", type=float, default=10.0)
+    parser.add_argument("--espera", type=float, default=2.0, help="segundos para que terminen de llegar")
+    parser.add_argument("--repetir", type=int, default=2, help="veces que se manda cada mensaje con el mismo id")
+    parser.add_argument("--tamano", type=int, default=100)
+    parser.add_argument("--modos", default="hilos,asyncio")
+    parser.add_argument("--json", help="ruta donde guardar los resultados")
+    args = parser.parse_args()
+
+    subir_limite_archivos()
+    resultados = [asyncio.run(medir(modo, args)) for modo in args.modos.split(",")]
+    guardar_json(resultados, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import re
+import time
+import asyncio
+import argparse
+import urllib.request
+
+from comun import lanzar_servidor, guardar_json, subir_limite_archivos, cpu_arbol, puerto_libre
+from bench_carga import MARCA, percentil
+from protocolo import DecodificadorTramas, codificar_trama, T_ALIAS, T_BIENVENIDA, T_MSG_ALL
+
+# BENCHMARK DEL CAMINO DE ESCRITURA
+# Ráfagas de broadcasts a N clientes, con distintas formas de escribir en los sockets:
+#   - por_trama   una escritura por trama (--vector 1), como antes
+#   - vectorial   lo que ya está en la cola sale en una sola escritura vectorial, sin esperar
+#   - coalescer   además el escritor espera hasta --demora-ms a que se junten más tramas
+# Cuenta las llamadas de escritura que hizo el servidor (chat_escrituras_socket_total de /metrics)
+# por broadcast y por entrega, y la latencia de punta a punta que cuesta juntarlas.
+
+CONFIGURACIONES = {
+    "por_trama": ("1", "0"),
+    "vectorial": ("256", "0"),
+    "coalescer": ("256", "1"),
+}
+
+ESCRITURAS = re.compile(r"^chat_escrituras_socket_total (\d+)", re.M)
+
+
+def leer_escrituras(puerto_metricas):
+    with urllib.request.urlopen(f"http://127.0.0.1:{puerto_metricas}/metrics", timeout=5) as respuesta:
+        return int(ESCRITURAS.search(respuesta.read().decode()).group(1))
+
+
+class Receptor:
+    def __init__(self, alias, latencias):
+        self.alias = alias
+        self.latencias = latencias
+        self.recibidos = 0
+
+    async def conectar(self, puerto):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", puerto)
+        await self.reader.read(1024)
+        self.writer.write(codificar_trama(T_ALIAS, self.alias))
+        decodificador = DecodificadorTramas()
+        while not any(t.tipo == T_BIENVENIDA for t in decodificador.alimentar(await self.reader.read(65536))):
+            pass
+
+    async def leer(self, esperados):
+        resto = b""
+        while self.recibidos < esperados:
+            datos = await self.reader.read(1 << 20)
+            if not datos:
+                break
+            ahora = time.time_ns()
+            datos = resto + datos
+            fin = 0
+            for marca in MARCA.finditer(datos):
+                self.latencias.append((ahora - int(marca.group(1))) / 1e6)
+                self.recibidos += 1
+                fin = marca.end()
+            resto = datos[max(fin, len(datos) - 20):]
+
+
+async def medir(modo, configuracion, args):
+    vector, demora = CONFIGURACIONES[configuracion]
+    puerto_metricas = puerto_libre()
+    proceso, puerto = lanzar_servidor(modo, extra_args=(
+        "--metricas", f"127.0.0.1:{puerto_metricas}", "--vector", vector, "--demora-ms", demora))
+    latencias = []
+    try:
+        receptores = [Receptor(f"r{i}", latencias) for i in range(args.clientes)]
+        for receptor in receptores:
+            await receptor.conectar(puerto)
+        emisor = Receptor("emisor", [])
+        await emisor.conectar(puerto)
+        await asyncio.sleep(0.5)
+
+        escrituras_antes = leer_escrituras(puerto_metricas)
+        cpu_antes = cpu_arbol(proceso.pid)
+        lectores = [asyncio.create_task(r.leer(args.mensajes)) for r in receptores]
+        inicio = time.perf_counter()
+        for i in range(args.mensajes):
+            emisor.writer.write(codificar_trama(T_MSG_ALL, f"@{time.time_ns()}@ " + "hola a todos " * 3))
+            if (i + 1) % args.rafaga == 0:
+                await emisor.writer.drain()
+                await asyncio.sleep(args.pausa / 1000)
+        await emisor.writer.drain()
+        await asyncio.wait_for(asyncio.gather(*lectores), args.espera)
+        segundos = time.perf_counter() - inicio
+        cpu = cpu_arbol(proceso.pid) - cpu_antes
+        escrituras = leer_escrituras(puerto_metricas) - escrituras_antes
+    finally:
+        proceso.terminate()
+        proceso.wait()
+
+    latencias.sort()
+    entregas = args.mensajes * args.clientes
+    resultado = {
+        "modo": modo, "configuracion": configuracion, "vector": int(vector), "demora_ms": float(demora),
+        "clientes": args.clientes, "broadcasts": args.mensajes, "entregas": entregas,
+        "escrituras": escrituras,
+        "escrituras_por_broadcast": round(escrituras / args.mensajes, 2),
+        "escrituras_por_entrega": round(escrituras / entregas, 3),
+        "latencia_p50_ms": round(percentil(latencias, 0.50), 2),
+        "latencia_p99_ms": round(percentil(latencias, 0.99), 2),
+        "cpu_servidor_segundos": round(cpu, 3),
+        "segundos": round(segundos, 3),
+    }
+    print(f"{modo:8} {configuracion:10} escrituras={escrituras:>7} "
+          f"({resultado['escrituras_por_broadcast']}/broadcast, {resultado['escrituras_por_entrega']}/entrega) "
+          f"p50={resultado['latencia_p50_ms']} ms p99={resultado['latencia_p99_ms']} ms "
+          f"cpu={resultado['cpu_servidor_segundos']} s")
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Llamadas de escritura por broadcast con y sin escrituras vectoriales")
+    parser.add_argument("--modos", default="hilos,asyncio")
+    parser.add_argument("--configuraciones", default=",".join(CONFIGURACIONES))
+    parser.add_argument("--clientes", type=int, default=100)
+    parser.add_argument("--mensajes", type=int, default=2000, help="broadcasts en total")
+    parser.add_argument("--rafaga", type=int, default=20, help="broadcasts seguidos antes de cada pausa")
+    parser.add_argument("--pausa", type=float, default=10.0, help="milisegundos entre ráfagas")
+    parser.add_argument("--espera", type=float, default=120.0, help="segundos máximos para recibir todo")
+    parser.add_argument("--json", help="ruta donde guardar los resultados")
+    args = parser.parse_args()
+
+    subir_limite_archivos()
+    resultados = []
+    for modo in args.modos.split(","):
+        for configuracion in args.configuraciones.split(","):
+            resultados.append(asyncio.run(medir(modo, configuracion, args)))
+    guardar_json(resultados, args.json)
+
+
+if __name__ == "__main__":
+    main()
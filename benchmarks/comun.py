@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+
+# Utilidades compartidas por los benchmarks: levantar el servidor en un proceso aparte,
+# leer su consumo de memoria/hilos desde /proc y guardar resultados en JSON.
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+# Código que ejecuta el proceso servidor según el modo pedido
+ARRANQUES = {
+    "hilos": "import sys, servicio; servicio.main(['--host', {host!r}, '--puerto', '{puerto}', '--backlog', '{backlog}', "
+             "'--modo', 'hilos', '--metricas', ''] + sys.argv[1:])",
+    "asyncio": "import sys, servicio; servicio.main(['--host', {host!r}, '--puerto', '{puerto}', '--backlog', '{backlog}', "
+               "'--modo', 'asyncio', '--metricas', ''] + sys.argv[1:])",
+    "cluster": "import sys, cluster; sys.argv = ['cluster', '--host', {host!r}, '--puerto', '{puerto}', "
+               "'--backlog', '{backlog}', '--bus', 'bus.sock']; cluster.main()",
+}
+
+
+# Los benchmarks miden el servidor sin los límites por cliente (ver admision.py): todos los bots
+# salen de 127.0.0.1 y mandan mucho más rápido que una persona
+SIN_LIMITES = {
+    "CHAT_MAX_CONEXIONES": "0", "CHAT_MAX_POR_IP": "0", "CHAT_MENSAJES_SEG": "0", "CHAT_MENSAJES_IP": "0",
+    "CHAT_BYTES_SEG": "0", "CHAT_BYTES_IP": "0", "CHAT_COLA_ENTRADA": "0", "CHAT_HANDSHAKE": "0",
+}
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def subir_limite_archivos():
+    # Muchas conexiones simultáneas necesitan muchos descriptores de archivo
+    try:
+        import resource
+        blando, duro = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (duro, duro))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def lanzar_servidor(modo, host="127.0.0.1", puerto=None, backlog=1024, extra_args=()):
+    # Arranca el servidor en un directorio temporal (para no tocar historial.db ni los *_chat.json del repo)
+    puerto = puerto or puerto_libre()
+    codigo = "import resource; b, d = resource.getrlimit(resource.RLIMIT_NOFILE); resource.setrlimit(resource.RLIMIT_NOFILE, (d, d)); "
+    codigo += ARRANQUES[modo].format(host=host, puerto=puerto, backlog=backlog)
+    directorio = tempfile.mkdtemp(prefix="bench_chat_")
+    entorno = dict(os.environ, PYTHONPATH=RAIZ, **SIN_LIMITES)
+    proceso = subprocess.Popen(
+        [sys.executable, "-c", codigo, *extra_args],
+        cwd=directorio, env=entorno,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    esperar_puerto(host, puerto)
+    return proceso, puerto
+
+
+def esperar_puerto(host, puerto, limite=15.0):
+    fin = time.time() + limite
+    while time.time() < fin:
+        try:
+            with socket.create_connection((host, puerto), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"El servidor no abrió el puerto {puerto}")
+
+
+def estado_proceso(pid):
+    # Memoria residente y virtual (KB) e hilos de un proceso, leídos de /proc (solo Linux).
+    # Las pilas de los hilos reservan memoria virtual aunque casi no aparezcan en el RSS.
+    datos = {"rss_kb": None, "vm_kb": None, "hilos": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    datos["rss_kb"] = int(linea.split()[1])
+                elif linea.startswith("VmSize:"):
+                    datos["vm_kb"] = int(linea.split()[1])
+                elif linea.startswith("Threads:"):
+                    datos["hilos"] = int(linea.split()[1])
+    except OSError:
+        pass
+    return datos
+
+
+def hijos(pid):
+    # Todos los procesos descendientes (los trabajadores de cluster.py)
+    encontrados = []
+    try:
+        for tarea in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tarea}/children") as f:
+                for hijo in f.read().split():
+                    encontrados.append(int(hijo))
+                    encontrados.extend(hijos(int(hijo)))
+    except OSError:
+        pass
+    return encontrados
+
+
+def estado_arbol(pid):
+    # Como estado_proceso, pero sumando el proceso y todos sus hijos
+    total = {"rss_kb": 0, "vm_kb": 0, "hilos": 0, "procesos": 0}
+    for actual in [pid] + hijos(pid):
+        datos = estado_proceso(actual)
+        if datos["rss_kb"] is None:
+            continue
+        total["procesos"] += 1
+        for clave in ("rss_kb", "vm_kb", "hilos"):
+            total[clave] += datos[clave]
+    return total
+
+
+def guardar_json(resultados, ruta):
+    if not ruta:
+        return
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump(resultados, f, indent=4, ensure_ascii=False)
+    print(f"Resultados guardados en {ruta}")
+
+
+def cpu_proceso(pid):
+    # Segundos de CPU (usuario + sistema) consumidos por un proceso, de /proc/pid/stat
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            campos = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return 0.0
+    return (int(campos[11]) + int(campos[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def cpu_arbol(pid):
+    # Como cpu_proceso, sumando los hijos vivos (trabajadores de cluster.py)
+    return sum(cpu_proceso(actual) for actual in [pid] + hijos(pid))
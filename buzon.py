@@ -0,0 +1,253 @@
+import time
+import logging
+import threading
+from queue import Queue, Empty
+
+import metricas
+from bd import RUTA_BD, abrir, ahora
+
+# BUZÓN PARA USUARIOS DESCONECTADOS (STORE-AND-FORWARD)
+# Un privado o un archivo para alguien que no está conectado ya no se pierde: queda en la tabla `buzon`
+# de historial.db (tipo de trama y carga, tal como se le habría entregado) y se le manda cuando vuelve a
+# completar el handshake. Los archivos se guardan como referencia (T_ARCHIVO_REF) al objeto del almacén.
+# Límites por destinatario: MAXIMO_MENSAJES y MAXIMO_BYTES (al pasarse se tiran los más viejos) y
+# VIDA segundos por mensaje. Solo se guarda para alias que alguna vez se conectaron.
+# Orden: al registrarse, el alias se marca como "vaciando" antes de entrar a `clientes`; mientras tanto
+# todo lo nuevo para él también va al buzón, detrás de lo viejo. El vaciado lee de a LOTE filas por
+# orden de llegada, las encola en la salida del cliente (fuera del lock global) y recién cuando el
+# buzón queda vacío se desmarca el alias, con el lock del buzón tomado: nada queda atrás ni se adelanta.
+# Quien reparte no espera al disco: con el lock solo se decide (entregar ya o guardar) y lo que hay que
+# guardar pasa a un hilo escritor propio, que lo inserta en lotes y en el mismo orden. Cada guardado
+# lleva un número; el vaciado espera a que el escritor llegue al último de su alias antes de dar el
+# buzón por vacío. El lock nunca se tiene durante una consulta o una escritura en la BD.
+
+MAXIMO_MENSAJES = 500          # menos que la cola de salida de un cliente
+MAXIMO_BYTES = 4 * 1024 * 1024
+VIDA = 3 * 24 * 3600           # menos que el ttl del almacén, así las referencias siguen valiendo
+LOTE = 100
+PURGA_CADA = 200               # cada cuántos mensajes guardados se borran los vencidos
+
+# Resultado de guardar_o_devolver: entregar ya, guardado, o rechazado (con el motivo para el remitente)
+ENTREGAR = "entregar"
+GUARDADO = "guardado"
+DESCONOCIDO = "alias desconocido"
+DEMASIADO_GRANDE = "demasiado grande"
+RECHAZOS = (DESCONOCIDO, DEMASIADO_GRANDE)
+
+log = logging.getLogger("chat.buzon")
+
+SQL_GUARDAR = "INSERT INTO buzon(destinatario, tipo, carga, tamano, fecha, vence) VALUES (?, ?, ?, ?, ?, ?)"
+SQL_OCUPADO = "SELECT COUNT(*), COALESCE(SUM(tamano), 0) FROM buzon WHERE destinatario = ?"
+SQL_MAS_VIEJO = "SELECT id, tamano FROM buzon WHERE destinatario = ? ORDER BY id LIMIT 1"
+SQL_LOTE = "SELECT id, tipo, carga FROM buzon WHERE destinatario = ? AND id > ? AND vence > ? ORDER BY id LIMIT ?"
+SQL_BORRAR_HASTA = "DELETE FROM buzon WHERE destinatario = ? AND id <= ?"
+SQL_PURGAR = "DELETE FROM buzon WHERE vence <= ?"
+SQL_CONOCIDO = "SELECT 1 FROM historial_conexiones WHERE alias = ? LIMIT 1"
+SQL_CONOCIDOS = "SELECT DISTINCT alias FROM historial_conexiones"
+
+_FIN = object()
+
+
+class Buzon:
+    def __init__(self, ruta=RUTA_BD, maximo_mensajes=MAXIMO_MENSAJES, maximo_bytes=MAXIMO_BYTES, vida=VIDA):
+        self.ruta = ruta
+        self.maximo_mensajes = maximo_mensajes
+        self.maximo_bytes = maximo_bytes
+        self.vida = vida
+        # `lock` solo cubre las decisiones (conectado o no, vaciando, qué falta escribir); nunca la BD
+        self.lock = threading.Lock()
+        self._escrito = threading.Condition(self.lock)
+        self._lock_bd = threading.Lock()  # la conexión de lectura (vaciado, conocidos, pendientes)
+        self._conn = abrir(ruta)
+        self._vaciando = set()
+        self._conocidos = {fila[0] for fila in self._conn.execute(SQL_CONOCIDOS)}
+        self._numero = 0            # último guardado entregado al escritor
+        self._escritos = 0          # último guardado que el escritor ya confirmó
+        self._ultimo_de = {}        # alias -> número de su último guardado
+        self._cola = Queue()
+        self._desde_purga = 0
+        self.guardados = 0
+        self.entregados = 0
+        self.descartados = 0
+        self.rechazados = 0
+        self.purgar()
+        self._hilo = threading.Thread(target=self._escribir, name="buzon", daemon=True)
+        self._hilo.start()
+
+    def marcar(self, alias):
+        # Justo antes de agregar el alias a `clientes` (o de reanudar su sesión): lo que llegue desde ahora
+        # va detrás de lo que ya tiene en el buzón
+        with self.lock:
+            self._vaciando.add(alias)
+            self._conocidos.add(alias)
+
+    def guardar_o_devolver(self, destinatario, tipo, carga, buscar):
+        # Decide con el lock del buzón tomado y devuelve (resultado, info):
+        #   - (ENTREGAR, info) si `buscar(destinatario)` da un cliente conectado que no está vaciando su
+        #     buzón: quien llama se lo encola en el momento
+        #   - (GUARDADO, None) si queda para el escritor
+        #   - (DESCONOCIDO o DEMASIADO_GRANDE, None) si no se puede guardar: el mensaje se pierde y el
+        #     remitente tiene que saberlo
+        # Un alias que nunca se conectó se busca en la BD fuera del lock.
+        conocido = destinatario in self._conocidos or self._conocido(destinatario)
+        with self.lock:
+            info = buscar(destinatario)
+            if info is not None and destinatario not in self._vaciando:
+                return ENTREGAR, info
+            rechazo = DESCONOCIDO if not conocido else DEMASIADO_GRANDE if len(carga) > self.maximo_bytes else None
+            if rechazo:
+                self.rechazados += 1
+                metricas.buzon.sumar(1, "rechazado")
+                return rechazo, None
+            self._encolar(destinatario, tipo, carga)
+            return GUARDADO, None
+
+    def guardar(self, destinatario, tipo, carga):
+        # Sin decidir: para lo que ya se intentó entregar y no entró (la cola del cliente se cerró).
+        # Devuelve False si no se pudo guardar (demasiado grande)
+        with self.lock:
+            if len(carga) > self.maximo_bytes:
+                self.rechazados += 1
+                metricas.buzon.sumar(1, "rechazado")
+                return False
+            self._encolar(destinatario, tipo, carga)
+            return True
+
+    def _encolar(self, destinatario, tipo, carga):
+        # Con el lock tomado: el número fija el orden entre lo que se guarda y lo que se vacía
+        self._numero += 1
+        self._ultimo_de[destinatario] = self._numero
+        self._cola.put((self._numero, destinatario, tipo, carga, ahora(), time.time() + self.vida))
+
+    def _conocido(self, alias):
+        with self._lock_bd:
+            conocido = self._conn.execute(SQL_CONOCIDO, (alias,)).fetchone() is not None
+        if conocido:
+            with self.lock:
+                self._conocidos.add(alias)
+        return conocido
+
+    def _escribir(self):
+        # Hilo escritor: todo lo que haya en la cola va en una sola transacción, en orden de llegada
+        conn = abrir(self.ruta)
+        terminar = False
+        while not terminar:
+            lote = [self._cola.get()]
+            while len(lote) < LOTE:
+                try:
+                    lote.append(self._cola.get_nowait())
+                except Empty:
+                    break
+            if lote[-1] is _FIN:
+                lote.pop()
+                terminar = True
+            if not lote:
+                break
+            try:
+                self._guardar_lote(conn, lote)
+            except Exception as e:
+                log.error("Error al guardar %d mensajes en el buzón: %s", len(lote), e)
+            with self.lock:
+                self._escritos = lote[-1][0]
+                self._escrito.notify_all()
+        conn.close()
+
+    def _guardar_lote(self, conn, lote):
+        descartados = 0
+        with metricas.escritura.medir("buzon"), conn:
+            for _, destinatario, tipo, carga, fecha, vence in lote:
+                conn.execute(SQL_GUARDAR, (destinatario, tipo, carga, len(carga), fecha, vence))
+                cantidad, tamano = conn.execute(SQL_OCUPADO, (destinatario,)).fetchone()
+                # Sobre el límite se tiran los más viejos
+                while cantidad > self.maximo_mensajes or tamano > self.maximo_bytes:
+                    id_viejo, tamano_viejo = conn.execute(SQL_MAS_VIEJO, (destinatario,)).fetchone()
+                    conn.execute(SQL_BORRAR_HASTA, (destinatario, id_viejo))
+                    cantidad, tamano = cantidad - 1, tamano - tamano_viejo
+                    descartados += 1
+        self.guardados += len(lote)
+        self.descartados += descartados
+        metricas.buzon.sumar(len(lote), "guardado")
+        if descartados:
+            metricas.buzon.sumar(descartados, "descartado")
+        self._desde_purga += len(lote)
+        if self._desde_purga >= PURGA_CADA:
+            self._purgar(conn)
+
+    def _esperar_escritor(self, alias):
+        # Con el lock tomado: espera a que esté en la BD todo lo guardado para `alias` hasta ahora
+        numero = self._ultimo_de.get(alias, 0)
+        self._escrito.wait_for(lambda: self._escritos >= numero)
+        return numero
+
+    def vaciar(self, alias, entregar, esperar_lugar=None):
+        # Entrega todo lo pendiente de `alias` en orden, de a LOTE. `entregar(tipo, carga)` devuelve False si
+        # la conexión ya se cerró: ahí se corta y lo que falta queda para la próxima vez.
+        # `esperar_lugar(cantidad)` frena hasta que la cola de salida tenga lugar para un lote.
+        ultimo = 0
+        total = 0
+        while True:
+            with self.lock:
+                numero = self._esperar_escritor(alias)
+            with self._lock_bd:
+                filas = self._conn.execute(SQL_LOTE, (alias, ultimo, time.time(), LOTE)).fetchall()
+            if not filas:
+                with self.lock:
+                    # Vacío de verdad solo si no se guardó nada nuevo mientras se leía
+                    if self._ultimo_de.get(alias, 0) != numero:
+                        continue
+                    self._vaciando.discard(alias)
+                    self._ultimo_de.pop(alias, None)
+                break
+            if esperar_lugar is not None:
+                esperar_lugar(len(filas))
+            entregadas = 0
+            for id_mensaje, tipo, carga in filas:
+                if not entregar(tipo, carga):
+                    break
+                ultimo = id_mensaje
+                entregadas += 1
+            if ultimo:
+                with self._lock_bd, self._conn:
+                    self._conn.execute(SQL_BORRAR_HASTA, (alias, ultimo))
+            self.entregados += entregadas
+            total += entregadas
+            metricas.buzon.sumar(entregadas, "entregado")
+            if entregadas < len(filas):
+                with self.lock:
+                    self._vaciando.discard(alias)
+                break
+        if total:
+            log.info("%s recibió %d mensajes de su buzón", alias, total)
+        return total
+
+    def purgar(self):
+        with self._lock_bd:
+            self._purgar(self._conn)
+
+    def _purgar(self, conn):
+        self._desde_purga = 0
+        with conn:
+            vencidos = conn.execute(SQL_PURGAR, (time.time(),)).rowcount
+        if vencidos:
+            metricas.buzon.sumar(vencidos, "vencido")
+            log.info("Buzón: %d mensajes vencidos borrados", vencidos)
+
+    def pendientes(self):
+        with self._lock_bd:
+            return self._conn.execute("SELECT COUNT(*) FROM buzon").fetchone()[0]
+
+    def estadisticas(self):
+        return {
+            "pendientes": self.pendientes(),
+            "guardados": self.guardados,
+            "entregados": self.entregados,
+            "descartados": self.descartados,
+            "rechazados": self.rechazados,
+        }
+
+    def cerrar(self, timeout=10.0):
+        # Escribe lo que quede en la cola antes de cerrar
+        self._cola.put(_FIN)
+        self._hilo.join(timeout)
+        with self._lock_bd:
+            self._conn.close()
@@ -1,8 +1,23 @@
+import time
 import socket
 import threading # para recibir mensajes sin congelar la interfaz
-import base64 # # para convertir archivos binarios en texto seguro para enviar
 import os # para manejar rutas y archivos
+from collections import deque
 import tkinter as tk
+from protocolo import (
+    Conexion, ErrorProtocolo, empaquetar_campos, desempaquetar_campos,
+    T_ALIAS, T_BIENVENIDA, T_ALIAS_OCUPADO, T_MSG_ALL, T_MSG_PRIVADO,
+    T_ARCHIVO, T_ARCHIVO_REF, T_LISTA_USUARIOS, T_SALIR, T_PRESENCIA_FOTO, T_PRESENCIA_CAMBIOS,
+    T_HISTORIAL_PEDIR, T_HISTORIAL_PAGINA, T_REANUDAR, T_SALA, T_LIMITE, T_ACUSE, T_RECIBO, T_MSG_CON_ID,
+    F_ACUSE, SEPARADOR
+)
+from transferencias import GestorTransferencias
+import compresion
+from presencia import VistaPresencia
+from sesiones import SesionCliente, esperas_reconexion
+from salas import CREAR, UNIR, SALIR, UNIDO, SALIDO, ERROR, ENTRO
+from admision import RECHAZO
+from acuses import PendientesCliente, ACEPTADO, ENTREGADO, RECHAZADO, EN_BUZON
 from tkinter import filedialog, scrolledtext, messagebox, simpledialog 
 # filedialog: para elegir archivos
 # scrolledtext: cuadro de texto con scroll
@@ -24,57 +39,166 @@ COLORES = {
 }
 
 # Envío / recepción de archivos
-def enviar_archivo(cliente, destinatario, ruta_archivo, callback):
+# El archivo se sube por bloques desde un hilo aparte (no congela la interfaz ni se carga entero en memoria).
+# Si la conexión se corta, el emisor queda en transferencias.envios y al reconectar se sigue con el mismo id
+# desde lo que el servidor ya confirmó (ver ClienteGUI._retomar_transferencias).
+def enviar_archivo(conexion, transferencias, destinatario, ruta_archivo, callback):
     if not os.path.exists(ruta_archivo):
         messagebox.showerror("Error", "Archivo no encontrado.")
         return
 
     nombre_archivo = os.path.basename(ruta_archivo)
-    with open(ruta_archivo, "rb") as f:
-        contenido_b64 = base64.b64encode(f.read()).decode("utf-8")
 
-    mensaje = f"FILE:{destinatario}:{nombre_archivo}:{contenido_b64}"
-    cliente.send(mensaje.encode("utf-8"))
-    callback(f"📤 Archivo '{nombre_archivo}' enviado a {destinatario}.")
+    def subir():
+        try:
+            # Calcular el SHA-256 lee el archivo entero: también se hace fuera del hilo de la interfaz
+            emisor = transferencias.nuevo_envio(destinatario, ruta_archivo)
+        except OSError as e:
+            callback(f"⚠ No se pudo enviar '{nombre_archivo}': {e}")
+            return
+        subir_archivo(conexion, transferencias, emisor, callback)
+
+    callback(f"⏳ Enviando '{nombre_archivo}' a {destinatario}...")
+    threading.Thread(target=subir, daemon=True).start()
+
+def subir_archivo(conexion, transferencias, emisor, callback):
+    # Corre en un hilo aparte. Si se corta la conexión el emisor sigue en transferencias.envios (un error
+    # del servidor lo saca de ahí) y se vuelve a llamar con la conexión nueva.
+    try:
+        emisor.enviar(conexion)
+        callback(f"📤 Archivo '{emisor.nombre}' enviado a {emisor.destinatario}.")
+    except Exception as e:
+        if emisor.cortado or isinstance(e, OSError):
+            callback(f"⏸ '{emisor.nombre}' quedó a medias: sigue cuando vuelva la conexión.")
+        else:
+            transferencias.envios.pop(emisor.id, None)
+            callback(f"⚠ No se pudo enviar '{emisor.nombre}': {e}")
+
+# Archivos compartidos con "Todos": el servidor solo avisa (nombre, tamaño, sha256) y se bajan cuando
+# el usuario los pide, por una conexión aparte para no trabar el chat mientras se descargan.
+def descargar_compartido(transferencias, direccion, referencia, callback):
+    def bajar():
+        try:
+            ruta = transferencias.descargar(direccion, referencia)
+            callback(f"📁 Archivo de {referencia.remitente} descargado: {referencia.nombre}\nGuardado en: {ruta}")
+        except Exception as e:
+            callback(f"⚠ No se pudo descargar '{referencia.nombre}': {e}")
+
+    callback(f"⏳ Descargando '{referencia.nombre}'...")
+    threading.Thread(target=bajar, daemon=True).start()
+
+# Historial: el servidor lo devuelve por páginas, de a `limite` mensajes hacia atrás desde `antes`
+# (el id del mensaje más viejo que ya tenemos; vacío = los más recientes). Ver historial.ConsultasHistorial.
+def pedir_historial(conexion, antes="", limite=50, conversacion="", busqueda=""):
+    conexion.enviar(T_HISTORIAL_PEDIR, empaquetar_campos(conversacion, str(antes), str(limite), busqueda))
+
+def leer_pagina_historial(carga):
+    # Devuelve (entradas, siguiente, conversacion): entradas (id, fecha, remitente, destinatario, mensaje) de la
+    # más vieja a la más nueva, el cursor para la página anterior o None si no hay más, y de qué conversación es
+    conversacion, siguiente, *entradas = carga.decode("utf-8").split(SEPARADOR.decode())
+    return [tuple(e.split("|", 4)) for e in entradas if e], siguiente or None, conversacion
+
+# Salas: "#nombre". Se crean, se entra y se sale con T_SALA; los mensajes y archivos a una sala van
+# como los privados, con la sala de destinatario. El servidor contesta y avisa quién entra y sale.
+def pedir_sala(conexion, accion, sala):
+    conexion.enviar(T_SALA, empaquetar_campos(accion, sala))
 
 # objetivo: escuchar todo lo que viene del servidor y procesarlo
-def recibir_mensajes(cliente, callback_mensaje, callback_usuarios):
+# Cada llamada a conexion.recibir() devuelve una trama completa, aunque TCP la haya partido o juntado con otras
+# La lista de usuarios llega una vez completa (foto) y después solo con los cambios: quién entró y quién salió
+# Con `sesion` se cuentan los mensajes recibidos, para pedir al reconectar solo los que faltan
+# Los privados con id se contestan con un recibo apenas llegan; los acuses de lo propio van a callback_acuse
+def recibir_mensajes(conexion, transferencias, callback_mensaje, callback_usuarios, callback_compartido=None,
+                     callback_presencia=None, callback_historial=None, callback_sala=None, sesion=None,
+                     callback_acuse=None):
+    vista = VistaPresencia()
     while True:
         try:
-            mensaje = cliente.recv(10_000_000).decode("utf-8")
-            if not mensaje:
+            trama = conexion.recibir()
+            if trama is None:
                 break
-            texto = mensaje.strip()
+            if sesion is not None:
+                sesion.contar(trama)
+
+            if trama.tipo == T_PRESENCIA_FOTO:
+                usuarios = vista.foto(trama.carga)
+                callback_usuarios([f"{codigo}|{alias}" for alias, codigo in usuarios.items()])
+                continue
 
-            # Recibe la lista de usuarios conectados, la limpia y la envía a la interfaz
-            if "|" in texto and ("," in texto or ";" in texto):
-                lista_raw = texto.replace(";", ",")
+            if trama.tipo == T_PRESENCIA_CAMBIOS:
+                try:
+                    cambios = vista.cambios(trama.carga)
+                except ErrorProtocolo:
+                    # Se perdió algún cambio: se pide la foto completa otra vez
+                    conexion.enviar(T_PRESENCIA_FOTO)
+                    continue
+                if cambios and callback_presencia:
+                    callback_presencia(cambios)
+                continue
+
+            # Servidores viejos: la lista completa en cada cambio
+            if trama.tipo == T_LISTA_USUARIOS:
+                lista_raw = trama.carga.decode("utf-8")
                 usuarios = [u for u in (item.strip() for item in lista_raw.split(",")) if u]
                 callback_usuarios(usuarios)
                 continue
 
-            # Detecta archivos, los reconstruye desde base64 y los guarda en /recibidos
-            if texto.startswith("FILE:"):
-                partes = texto.split(":", 3)
-                if len(partes) == 4:
-                    remitente, nombre_archivo, contenido_b64 = partes[1], partes[2], partes[3]
-                    os.makedirs("recibidos", exist_ok=True) # Crea la carpeta donde se guardarán los archivos recibidos
-                    ruta = os.path.join("recibidos", nombre_archivo) #Une la carpeta recibidos con el nombre del archivo para generar la ruta  donde se va a guarda
-                    with open(ruta, "wb") as f:
-                        f.write(base64.b64decode(contenido_b64))# Convierte de Base64 a binario y lo guarda
-                    callback_mensaje(f"📁 Archivo recibido de {remitente}: {nombre_archivo}\nGuardado en: {ruta}")
-                else:
-                    callback_mensaje("⚠ Mensaje de archivo mal formado.")
+            if trama.tipo == T_HISTORIAL_PAGINA:
+                if callback_historial:
+                    callback_historial(*leer_pagina_historial(trama.carga))
                 continue
 
-            # Si el mensaje es de bienvenida, lo muestro aparte
+            if trama.tipo == T_SALA:
+                if callback_sala:
+                    callback_sala(*trama.carga.decode("utf-8").split(SEPARADOR.decode()))
+                continue
 
-            if texto.startswith("Bienvenido"):
-                callback_mensaje(texto)
+            # El servidor descartó un mensaje o nos lee más despacio por pasarnos de los límites (ver admision.py)
+            if trama.tipo == T_LIMITE:
+                motivo, segundos, texto = trama.carga.decode("utf-8").split(SEPARADOR.decode(), 2)
+                callback_mensaje(f"⚠ {texto}")
                 continue
 
-            # Si no, lo trato como mensaje normal y lo muestro igual
-            callback_mensaje(texto)
+            # Acuse de un mensaje propio (ver acuses.py): aceptado, rechazado o entregado al destinatario
+            if trama.tipo == T_ACUSE:
+                if callback_acuse:
+                    callback_acuse(*trama.carga.decode("utf-8").split(SEPARADOR.decode(), 2))
+                continue
+
+            # Privado que espera recibo: se confirma y se muestra como cualquier otro
+            if trama.tipo == T_MSG_CON_ID:
+                remitente, id_mensaje, texto = desempaquetar_campos(trama.carga, 3)
+                conexion.enviar(T_RECIBO, empaquetar_campos(remitente, id_mensaje))
+                callback_mensaje(texto.decode("utf-8").strip())
+                continue
+
+            # Aviso de un archivo compartido: todavía no se descarga nada
+            if trama.tipo == T_ARCHIVO_REF:
+                referencia = transferencias.referencia(trama)
+                if callback_compartido:
+                    callback_compartido(referencia)
+                continue
+
+            # Bloques de archivos (subidas propias y descargas): se escriben directo a disco en /recibidos
+            if transferencias.procesar(trama, callback_mensaje):
+                continue
+
+            # Archivos que llegan enteros en una sola trama
+            if trama.tipo == T_ARCHIVO:
+                try:
+                    remitente, nombre_archivo, contenido = desempaquetar_campos(trama.carga, 3)
+                except ErrorProtocolo:
+                    callback_mensaje("⚠ Mensaje de archivo mal formado.")
+                    continue
+                os.makedirs("recibidos", exist_ok=True) # Crea la carpeta donde se guardarán los archivos recibidos
+                ruta = os.path.join("recibidos", os.path.basename(nombre_archivo)) #Une la carpeta recibidos con el nombre del archivo para generar la ruta  donde se va a guarda
+                with open(ruta, "wb") as f:
+                    f.write(contenido)
+                callback_mensaje(f"📁 Archivo recibido de {remitente}: {nombre_archivo}\nGuardado en: {ruta}")
+                continue
+
+            # Cualquier otro texto (mensajes públicos, privados, avisos) se muestra igual
+            callback_mensaje(trama.carga.decode("utf-8").strip())
 
         except Exception as e:
             callback_mensaje(f"⚠ Error al recibir mensaje: {e}")
@@ -83,6 +207,16 @@ def recibir_mensajes(cliente, callback_mensaje, callback_usuarios):
 # GUI Cliente
 
 class ClienteGUI:
+    # Pantalla de mensajes acotada: a lo sumo MAX_LINEAS en el widget. Las que se desalojan por arriba
+    # quedan en memoria (hasta MAX_MEMORIA) y vuelven de a PAGINA_LINEAS al subir con el scroll;
+    # recién cuando se acaban se pide historial al servidor.
+    INTERVALO_RENDER_MS = 50
+    MAX_TANDA = 500
+    MAX_LINEAS = 2000
+    MAX_MEMORIA = 20000
+    PAGINA_LINEAS = 200
+    INTERVALO_REINTENTOS_MS = 1000
+
     def __init__(self, master):
         self.master = master
         self.master.title("💬 Chat Cliente")
@@ -92,12 +226,20 @@ class ClienteGUI:
         #Conexión al servidor 
         #penas crea el socket, no se conecta todavía.
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.direccion = ("127.0.0.1", 5010)
         try:
-            self.sock.connect(("127.0.0.1", 5010))#Intentar conectar al servidor
+            self.sock.connect(self.direccion)#Intentar conectar al servidor
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo conectar con el servidor: {e}")
             master.destroy()
             return      
+        self.conexion = Conexion(self.sock)
+        self.transferencias = GestorTransferencias("recibidos")
+        self.sesion = None
+        self.cerrando = False
+        # Mensajes con id sin acuse del servidor (solo si el servidor los entiende, ver acuses.py)
+        self.acuses = False
+        self.sin_acuse = PendientesCliente()
         try:
             # Llama al handshake para registrarse y obtener un alias autorizado por el servidor
             self.alias = self._realizar_handshake() 
@@ -125,6 +267,16 @@ class ClienteGUI:
         )
     
         self.text_area.pack(fill=tk.BOTH, expand=True)
+        # Historial: se pide una página al entrar y otra cada vez que el usuario llega arriba de todo
+        # Pantalla acotada (ver "Visualización"): lo que llega de otros hilos espera en `pendientes`
+        self.pendientes = deque()
+        self.lineas_viejas = deque(maxlen=self.MAX_MEMORIA)
+        self.master.after(self.INTERVALO_RENDER_MS, self._dibujar_pendientes)
+        self.cursor_historial = None
+        self.pidiendo_historial = True
+        self.historial_cargado = False
+        self.text_area.tag_config("historial", foreground=COLORES["texto_resaltado"])
+        self.text_area.config(yscrollcommand=self._al_desplazar)
 
         frame_input = tk.Frame(left_frame, bg=COLORES["fondo"])
         frame_input.pack(fill=tk.X, pady=5)
@@ -137,6 +289,8 @@ class ClienteGUI:
                   command=self.enviar_a_todos).pack(side=tk.LEFT, padx=5)
         tk.Button(frame_input, text="Enviar Privado", bg=COLORES["boton_secundario"], fg="white",
                   command=self.enviar_privado).pack(side=tk.LEFT, padx=5)
+        tk.Button(frame_input, text="Enviar a Sala", bg=COLORES["boton_secundario"], fg="white",
+                  command=self.enviar_a_sala).pack(side=tk.LEFT, padx=5)
         tk.Button(frame_input, text="📎 Adjuntar", bg=COLORES["boton_verde"], fg="white",
                   command=self.adjuntar_archivo).pack(side=tk.LEFT, padx=5)
         tk.Button(frame_input, text="Desconectar", bg=COLORES["boton_rojo"], fg="white",
@@ -154,49 +308,164 @@ class ClienteGUI:
         self.listbox_usuarios = tk.Listbox(right_frame, bg=COLORES["fondo"], fg=COLORES["texto"])
         self.listbox_usuarios.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
 
+        # Salas en las que está el usuario, con cuántos miembros tiene cada una
+        tk.Label(right_frame, text="Salas", bg=COLORES["panel_derecho"],
+                 fg=COLORES["texto_resaltado"], font=("Arial", 10, "bold")).pack(pady=5)
+        self.salas = {}        # sala -> set de miembros (la presencia de cada sala)
+        self.filas_salas = []  # sala de cada fila de listbox_salas
+        self.listbox_salas = tk.Listbox(right_frame, height=5, bg=COLORES["fondo"], fg=COLORES["texto"],
+                                        exportselection=False)
+        self.listbox_salas.pack(fill=tk.BOTH, padx=10, pady=5)
+        frame_salas = tk.Frame(right_frame, bg=COLORES["panel_derecho"])
+        frame_salas.pack(fill=tk.X, padx=10)
+        tk.Button(frame_salas, text="Crear", bg=COLORES["boton_verde"], fg="white",
+                  command=lambda: self.accion_sala(CREAR)).pack(side=tk.LEFT, expand=True, fill=tk.X)
+        tk.Button(frame_salas, text="Unirse", bg=COLORES["boton_principal"], fg="white",
+                  command=lambda: self.accion_sala(UNIR)).pack(side=tk.LEFT, expand=True, fill=tk.X)
+        tk.Button(frame_salas, text="Salir", bg=COLORES["boton_rojo"], fg="white",
+                  command=self.salir_de_sala).pack(side=tk.LEFT, expand=True, fill=tk.X)
+
+        # Archivos compartidos con todos: doble clic para descargarlos
+        tk.Label(right_frame, text="Archivos compartidos", bg=COLORES["panel_derecho"],
+                 fg=COLORES["texto_resaltado"], font=("Arial", 10, "bold")).pack(pady=5)
+
+        self.compartidos = []
+        self.listbox_archivos = tk.Listbox(right_frame, height=6, bg=COLORES["fondo"], fg=COLORES["texto"])
+        self.listbox_archivos.pack(fill=tk.BOTH, padx=10, pady=5)
+        self.listbox_archivos.bind("<Double-Button-1>", self.descargar_seleccionado)
+
         # Hilo para recibir mensajes 
-        threading.Thread(target=recibir_mensajes, args=(self.sock, self.mostrar_mensaje, self.actualizar_usuarios), daemon=True).start()
+        self.filas_usuarios = []  # alias de cada fila de listbox_usuarios, en el mismo orden
+        # Todo lo que llega desde el hilo receptor se aplica en el hilo de Tk (ver en_tk)
+        self.callbacks = [self.en_tk(f) for f in (self.actualizar_usuarios, self.agregar_compartido,
+                                                  self.aplicar_cambios_usuarios, self.mostrar_historial,
+                                                  self.evento_sala)]
+        threading.Thread(target=self._recibir, daemon=True).start()
+        self.master.after(self.INTERVALO_REINTENTOS_MS, self._reintentar)
+        pedir_historial(self.conexion)
+    # Recepción con reconexión: si la conexión se corta sin que el usuario se haya desconectado,
+    # se reanuda la sesión y el servidor reenvía lo que llegó mientras tanto
+    def _recibir(self):
+        while True:
+            recibir_mensajes(self.conexion, self.transferencias, self.mostrar_mensaje, *self.callbacks,
+                             sesion=self.sesion, callback_acuse=self.acuse_recibido)
+            if self.cerrando:
+                return
+            # Subidas y descargas a medias: se frenan y siguen por la conexión nueva
+            descargas = self.transferencias.cortar()
+            if self.sesion is None or not self._reconectar():
+                self.mostrar_mensaje("⚠ Se perdió la conexión con el servidor.")
+                return
+            self._retomar_transferencias(descargas)
+
+    def _retomar_transferencias(self, descargas):
+        # Cada subida sigue desde el offset que confirme el servidor; lo que el servidor nos estaba mandando
+        # se pide al almacén desde lo que ya está en disco, por una conexión aparte
+        for emisor in list(self.transferencias.envios.values()):
+            self.mostrar_mensaje(f"⏳ Retomando el envío de '{emisor.nombre}'...")
+            threading.Thread(target=subir_archivo, args=(self.conexion, self.transferencias, emisor, self.mostrar_mensaje),
+                             daemon=True).start()
+        for referencia in descargas:
+            descargar_compartido(self.transferencias, self.direccion, referencia, self.mostrar_mensaje)
+
+    def _reconectar(self):
+        # Corre en el hilo receptor. Espera exponencial con variación al azar entre intentos.
+        self.mostrar_mensaje("⚠ Se perdió la conexión. Reconectando...")
+        for espera in esperas_reconexion():
+            time.sleep(espera)
+            if self.cerrando:
+                return False
+            try:
+                sock = socket.create_connection(self.direccion, timeout=10)
+            except OSError:
+                continue
+            try:
+                conexion = Conexion(sock)
+                if sock.recv(4096).startswith(RECHAZO.encode("utf-8")):
+                    # Servidor lleno: se reintenta en la próxima espera
+                    sock.close()
+                    continue
+                conexion.enviar(T_REANUDAR, self.sesion.reanudacion(), compresion.ACEPTADOS | F_ACUSE)
+                respuesta = conexion.recibir()
+                nueva = respuesta is not None and respuesta.tipo == T_ALIAS
+                if nueva:
+                    # La sesión ya venció: se vuelve a entrar con el mismo alias, como la primera vez
+                    conexion.enviar(T_ALIAS, self.alias, compresion.ACEPTADOS | F_ACUSE)
+                    respuesta = conexion.recibir()
+            except (OSError, ErrorProtocolo):
+                sock.close()
+                continue
+            if respuesta is None or respuesta.tipo != T_BIENVENIDA:
+                sock.close()
+                if respuesta is not None and respuesta.tipo == T_ALIAS_OCUPADO:
+                    self.mostrar_mensaje(f"⚠ El alias {self.alias} ya está en uso: no se pudo reconectar.")
+                    return False
+                continue
+
+            sock.settimeout(None)
+            conexion.codec = compresion.CODECS.get(respuesta.flags & compresion.MASCARA)
+            self.acuses = bool(respuesta.flags & F_ACUSE)
+            if nueva:
+                self.sesion = SesionCliente.desde_bienvenida(self.alias, respuesta.carga)
+                self.mostrar_mensaje("✅ Reconectado. Los mensajes del corte quedaron en el historial.")
+                # Con una sesión nueva el servidor ya no lo tiene en ninguna sala: se vuelve a entrar
+                for sala in list(self.salas):
+                    pedir_sala(conexion, UNIR, sala)
+            else:
+                perdidos = self.sesion.reanudada(respuesta.carga)
+                self.mostrar_mensaje("✅ Reconectado.")
+                if perdidos:
+                    self.mostrar_mensaje(f"⚠ {perdidos} mensajes del corte no se pudieron recuperar (quedan en el historial).")
+            self.sock, self.conexion = sock, conexion
+            self.pidiendo_historial = False
+            # Lo que quedó sin acuse se manda otra vez con el mismo id: si ya había llegado, el servidor
+            # solo repite el acuse
+            self._reenviar(todos=True)
+            return True
+        return False
     # Registro y validación del alias con el servidor.
     def _realizar_handshake(self):
+        #  Recibir mensaje inicial del servidor (el servidor habla primero, en texto plano)
+        prompt = self.sock.recv(4096).decode("utf-8").strip()
+        if not prompt:
+            return None
+        # Si el servidor está lleno contesta con un rechazo en vez del pedido de alias, y cierra
+        if prompt.startswith(RECHAZO):
+            messagebox.showerror("Servidor", prompt[len(RECHAZO):].strip())
+            return None
         while True:
-             #  Recibir mensaje inicial del servidor (el servidor habla primero)
-            prompt = self.sock.recv(4096).decode("utf-8").strip()
-            if not prompt:
-                return None
-            #  Si el servidor ya nos da la bienvenida, ya tenemos alias
-            if prompt.startswith("Bienvenido"):
-                try:
-                    alias = prompt.split(",")[1].strip().strip(".")
-                except:
-                    alias = "Anónimo"
-                return alias
-            
-            #  Si no hay bienvenida → pedir alias al usuario
+            #  Pedir alias al usuario
             alias = simpledialog.askstring("Alias", prompt if prompt else "Ingrese su alias:")
             if alias is None:
                 return None
             alias = alias.strip() or "Anónimo"
-             #  Enviar alias al servidor para validación
-            self.sock.send(alias.encode("utf-8"))
+             #  Enviar alias al servidor para validación; al ser una trama el servidor sabe que hablamos el protocolo nuevo
+            # En los flags van los códecs de compresión que entendemos (el servidor elige uno en la bienvenida)
+            # y F_ACUSE: mandamos ids de mensaje y contestamos recibos
+            self.conexion.enviar(T_ALIAS, alias, compresion.ACEPTADOS | F_ACUSE)
             # Recibir respuesta del servidor (aceptado, ocupado o mensaje extra)
-            respuesta = self.sock.recv(4096).decode("utf-8").strip()
-            if not respuesta:
+            respuesta = self.conexion.recibir()
+            if respuesta is None:
                 raise RuntimeError("El servidor cerró la conexión durante el registro de alias.")
 
              # Si el alias fue aceptado → terminar handshake
-            if respuesta.startswith("Bienvenido") or respuesta.startswith("ALIAS_OK"):
+            # La bienvenida también trae el token para reanudar la sesión si la conexión se corta
+            if respuesta.tipo == T_BIENVENIDA:
+                self.conexion.codec = compresion.CODECS.get(respuesta.flags & compresion.MASCARA)
+                self.acuses = bool(respuesta.flags & F_ACUSE)
+                self.sesion = SesionCliente.desde_bienvenida(alias, respuesta.carga)
                 return alias
-            #  Si el alias está ocupado → pedir otro (repite el ciclo)
-            elif "alias_taken" in respuesta.lower() or "ya existe" in respuesta.lower():
+            #  Si el alias está ocupado → pedir otro (el servidor vuelve a mandar el pedido de alias)
+            if respuesta.tipo == T_ALIAS_OCUPADO:
                 messagebox.showwarning("Alias ocupado", "El alias ya está en uso. Intente con otro.")
-                continue
-            
-            else:
-                if "bienvenido" in respuesta.lower():
-                    return alias
-                messagebox.showinfo("Servidor", respuesta)
+                siguiente = self.conexion.recibir()
+                if siguiente is None:
+                    return None
+                prompt = siguiente.carga.decode("utf-8").strip()
                 continue
 
+            messagebox.showinfo("Servidor", respuesta.carga.decode("utf-8"))
+
     # envio de mensajes publicos 
     def enviar_a_todos(self):
         # toma el mensaje que el suario escribió en la entrada de texto
@@ -205,7 +474,7 @@ class ClienteGUI:
             return
         try:
             #Envía el mensaje al servidor con el formato publico
-            self.sock.send(f"MSG_ALL:{mensaje}".encode("utf-8"))
+            self._mandar(T_MSG_ALL, mensaje)
             self.mostrar_mensaje(f"(Tú a Todos): {mensaje}")
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo enviar el mensaje: {e}")
@@ -222,36 +491,222 @@ class ClienteGUI:
             messagebox.showwarning("Privado", "Selecciona un usuario de la lista.")
             return
          # Obtiene el nombre del usuario seleccionado
-        usuario = self.listbox_usuarios.get(seleccion[0])
-        alias = usuario.split(" (")[0]
+        alias = self.filas_usuarios[seleccion[0]]
         try:
-            self.sock.send(f"MSG_PRIVATE:{alias}:{mensaje}".encode("utf-8"))
+            self._mandar(T_MSG_PRIVADO, empaquetar_campos(alias, mensaje))
             self.mostrar_mensaje(f"(Tú a {alias}): {mensaje}")
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo enviar el mensaje privado: {e}")
         self.entry_msg.delete(0, tk.END)
 
+    def enviar_a_sala(self):
+        mensaje = self.entry_msg.get().strip()
+        if not mensaje:
+            return
+        seleccion = self.listbox_salas.curselection()
+        if not seleccion:
+            messagebox.showwarning("Sala", "Selecciona una sala de la lista (o crea una o únete a una).")
+            return
+        sala = self.filas_salas[seleccion[0]]
+        try:
+            self._mandar(T_MSG_PRIVADO, empaquetar_campos(sala, mensaje))
+            self.mostrar_mensaje(f"(Tú a {sala}): {mensaje}")
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo enviar el mensaje a la sala: {e}")
+        self.entry_msg.delete(0, tk.END)
+
+    # Ids de mensaje y acuses (ver acuses.py): cada mensaje propio lleva un id y se reintenta con ese
+    # mismo id hasta que el servidor lo acepta; si el primer envío sí había llegado, no se duplica.
+    def _mandar(self, tipo, carga):
+        if not self.acuses:
+            self.conexion.enviar(tipo, carga)
+            return
+        id_mensaje = self.sin_acuse.nuevo(tipo, carga)
+        try:
+            self.conexion.enviar(tipo, empaquetar_campos(id_mensaje, carga), F_ACUSE)
+        except OSError:
+            pass  # queda pendiente: se reenvía al reconectar
+
+    def _reenviar(self, todos=False):
+        reintentos, abandonados = self.sin_acuse.para_reintentar(todos)
+        for id_mensaje, tipo, carga in reintentos:
+            try:
+                self.conexion.enviar(tipo, empaquetar_campos(id_mensaje, carga), F_ACUSE)
+            except OSError:
+                break  # sin conexión: al reconectar se reenvían todos
+        for tipo, carga in abandonados:
+            texto = carga if isinstance(carga, str) else carga.split(SEPARADOR, 1)[-1].decode("utf-8")
+            self.mostrar_mensaje(f"⚠ El servidor no confirmó tu mensaje: {texto}")
+
+    def _reintentar(self):
+        # Corre en el hilo de Tk cada INTERVALO_REINTENTOS_MS
+        if self.cerrando:
+            return
+        self._reenviar()
+        self.master.after(self.INTERVALO_REINTENTOS_MS, self._reintentar)
+
+    def acuse_recibido(self, id_mensaje, estado, detalle):
+        # Desde el hilo receptor
+        segundos = self.sin_acuse.acusar(id_mensaje, estado)
+        if estado == ENTREGADO and segundos is not None:
+            self.mostrar_mensaje(f"✓ {detalle} recibió tu mensaje ({segundos * 1000:.0f} ms)")
+        elif estado == ACEPTADO and detalle == EN_BUZON:
+            self.mostrar_mensaje("✉ El destinatario no está conectado: recibirá tu mensaje cuando vuelva.")
+        elif estado == RECHAZADO and segundos is not None:
+            self.mostrar_mensaje(f"⚠ El servidor no aceptó tu mensaje: {detalle}")
+
+    def accion_sala(self, accion):
+        sala = simpledialog.askstring("Sala", "Nombre de la sala (por ejemplo #proyecto-final):")
+        if not sala:
+            return
+        sala = sala.strip()
+        if not sala.startswith("#"):
+            sala = "#" + sala
+        try:
+            pedir_sala(self.conexion, accion, sala)
+        except OSError as e:
+            messagebox.showerror("Error", f"No se pudo contactar al servidor: {e}")
+
+    def salir_de_sala(self):
+        seleccion = self.listbox_salas.curselection()
+        if not seleccion:
+            messagebox.showwarning("Sala", "Selecciona la sala de la que quieres salir.")
+            return
+        try:
+            pedir_sala(self.conexion, SALIR, self.filas_salas[seleccion[0]])
+        except OSError as e:
+            messagebox.showerror("Error", f"No se pudo contactar al servidor: {e}")
+
     def adjuntar_archivo(self):
           # Abre una ventana para que el usuario elija un archivo
         ruta = filedialog.askopenfilename(title="Seleccionar archivo", filetypes=[("Todos los archivos", "*.*")])
         if not ruta:
             return
-        destinatario = simpledialog.askstring("Enviar a", "Ingrese el nombre del destinatario (o 'Todos'):")
+        destinatario = simpledialog.askstring("Enviar a", "Ingrese el nombre del destinatario, una #sala o 'Todos':")
         # Si el usuario no escribe nada, se envía a todos por defecto
         destinatario = destinatario or "Todos"
-        enviar_archivo(self.sock, destinatario, ruta, self.mostrar_mensaje)
+        enviar_archivo(self.conexion, self.transferencias, destinatario, ruta, self.mostrar_mensaje)
 
     # Visualización 
+    # Tk no se puede tocar desde otros hilos: mostrar_mensaje y los callbacks de en_tk solo encolan,
+    # y _dibujar_pendientes lo aplica desde el hilo de Tk cada INTERVALO_RENDER_MS, de a tandas.
     def mostrar_mensaje(self, mensaje):
-        # Habilita el cuadro de texto para poder escribir en él
+        # Se puede llamar desde cualquier hilo (receptor, subidas, descargas)
+        self.pendientes.append(mensaje)
+
+    def en_tk(self, funcion):
+        # Envuelve un callback para que se ejecute en el hilo de Tk, en orden con los mensajes
+        return lambda *args: self.pendientes.append((funcion, args))
+
+    def _dibujar_pendientes(self):
+        lineas = []
+        for _ in range(min(len(self.pendientes), self.MAX_TANDA)):
+            evento = self.pendientes.popleft()
+            if isinstance(evento, str):
+                lineas.append(evento)
+                continue
+            # Antes de otro tipo de evento se vuelcan los mensajes juntados, para respetar el orden
+            self._agregar_lineas(lineas)
+            lineas = []
+            funcion, args = evento
+            try:
+                funcion(*args)
+            except tk.TclError:
+                pass
+        self._agregar_lineas(lineas)
+        # Si quedó trabajo se sigue enseguida, dejando que Tk procese eventos en el medio
+        self.master.after(1 if self.pendientes else self.INTERVALO_RENDER_MS, self._dibujar_pendientes)
+
+    def _agregar_lineas(self, lineas):
+        if not lineas:
+            return
+        al_final = self.text_area.yview()[1] >= 0.999
+        # Habilita el cuadro de texto para poder escribir en él (una sola inserción por tanda)
         self.text_area.config(state=tk.NORMAL)
-        self.text_area.insert(tk.END, mensaje + "\n")
+        self.text_area.insert(tk.END, "\n".join(lineas) + "\n")
+        # Si el usuario está leyendo más arriba se le deja lugar, pero nunca más del doble del límite
+        if al_final or self._cantidad_lineas() > 2 * self.MAX_LINEAS:
+            self._desalojar()
         # Lo vuelve a poner en solo lectura para evitar que el usuario lo edite
         self.text_area.config(state=tk.DISABLED)
-        self.text_area.yview(tk.END)
+        if al_final:
+            self.text_area.yview(tk.END)
+
+    def _cantidad_lineas(self):
+        return int(self.text_area.index("end-1c").split(".")[0]) - 1
+
+    def _desalojar(self):
+        # Saca las líneas más viejas del widget y las guarda (con su color) para volver a mostrarlas
+        sobrantes = self._cantidad_lineas() - self.MAX_LINEAS
+        if sobrantes <= 0:
+            return
+        for numero in range(1, sobrantes + 1):
+            if len(self.lineas_viejas) == self.lineas_viejas.maxlen:
+                # Se pierde la más vieja de memoria: el historial del servidor ya no empalma con lo que queda
+                self.cursor_historial = None
+            etiquetas = tuple(t for t in self.text_area.tag_names(f"{numero}.0") if t == "historial")
+            self.lineas_viejas.append((self.text_area.get(f"{numero}.0", f"{numero}.end"), etiquetas))
+        self.text_area.delete("1.0", f"{sobrantes + 1}.0")
+
+    def _insertar_arriba(self, lineas):
+        # `lineas` es [(texto, etiquetas)] de la más vieja a la más nueva; la vista queda donde estaba
+        primera_visible = int(self.text_area.index("@0,0").split(".")[0])
+        self.text_area.config(state=tk.NORMAL)
+        for texto, etiquetas in reversed(lineas):
+            self.text_area.insert("1.0", texto + "\n", etiquetas)
+        self.text_area.config(state=tk.DISABLED)
+        self.text_area.yview(f"{primera_visible + len(lineas)}.0")
+
+    def _linea_historial(self, id_mensaje, fecha, remitente, destinatario, mensaje):
+        # Mismo formato que los mensajes en vivo, con la fecha adelante
+        if remitente == self.alias:
+            texto = f"(Tú a {'Todos' if destinatario.lower() == 'todos' else destinatario}): {mensaje}"
+        elif destinatario.lower() == "todos":
+            texto = f"{remitente} (Todos): {mensaje}"
+        elif destinatario.startswith("#"):
+            texto = f"{remitente} ({destinatario}): {mensaje}"
+        else:
+            texto = f"{remitente} (Privado): {mensaje}"
+        return f"[{fecha[:16]}] {texto}" if fecha else texto
+
+    def mostrar_historial(self, entradas, siguiente, conversacion=""):
+        if conversacion.startswith("#"):
+            # Lo último de una sala a la que se acaba de entrar: va abajo, como los mensajes en vivo
+            if entradas:
+                self._agregar_lineas([f"── Últimos mensajes de {conversacion} ──"] +
+                                     [self._linea_historial(*e) for e in entradas])
+            return
+        # Las páginas más viejas se insertan arriba de todo sin mover lo que el usuario está mirando
+        self.cursor_historial = siguiente
+        self.pidiendo_historial = False
+        if not entradas:
+            return
+        self._insertar_arriba([(self._linea_historial(*e), ("historial",)) for e in entradas])
+        if not self.historial_cargado:
+            self.historial_cargado = True
+            self.text_area.yview(tk.END)
+
+    def _al_desplazar(self, primero, ultimo):
+        self.text_area.vbar.set(primero, ultimo)
+        if float(primero) > 0.0:
+            return
+        if self.lineas_viejas:
+            # Primero vuelve lo que ya se había desalojado, sin ir al servidor
+            cantidad = min(self.PAGINA_LINEAS, len(self.lineas_viejas))
+            lineas = [self.lineas_viejas.pop() for _ in range(cantidad)]
+            lineas.reverse()
+            self.master.after_idle(self._insertar_arriba, lineas)
+        elif self.cursor_historial and not self.pidiendo_historial:
+            self.pidiendo_historial = True
+            try:
+                pedir_historial(self.conexion, self.cursor_historial)
+            except OSError:
+                pass
 
     def actualizar_usuarios(self, lista):
+        # Lista completa: solo al entrar (foto) o con servidores viejos
         self.listbox_usuarios.delete(0, tk.END)
+        self.filas_usuarios = []
         
         # Recorre cada usuario recibido del servidor
         for usuario in lista:
@@ -261,19 +716,78 @@ class ClienteGUI:
                 self.listbox_usuarios.insert(tk.END, f"{alias} ({codigo})")
                  # Si solo viene el alias, se muestra tal cual
             else:
+                alias = usuario
                 self.listbox_usuarios.insert(tk.END, usuario)
+            self.filas_usuarios.append(alias)
+
+    def aplicar_cambios_usuarios(self, cambios):
+        # Solo se tocan las filas de quien entró o salió; el resto de la lista (y la selección) queda igual
+        for alias, codigo in cambios:
+            if alias in self.filas_usuarios:
+                fila = self.filas_usuarios.index(alias)
+                self.listbox_usuarios.delete(fila)
+                del self.filas_usuarios[fila]
+            if codigo is not None:
+                self.listbox_usuarios.insert(tk.END, f"{alias} ({codigo})")
+                self.filas_usuarios.append(alias)
+
+    def evento_sala(self, accion, sala, *datos):
+        # Respuestas del servidor y presencia de las salas en las que está el usuario
+        if accion == UNIDO:
+            nueva = sala not in self.salas
+            self.salas[sala] = set(datos)
+            if nueva:
+                self.mostrar_mensaje(f"🚪 Entraste a {sala} ({len(datos)} miembros: {', '.join(datos)})")
+                pedir_historial(self.conexion, limite=20, conversacion=sala)
+        elif accion == SALIDO:
+            if self.salas.pop(sala, None) is not None:
+                self.mostrar_mensaje(f"🚪 Saliste de {sala}")
+        elif accion == ERROR:
+            self.mostrar_mensaje(f"⚠ {sala}: {datos[0] if datos else 'error'}")
+            if datos and datos[0] == "La sala no existe":
+                self.salas.pop(sala, None)
+        elif sala in self.salas and datos:
+            if accion == ENTRO:
+                self.salas[sala].add(datos[0])
+                self.mostrar_mensaje(f"➡ {datos[0]} entró a {sala}")
+            else:
+                self.salas[sala].discard(datos[0])
+                self.mostrar_mensaje(f"⬅ {datos[0]} salió de {sala}")
+        self._dibujar_salas()
+
+    def _dibujar_salas(self):
+        seleccion = self.listbox_salas.curselection()
+        elegida = self.filas_salas[seleccion[0]] if seleccion else None
+        self.listbox_salas.delete(0, tk.END)
+        self.filas_salas = sorted(self.salas)
+        for sala in self.filas_salas:
+            self.listbox_salas.insert(tk.END, f"{sala} ({len(self.salas[sala])})")
+        if elegida in self.salas:
+            self.listbox_salas.selection_set(self.filas_salas.index(elegida))
+
+    def agregar_compartido(self, referencia):
+        self.compartidos.append(referencia)
+        self.listbox_archivos.insert(tk.END, f"{referencia.nombre} ({referencia.tamano // 1024} KB) - {referencia.remitente}")
+        self.mostrar_mensaje(f"📎 {referencia.remitente} compartió '{referencia.nombre}'. Doble clic en la lista para descargarlo.")
+
+    def descargar_seleccionado(self, evento=None):
+        seleccion = self.listbox_archivos.curselection()
+        if not seleccion:
+            return
+        descargar_compartido(self.transferencias, self.direccion, self.compartidos[seleccion[0]], self.mostrar_mensaje)
 
     #  Desconexión
     def desconectar(self):
         # Intenta avisar al servidor que el usuario se está desconectando
+        self.cerrando = True
         try:
-            self.sock.send("salir".encode("utf-8"))
-        except:
-            pass  
+            self.conexion.enviar(T_SALIR)
+        except OSError:
+            pass
         try:
             self.sock.close()
-        except:
-            pass        
+        except OSError:
+            pass
     # Cierra la ventana principal del cliente
         self.master.destroy()
 
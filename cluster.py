@@ -0,0 +1,308 @@
+import os
+import sys
+import time
+import queue
+import logging
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+# MODO MULTIPROCESO
+# N procesos trabajadores escuchan en el mismo puerto (SO_REUSEPORT: el kernel reparte las conexiones
+# entre ellos), así el servidor ya no queda atado a un solo núcleo por el GIL y por un único
+# procesar_mensajes. Cada trabajador es un servidor.py completo (modo hilos o asyncio) con sus propios
+# clientes; lo que cruza de un trabajador a otro pasa por el enrutador:
+#   - alias únicos entre todos los trabajadores (el enrutador es quien los reserva)
+#   - presencia: quién entra y quién sale en cualquier trabajador
+#   - broadcast, privados y archivos para clientes que están en otro trabajador
+#   - quién entra y sale de cada sala (cada trabajador tiene el índice completo de miembros)
+# El enrutador es un bus de mensajes sobre multiprocessing.connection: por defecto un socket Unix
+# local, o TCP (host:puerto) para repartir trabajadores en varias máquinas con un enrutador
+# independiente (`--solo-enrutador`), a modo de broker en memoria.
+# Cada trabajador escribe su historial y sus conexiones en historial.db (SQLite en modo WAL admite
+# varios procesos escribiendo). Los archivos compartidos necesitan que almacen/ sea el mismo disco.
+
+BUS_LOCAL = "chat_bus.sock"
+
+log = logging.getLogger("chat.cluster")
+
+
+def direccion_bus(texto):
+    # "host:puerto" -> TCP; cualquier otra cosa es la ruta de un socket Unix
+    host, separador, puerto = texto.rpartition(":")
+    if separador and puerto.isdigit():
+        return (host, int(puerto))
+    return texto
+
+
+class Enrutador:
+    # Proceso central (o hilo del proceso principal) al que se conectan todos los trabajadores.
+    # Todo su estado se toca con un solo lock, y los reenvíos se encolan con el lock tomado: así cada
+    # trabajador ve los eventos en el mismo orden en que el enrutador cambió su estado. El envío en sí
+    # lo hace un hilo por trabajador, fuera del lock: un trabajador lento (o que a su vez está mandando
+    # al bus) no frena a los demás ni deja al enrutador trabado en un send.
+    def __init__(self, direccion, clave):
+        self.direccion = direccion
+        self.clave = clave
+        self.trabajadores = {}  # numero -> cola de salida hacia ese trabajador
+        self.duenos = {}        # alias -> numero del trabajador que lo tiene
+        self.codigos = {}       # alias -> codigo (solo los que ya terminaron de entrar)
+        self._lock = threading.Lock()
+        self.reenviados = 0
+
+    def iniciar(self):
+        if isinstance(self.direccion, str) and os.path.exists(self.direccion):
+            os.remove(self.direccion)
+        self._oyente = Listener(self.direccion, authkey=self.clave)
+        threading.Thread(target=self._aceptar, name="enrutador", daemon=True).start()
+        return self
+
+    def _aceptar(self):
+        while True:
+            conn = self._oyente.accept()
+            threading.Thread(target=self._atender, args=(conn,), daemon=True).start()
+
+    def _enviar(self, numero, mensaje):
+        cola = self.trabajadores.get(numero)
+        if cola is not None:
+            cola.put(mensaje)
+            self.reenviados += 1
+
+    def _despachar(self, conn, cola):
+        # Hilo de envío de un trabajador: None (o un error al mandar) lo termina y cierra la conexión,
+        # con lo que también termina la lectura en _atender, que lo saca de las tablas
+        try:
+            while True:
+                mensaje = cola.get()
+                if mensaje is None:
+                    break
+                conn.send(mensaje)
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def _a_los_demas(self, origen, mensaje):
+        for numero in list(self.trabajadores):
+            if numero != origen:
+                self._enviar(numero, mensaje)
+
+    def _atender(self, conn):
+        numero = None
+        cola = None
+        try:
+            while True:
+                mensaje = conn.recv()
+                tipo = mensaje[0]
+                with self._lock:
+                    if tipo == "hola":
+                        numero = mensaje[1]
+                        cola = queue.SimpleQueue()
+                        self.trabajadores[numero] = cola
+                        threading.Thread(target=self._despachar, args=(conn, cola), daemon=True).start()
+                        self._enviar(numero, ("estado", list(self.codigos.items())))
+
+                    elif tipo == "reservar":
+                        _, pedido, alias = mensaje
+                        libre = alias not in self.duenos
+                        if libre:
+                            self.duenos[alias] = numero
+                        self._enviar(numero, ("reservado", pedido, libre))
+
+                    elif tipo == "unir":
+                        _, alias, codigo = mensaje
+                        self.codigos[alias] = codigo
+                        self._a_los_demas(numero, mensaje)
+
+                    elif tipo == "salir":
+                        alias = mensaje[1]
+                        if self.duenos.get(alias) == numero:
+                            del self.duenos[alias]
+                            if self.codigos.pop(alias, None) is not None:
+                                self._a_los_demas(numero, mensaje)
+
+                    elif tipo == "difundir":
+                        self._a_los_demas(numero, mensaje)
+
+                    elif tipo == "enviar_a":
+                        # Solo al trabajador que tiene al destinatario. Si no está conectado en ningún lado
+                        # vuelve al que lo mandó, que lo deja en el buzón (la BD es la misma para todos).
+                        destino = self.duenos.get(mensaje[1])
+                        self._enviar(numero if destino is None else destino, mensaje)
+        except (EOFError, OSError):
+            pass
+        finally:
+            # Si un trabajador se cae, sus clientes dejan de existir para los demás
+            with self._lock:
+                if numero is not None and self.trabajadores.get(numero) is cola:
+                    del self.trabajadores[numero]
+                for alias in [a for a, dueno in self.duenos.items() if dueno == numero]:
+                    del self.duenos[alias]
+                    if self.codigos.pop(alias, None) is not None:
+                        self._a_los_demas(numero, ("salir", alias))
+            if cola is not None:
+                cola.put(None)
+            else:
+                conn.close()
+
+
+class EnlaceBus:
+    # Lado trabajador: lo que servidor.py usa a través de `servidor.bus`.
+    def __init__(self, numero, direccion, clave):
+        self.numero = numero
+        self.direccion = direccion
+        self.clave = clave
+        self._lock_envio = threading.Lock()
+        self._pedidos = {}  # id -> [Event, resultado]
+        self._siguiente = 0
+
+    def conectar(self, servidor):
+        self.servidor = servidor
+        self._conn = Client(self.direccion, authkey=self.clave)
+        self._enviar(("hola", self.numero))
+        tipo, miembros = self._conn.recv()
+        # Los que ya estaban conectados en otros trabajadores
+        with servidor.lock:
+            for alias, codigo in miembros:
+                servidor.presencia.unir(alias, codigo)
+        threading.Thread(target=self._escuchar, name="bus", daemon=True).start()
+        return self
+
+    def _enviar(self, mensaje):
+        with self._lock_envio:
+            self._conn.send(mensaje)
+
+    # Llamados desde servidor.py
+    def reservar(self, alias, espera=10.0):
+        # True si el alias quedó reservado para este trabajador (nadie lo tiene en ningún otro)
+        with self._lock_envio:
+            self._siguiente += 1
+            pedido = self._siguiente
+            self._pedidos[pedido] = [threading.Event(), False]
+            self._conn.send(("reservar", pedido, alias))
+        evento, _ = self._pedidos[pedido]
+        evento.wait(espera)
+        return self._pedidos.pop(pedido)[1]
+
+    def unir(self, alias, codigo):
+        self._enviar(("unir", alias, codigo))
+
+    def salir(self, alias):
+        self._enviar(("salir", alias))
+
+    def difundir(self, evento, *args):
+        self._enviar(("difundir", evento, args))
+
+    def enviar_a(self, alias, evento, *args):
+        self._enviar(("enviar_a", alias, evento, args))
+
+    def _escuchar(self):
+        servidor = self.servidor
+        try:
+            while True:
+                mensaje = self._conn.recv()
+                tipo = mensaje[0]
+                if tipo == "reservado":
+                    _, pedido, libre = mensaje
+                    if pedido in self._pedidos:
+                        self._pedidos[pedido][1] = libre
+                        self._pedidos[pedido][0].set()
+                elif tipo == "unir":
+                    with servidor.lock:
+                        servidor.presencia.unir(mensaje[1], mensaje[2])
+                elif tipo == "salir":
+                    with servidor.lock:
+                        servidor.presencia.salir(mensaje[1])
+                    servidor.dejar_salas(mensaje[1])
+                else:
+                    # Entregas que vienen de otro trabajador: solo a los clientes locales
+                    evento, args = mensaje[-2], mensaje[-1]
+                    servidor.entregar_remoto(evento, *args)
+        except (EOFError, OSError):
+            # Sin enrutador el trabajador ya no puede garantizar alias únicos: se vacía la BD y se termina
+            log.critical("Trabajador %s: se perdió la conexión con el enrutador", self.numero)
+            servidor.cerrar()
+            os._exit(1)
+
+
+def trabajador(numero, modo, host, puerto, backlog, bus, clave, ruta_bd, nivel_log, metricas):
+    # Cuerpo de cada proceso trabajador. servidor.py se importa recién acá, dentro del proceso hijo.
+    import registro
+    import servidor
+    import servicio
+    registro.configurar(nivel_log)
+    # Todo lo demás (límites, salida, gracia, ventana de ids, caché) sale de las mismas variables de entorno
+    # que en servicio.py y vale por trabajador
+    servicio.configurar(servidor, servicio.leer_argumentos([]))
+    servidor.preparar(ruta_bd)
+    if metricas:
+        # Cada trabajador tiene sus propias métricas: el trabajador N escucha en el puerto base + N
+        servicio.abrir_metricas(metricas, numero)
+    servidor.bus = EnlaceBus(numero, bus, clave).conectar(servidor)
+    if modo == "asyncio":
+        import asyncio
+        import servidor_asyncio
+        asyncio.run(servidor_asyncio.servir(host, puerto, backlog, reuse_port=True))
+    else:
+        servidor.iniciar_servidor(host, puerto, backlog, reuse_port=True)
+        threading.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor de chat en varios procesos")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--puerto", type=int, default=5010)
+    parser.add_argument("--trabajadores", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--modo", choices=("hilos", "asyncio"), default="asyncio")
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument("--bus", default=BUS_LOCAL, help="socket Unix o host:puerto del enrutador")
+    parser.add_argument("--solo-enrutador", action="store_true", help="correr solo el enrutador (varias máquinas)")
+    parser.add_argument("--sin-enrutador", action="store_true", help="usar un enrutador que ya corre en --bus")
+    parser.add_argument("--bd", default=os.environ.get("CHAT_BD", "historial.db"))
+    parser.add_argument("--log-nivel", default=os.environ.get("CHAT_LOG_NIVEL", "INFO"))
+    parser.add_argument("--metricas", default=os.environ.get("CHAT_METRICAS", ""),
+                        help="host:puerto base de /metrics; el trabajador N usa el puerto + N")
+    args = parser.parse_args()
+
+    import registro
+    registro.configurar(args.log_nivel)
+
+    # Entre máquinas la clave tiene que ser la misma en todas; en una sola se genera al arrancar
+    clave = os.environ.get("CHAT_BUS_CLAVE", "").encode() or os.urandom(16)
+    bus = direccion_bus(args.bus)
+
+    if not args.sin_enrutador:
+        Enrutador(bus, clave).iniciar()
+        log.info("Enrutador escuchando en %s", args.bus)
+    if args.solo_enrutador:
+        threading.Event().wait()
+
+    # Las migraciones se aplican una vez antes de arrancar los trabajadores, no N veces en paralelo
+    from bd import init_db
+    init_db(args.bd)
+
+    contexto = multiprocessing.get_context("spawn")
+    procesos = [
+        contexto.Process(target=trabajador, name=f"trabajador-{n}", daemon=True,
+                         args=(n, args.modo, args.host, args.puerto, args.backlog, bus, clave, args.bd,
+                               args.log_nivel, args.metricas))
+        for n in range(args.trabajadores)
+    ]
+    for proceso in procesos:
+        proceso.start()
+    log.info("%d trabajadores (%s) en %s:%s", len(procesos), args.modo, args.host, args.puerto)
+    try:
+        while all(p.is_alive() for p in procesos):
+            time.sleep(1)
+        log.error("Un trabajador terminó; se cierra el servidor")
+    except KeyboardInterrupt:
+        pass
+    for proceso in procesos:
+        proceso.terminate()
+    registro.detener()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
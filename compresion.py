@@ -0,0 +1,152 @@
+import os
+import zlib
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    # zstd es opcional: sin el paquete `zstandard` solo se ofrece zlib
+    zstandard = None
+
+# COMPRESIÓN DE TRAMAS POR CONEXIÓN
+# Se negocia en el handshake de alias: el cliente manda en los flags de T_ALIAS los códecs que entiende
+# (F_ZLIB | F_ZSTD) y el servidor contesta en los flags de T_BIENVENIDA el que eligió (o 0 = sin
+# compresión). Desde ahí, en las tramas comprimibles el mismo bit en los flags indica que la carga viaja
+# comprimida con ese códec; el DecodificadorTramas la descomprime y el resto del código no se entera.
+# Cada trama se decide por separado:
+#   - las cargas de menos de UMBRAL bytes van tal cual (un mensaje de chat corto no gana nada)
+#   - lo que ya está comprimido (JPG, PNG, PDF, ZIP, MP4...) no se vuelve a comprimir: se reconoce por
+#     la extensión, por los primeros bytes o comprimiendo una muestra chica de los bloques grandes
+#   - si el resultado no ahorra al menos un 10%, se manda la carga original
+# Los clientes de texto viejo nunca negocian, así que nunca reciben nada comprimido.
+
+F_ZLIB = 0x01
+F_ZSTD = 0x02
+MASCARA = F_ZLIB | F_ZSTD
+
+UMBRAL = 256
+AHORRO_MINIMO = 0.9   # se usa la versión comprimida solo si mide menos del 90% del original
+MUESTRA = 4096        # bytes que se prueban antes de comprimir un bloque grande de archivo
+
+EXTENSIONES_COMPRIMIDAS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp3", ".m4a", ".ogg", ".opus", ".flac", ".aac",
+    ".mp4", ".m4v", ".mkv", ".mov", ".avi", ".webm",
+    ".pdf", ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".epub", ".apk", ".jar",
+}
+
+FIRMAS_COMPRIMIDAS = (
+    b"\xff\xd8\xff",           # JPEG
+    b"\x89PNG",                # PNG
+    b"GIF8",                   # GIF
+    b"%PDF",                   # PDF
+    b"PK\x03\x04",             # ZIP, DOCX, XLSX, APK...
+    b"\x1f\x8b",               # gzip
+    b"\x28\xb5\x2f\xfd",       # zstd
+    b"BZh",                    # bzip2
+    b"\xfd7zXZ",               # xz
+    b"7z\xbc\xaf",             # 7z
+    b"Rar!",                   # RAR
+    b"OggS",                   # Ogg
+    b"ID3",                    # MP3
+    b"\x1aE\xdf\xa3",          # Matroska / WebM
+)
+
+
+def ya_comprimido(inicio=b"", nombre=""):
+    # `inicio` son los primeros bytes de la carga: la firma puede estar corrida por los campos que van
+    # antes de los datos (id, offset y crc de un bloque), así que se busca en todo ese tramo
+    if nombre and os.path.splitext(nombre)[1].lower() in EXTENSIONES_COMPRIMIDAS:
+        return True
+    # MP4/MOV ("....ftyp") y WEBP ("RIFF....WEBP") tienen la firma corrida unos bytes
+    return any(firma in inicio for firma in FIRMAS_COMPRIMIDAS + (b"ftyp", b"WEBPVP8"))
+
+
+def _muestra_incompresible(datos):
+    # Para bloques grandes sin firma reconocible: se comprime rápido una muestra del medio
+    if len(datos) < 4 * MUESTRA:
+        return False
+    medio = len(datos) // 2
+    muestra = datos[medio:medio + MUESTRA]
+    return len(zlib.compress(muestra, 1)) > len(muestra) * 0.95
+
+
+class Codec:
+    def __init__(self, nombre, bandera, nivel):
+        self.nombre = nombre
+        self.bandera = bandera
+        self.nivel = nivel
+        self._local = threading.local()  # los contextos de zstd no se pueden usar desde dos hilos a la vez
+        self.comprimidas = 0
+        self.bytes_originales = 0
+        self.bytes_comprimidos = 0
+
+    def _zstd(self):
+        if not hasattr(self._local, "compresor"):
+            self._local.compresor = zstandard.ZstdCompressor(level=self.nivel)
+            self._local.descompresor = zstandard.ZstdDecompressor()
+        return self._local
+
+    def comprimir(self, datos):
+        if self.nombre == "zstd":
+            return self._zstd().compresor.compress(datos)
+        return zlib.compress(datos, self.nivel)
+
+    def descomprimir(self, datos, maximo):
+        # `maximo` evita que una carga chica se infle a gigabytes (bomba de descompresión)
+        if self.nombre == "zstd":
+            with self._zstd().descompresor.stream_reader(datos) as lector:
+                salida = lector.read(maximo + 1)
+        else:
+            lector = zlib.decompressobj()
+            salida = lector.decompress(datos, maximo + 1)
+        if len(salida) > maximo:
+            raise ValueError(f"La carga descomprimida supera {maximo} bytes")
+        return salida
+
+    def intentar(self, carga, archivo=False, nombre=""):
+        # Devuelve (carga, bandera): la carga comprimida y el bit de este códec, o la original y 0
+        if len(carga) < UMBRAL:
+            return carga, 0
+        if archivo and (ya_comprimido(carga[:80], nombre) or _muestra_incompresible(carga)):
+            return carga, 0
+        comprimida = self.comprimir(carga)
+        if len(comprimida) >= len(carga) * AHORRO_MINIMO:
+            return carga, 0
+        self.comprimidas += 1
+        self.bytes_originales += len(carga)
+        self.bytes_comprimidos += len(comprimida)
+        return comprimida, self.bandera
+
+
+# Un códec por tipo y por proceso: cada trama se comprime sola, sin estado compartido entre tramas
+CODECS = {F_ZLIB: Codec("zlib", F_ZLIB, 6)}
+if zstandard is not None:
+    CODECS[F_ZSTD] = Codec("zstd", F_ZSTD, 3)
+
+ACEPTADOS = sum(CODECS)          # lo que este proceso sabe descomprimir
+PREFERENCIA = (F_ZSTD, F_ZLIB)   # si el otro lado entiende los dos, zstd
+
+
+def elegir(ofrecidos):
+    # Devuelve el Codec a usar con quien ofreció `ofrecidos` (flags de T_ALIAS), o None
+    for bandera in PREFERENCIA:
+        if ofrecidos & bandera and bandera in CODECS:
+            return CODECS[bandera]
+    return None
+
+
+def descomprimir(flags, carga, maximo):
+    codec = CODECS.get(flags & MASCARA)
+    if codec is None:
+        raise ValueError(f"Compresión no soportada (flags {flags:#x})")
+    return codec.descomprimir(carga, maximo)
+
+
+def estadisticas():
+    return {
+        c.nombre: {"comprimidas": c.comprimidas, "bytes_originales": c.bytes_originales,
+                   "bytes_comprimidos": c.bytes_comprimidos}
+        for c in CODECS.values()
+    }
@@ -0,0 +1,44 @@
+# REGISTRO DE CLIENTES CONECTADOS (COPIA EN ESCRITURA)
+# `clientes` se lee muchísimo más seguido de lo que cambia: cada broadcast, privado, archivo y cambio de
+# presencia lo recorre o lo consulta, y solo una entrada o una salida lo modifica. Por eso las lecturas
+# no toman ningún lock: ven la foto publicada, un dict que nunca se modifica junto con la tupla de sus
+# items ya armada para recorrer. Cada escritura arma un dict nuevo y lo publica reemplazando una sola
+# referencia (atómico): quien esté repartiendo con la foto anterior la termina de recorrer tranquilo.
+# Escribir cuesta O(clientes) en lugar de O(1), pero pasa una vez por conexión y no en cada mensaje.
+# Las escrituras se hacen con el lock del registro tomado por quien llama (servidor.lock), así la
+# reserva del alias y la presencia quedan en la misma sección crítica, que es corta: solo diccionarios,
+# nunca sockets, disco ni otros locks (el buzón se marca entre la reserva y la publicación).
+
+
+class Directorio:
+    def __init__(self):
+        self._estado = ({}, ())  # (alias -> info, tupla de (alias, info)): se reemplaza entero
+        self.versiones = 0
+
+    # Lecturas: sin lock, sobre la foto del momento
+    def get(self, alias, defecto=None):
+        return self._estado[0].get(alias, defecto)
+
+    def __contains__(self, alias):
+        return alias in self._estado[0]
+
+    def __len__(self):
+        return len(self._estado[1])
+
+    def items(self):
+        return self._estado[1]
+
+    # Escrituras: con servidor.lock tomado
+    def agregar(self, alias, info):
+        foto = dict(self._estado[0])
+        foto[alias] = info
+        self._publicar(foto)
+
+    def quitar(self, alias):
+        foto = dict(self._estado[0])
+        del foto[alias]
+        self._publicar(foto)
+
+    def _publicar(self, foto):
+        self._estado = (foto, tuple(foto.items()))
+        self.versiones += 1
@@ -0,0 +1,349 @@
+import os
+import sys
+import glob
+import json
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+# HISTORIAL DE MENSAJES
+# Backends intercambiables para guardar cada mensaje que pasa por el servidor.
+# Todos ofrecen la misma interfaz: guardar(alias, mensaje, destinatario), sincronizar() y cerrar().
+#   - "json":   el formato original, {alias}_chat.json reescrito completo en cada mensaje (O(n) por mensaje)
+#   - "jsonl":  {alias}_chat.jsonl en modo append, una línea por mensaje y fsync por lotes
+#   - "sqlite": tabla `mensajes` dentro de historial.db, en modo WAL y con commits agrupados
+# Leer el historial (por páginas, con búsqueda) solo se puede con "sqlite": ver ConsultasHistorial.
+
+from bd import RUTA_BD, abrir, migrar, conversacion_de, PoolConexiones
+
+
+def _registro(alias, mensaje, destinatario, fecha=None):
+    # `fecha` vacía se usa para mensajes migrados, cuya fecha original no se conoce
+    return {
+        "remitente": alias,
+        "destinatario": destinatario,
+        "mensaje": mensaje,
+        "fecha": datetime.now().strftime("%Y-%m-%d %H:%M:%S") if fecha is None else fecha,
+    }
+
+
+class _Diferido:
+    # Si quedó un lote a medias, agenda una sincronización para dentro de `intervalo` segundos
+    # así no depende de que llegue otro mensaje.
+    def _programar_sincronizacion(self):
+        if self._temporizador is None:
+            self._temporizador = threading.Timer(self.intervalo, self._sincronizar_diferido)
+            self._temporizador.daemon = True
+            self._temporizador.start()
+
+    def _sincronizar_diferido(self):
+        with self._lock:
+            self._temporizador = None
+            if not self._cerrado:
+                self._sincronizar()
+
+
+class HistorialJSON:
+    # Comportamiento de siempre: carga el archivo entero, agrega una entrada y lo vuelve a escribir.
+    def __init__(self, directorio="."):
+        self.directorio = directorio
+
+    def guardar(self, alias, mensaje, destinatario="Todos"):
+        self.guardar_lote([(alias, mensaje, destinatario)])
+
+    def guardar_lote(self, mensajes):
+        for alias, mensaje, destinatario, *_ in mensajes:
+            self._guardar(alias, mensaje, destinatario)
+
+    def _guardar(self, alias, mensaje, destinatario):
+        archivo = os.path.join(self.directorio, f"{alias}_chat.json")
+        chat = []
+
+        if os.path.exists(archivo):
+            with open(archivo, "r", encoding="utf-8") as f:
+                chat = json.load(f)
+
+        chat.append({"remitente": alias, "destinatario": destinatario, "mensaje": mensaje})
+
+        with open(archivo, "w", encoding="utf-8") as f:
+            json.dump(chat, f, indent=4, ensure_ascii=False)
+
+    def sincronizar(self):
+        pass
+
+    def cerrar(self):
+        pass
+
+
+class HistorialJSONL(_Diferido):
+    # Solo agrega al final del archivo: guardar un mensaje cuesta lo mismo sin importar el tamaño del historial.
+    # Cada línea llega al sistema operativo enseguida; el fsync a disco se hace cada `lote` mensajes
+    # o cada `intervalo` segundos, lo que pase primero.
+    def __init__(self, directorio=".", lote=100, intervalo=1.0, max_abiertos=128):
+        self.directorio = directorio
+        self.lote = lote
+        self.intervalo = intervalo
+        self.max_abiertos = max_abiertos
+        self._archivos = OrderedDict()  # alias -> archivo abierto (los menos usados se cierran)
+        self._sucios = set()
+        self._sin_sincronizar = 0
+        self._ultimo_fsync = time.monotonic()
+        self._lock = threading.Lock()
+        self._temporizador = None
+        self._cerrado = False
+
+    def _archivo(self, alias):
+        f = self._archivos.pop(alias, None)
+        if f is None:
+            ruta = os.path.join(self.directorio, f"{alias}_chat.jsonl")
+            f = open(ruta, "a", encoding="utf-8")
+            if len(self._archivos) >= self.max_abiertos:
+                viejo_alias, viejo = self._archivos.popitem(last=False)
+                self._cerrar_archivo(viejo_alias, viejo)
+        self._archivos[alias] = f
+        return f
+
+    def _cerrar_archivo(self, alias, f):
+        if alias in self._sucios:
+            f.flush()
+            os.fsync(f.fileno())
+            self._sucios.discard(alias)
+        f.close()
+
+    def guardar(self, alias, mensaje, destinatario="Todos"):
+        self.guardar_lote([(alias, mensaje, destinatario)])
+
+    def guardar_lote(self, mensajes):
+        with self._lock:
+            for mensaje in mensajes:
+                registro = _registro(*mensaje)
+                f = self._archivo(registro["remitente"])
+                f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+                f.flush()
+                self._sucios.add(registro["remitente"])
+                self._sin_sincronizar += 1
+            if self._sin_sincronizar >= self.lote or time.monotonic() - self._ultimo_fsync >= self.intervalo:
+                self._sincronizar()
+            else:
+                self._programar_sincronizacion()
+
+    def _sincronizar(self):
+        for alias in self._sucios:
+            os.fsync(self._archivos[alias].fileno())
+        self._sucios.clear()
+        self._sin_sincronizar = 0
+        self._ultimo_fsync = time.monotonic()
+
+    def sincronizar(self):
+        with self._lock:
+            self._sincronizar()
+
+    def cerrar(self):
+        with self._lock:
+            self._cerrado = True
+            self._sincronizar()
+            for f in self._archivos.values():
+                f.close()
+            self._archivos.clear()
+
+
+class HistorialSQLite(_Diferido):
+    # Tabla `mensajes` en historial.db. WAL permite leer mientras se escribe, y los commits se agrupan:
+    # se confirma cada `lote` mensajes o cada `intervalo` segundos, lo que pase primero.
+    def __init__(self, ruta=RUTA_BD, lote=100, intervalo=1.0, conn=None):
+        self.lote = lote
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._temporizador = None
+        self._cerrado = False
+        # Conexión propia y persistente; el esquema (tabla mensajes) lo crean las migraciones de bd.py.
+        # Con `conn` se usa una ya abierta y migrada (la del arranque del servidor) en vez de abrir otra.
+        if conn is None:
+            conn = abrir(ruta)
+            migrar(conn)
+        self._conn = conn
+        self._sin_confirmar = 0
+        self._ultimo_commit = time.monotonic()
+
+    def guardar(self, alias, mensaje, destinatario="Todos"):
+        self.guardar_lote([(alias, mensaje, destinatario)])
+
+    def guardar_lote(self, mensajes):
+        # `mensajes` es una lista de tuplas (alias, mensaje, destinatario[, fecha]).
+        # Devuelve las filas guardadas como las lee ConsultasHistorial: (id, fecha, remitente, destinatario, mensaje).
+        filas = []
+        for mensaje in mensajes:
+            r = _registro(*mensaje)
+            filas.append((r["remitente"], r["destinatario"], r["mensaje"], r["fecha"],
+                          conversacion_de(r["remitente"], r["destinatario"])))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO mensajes(remitente, destinatario, mensaje, fecha, conversacion) VALUES (?, ?, ?, ?, ?)",
+                filas
+            )
+            # Mientras dura la transacción nadie más escribe: los ids del lote son consecutivos
+            ultimo = self._conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            self._sin_confirmar += len(filas)
+            if self._sin_confirmar >= self.lote or time.monotonic() - self._ultimo_commit >= self.intervalo:
+                self._sincronizar()
+            else:
+                self._programar_sincronizacion()
+        primero = ultimo - len(filas) + 1
+        return [(primero + i, fecha, remitente, destinatario, texto)
+                for i, (remitente, destinatario, texto, fecha, _) in enumerate(filas)]
+
+    def _sincronizar(self):
+        self._conn.commit()
+        self._sin_confirmar = 0
+        self._ultimo_commit = time.monotonic()
+
+    def sincronizar(self):
+        with self._lock:
+            self._sincronizar()
+
+    def cerrar(self):
+        with self._lock:
+            self._cerrado = True
+            self._sincronizar()
+            self._conn.close()
+
+
+# LECTURA DEL HISTORIAL
+# Páginas de la más nueva a la más vieja, con cursor: `antes` es el id del mensaje más viejo ya recibido y
+# la página siguiente son los `limite` anteriores a él. Así cada página es una lectura de índice, sin OFFSET.
+# Cada alias solo puede leer lo que le llegó o mandó:
+#   - conversacion ""      -> todo lo suyo: los mensajes a Todos, sus privados y los de sus `salas`
+#                             (lo que muestra el cliente)
+#   - conversacion "Todos" -> solo los públicos
+#   - conversacion <alias> -> los privados entre los dos
+#   - conversacion <#sala> -> los de la sala (el servidor chequea antes que sea miembro)
+# `salas` es {sala: fecha de entrada} (ver Salas.desde): de cada sala solo salen los mensajes posteriores
+# a la entrada del alias, así una sala vuelta a crear con el mismo nombre no muestra lo de antes.
+# `busqueda` filtra con el índice de texto completo (FTS5) dentro de lo mismo.
+MAX_PAGINA = 200
+
+_COLUMNAS = "m.id, m.fecha, m.remitente, m.destinatario, m.mensaje"
+
+
+class ConsultasHistorial:
+    def __init__(self, ruta=RUTA_BD, tamano_pool=4, recientes=None):
+        # Conexiones propias, solo de lectura: no compiten con la etapa de persistencia (WAL)
+        self.pool = PoolConexiones(ruta, tamano_pool)
+        self.recientes = recientes  # CacheRecientes para las primeras páginas (ver recientes.py), o None
+
+    def pagina(self, alias, conversacion="", antes=None, limite=50, busqueda="", salas=None, cache=True):
+        # Devuelve (filas, siguiente): filas de la más vieja a la más nueva y el cursor para pedir las
+        # anteriores, o None si ya no hay más. La primera página sin búsqueda sale de memoria si hay caché.
+        limite = max(1, min(int(limite), MAX_PAGINA))
+        salas = salas or {}
+        if cache and self.recientes is not None and not antes and not busqueda and limite <= self.recientes.cola:
+            filas = self.recientes.pagina(self.recientes.claves(alias, conversacion, salas), limite, self.cola)
+            # Si la caché trae mensajes de una sala de antes de que el alias entrara, la página sale de la BD
+            if not any(f[3].startswith("#") and f[1] < salas.get(f[3], "9999") for f in filas):
+                return filas, filas[0][0] if len(filas) == limite else None
+        antes = int(antes) if antes else (1 << 62)
+        if conversacion == "":
+            # Una lectura por índice (más una por sala), cada una con su propio límite, y se queda con las más nuevas
+            condiciones = ["m.conversacion = 'Todos'", "m.remitente = :alias", "m.destinatario = :alias"]
+            condiciones += [f"m.conversacion = :sala{i} AND m.fecha >= :desde{i}" for i in range(len(salas))]
+        elif conversacion.lower() == "todos":
+            condiciones = ["m.conversacion = 'Todos'"]
+        elif conversacion.startswith("#"):
+            condiciones = ["m.conversacion = :conversacion AND m.fecha >= :desde"]
+        else:
+            condiciones = ["m.conversacion = :conversacion"]
+
+        desde = "mensajes m"
+        filtro = ""
+        if busqueda:
+            # La búsqueda se toma como una frase literal (sin operadores de FTS5)
+            desde = "mensajes_fts f JOIN mensajes m ON m.id = f.rowid"
+            filtro = " AND mensajes_fts MATCH :busqueda"
+        partes = [
+            f"SELECT * FROM (SELECT {_COLUMNAS} FROM {desde} WHERE {c} AND m.id < :antes{filtro} "
+            f"ORDER BY m.id DESC LIMIT :limite)"
+            for c in condiciones
+        ]
+        sql = " UNION ".join(partes) + " ORDER BY id DESC LIMIT :limite"
+        parametros = {
+            "alias": alias,
+            "conversacion": conversacion_de(alias, conversacion),
+            "antes": antes,
+            "limite": limite,
+            "busqueda": '"' + busqueda.replace('"', '""') + '"',
+            # Una sala de la que no es miembro no devuelve nada (el servidor ya lo chequea antes)
+            "desde": salas.get(conversacion, "9999"),
+        }
+        for i, (sala, desde) in enumerate(salas.items()):
+            parametros[f"sala{i}"] = sala
+            parametros[f"desde{i}"] = desde
+        with self.pool.conexion() as conn:
+            filas = conn.execute(sql, parametros).fetchall()
+        filas.reverse()
+        siguiente = filas[0][0] if len(filas) == limite else None
+        return filas, siguiente
+
+    def cola(self, clave, cantidad):
+        # Las `cantidad` filas más nuevas de una cola de CacheRecientes, de la más vieja a la más nueva
+        tipo, valor = clave
+        if tipo == "conversacion":
+            sql = (f"SELECT {_COLUMNAS} FROM mensajes m WHERE m.conversacion = :valor "
+                   f"ORDER BY m.id DESC LIMIT :cantidad")
+        else:
+            sql = " UNION ".join(
+                f"SELECT * FROM (SELECT {_COLUMNAS} FROM mensajes m WHERE m.{columna} = :valor "
+                f"ORDER BY m.id DESC LIMIT :cantidad)"
+                for columna in ("remitente", "destinatario")
+            ) + " ORDER BY id DESC LIMIT :cantidad"
+        with self.pool.conexion() as conn:
+            filas = conn.execute(sql, {"valor": valor, "cantidad": cantidad}).fetchall()
+        filas.reverse()
+        return filas
+
+    def cerrar(self):
+        self.pool.cerrar()
+
+
+BACKENDS = {
+    "json": HistorialJSON,
+    "jsonl": HistorialJSONL,
+    "sqlite": HistorialSQLite,
+}
+
+
+def crear_historial(tipo="sqlite", **opciones):
+    if tipo not in BACKENDS:
+        raise ValueError(f"Backend de historial desconocido: {tipo} (opciones: {', '.join(BACKENDS)})")
+    return BACKENDS[tipo](**opciones)
+
+
+# MIGRACIÓN DE LOS *_chat.json EXISTENTES
+def migrar_json(destino, directorio=".", renombrar=True):
+    # Pasa cada {alias}_chat.json al backend `destino` (jsonl o sqlite) y, si `renombrar`,
+    # deja el original como {alias}_chat.json.migrado para que no se migre dos veces.
+    total = 0
+    for archivo in sorted(glob.glob(os.path.join(directorio, "*_chat.json"))):
+        with open(archivo, "r", encoding="utf-8") as f:
+            chat = json.load(f)
+        mensajes = [(m["remitente"], m["mensaje"], m.get("destinatario", "Todos"), m.get("fecha", "")) for m in chat]
+        destino.guardar_lote(mensajes)
+        destino.sincronizar()
+        if renombrar:
+            os.replace(archivo, archivo + ".migrado")
+        print(f"{archivo}: {len(mensajes)} mensajes migrados")
+        total += len(mensajes)
+    return total
+
+
+if __name__ == "__main__":
+    # Uso: python historial.py [sqlite|jsonl] [directorio]
+    tipo = sys.argv[1] if len(sys.argv) > 1 else "sqlite"
+    directorio = sys.argv[2] if len(sys.argv) > 2 else "."
+    if tipo == "sqlite":
+        destino = HistorialSQLite(os.path.join(directorio, RUTA_BD))
+    else:
+        destino = crear_historial(tipo, directorio=directorio)
+    total = migrar_json(destino, directorio)
+    destino.cerrar()
+    print(f"Migración terminada: {total} mensajes")
@@ -0,0 +1,314 @@
+import time
+import logging
+import threading
+from bisect import bisect_left
+
+import protocolo
+
+# MÉTRICAS DEL SERVIDOR
+# Contadores, histogramas y medidores en memoria, pensados para el camino caliente: cada observación es
+# un perf_counter(), un bisect y dos sumas bajo un lock propio de la métrica (nunca el lock global).
+# Se leen de tres formas:
+#   - texto()    formato de texto de Prometheus, servido en http://host:puerto/metrics (iniciar_http)
+#   - resumen()  diccionario con lo principal, para el panel de la interfaz gráfica
+#   - cada métrica por separado (valor(), percentil()) para benchmarks o pruebas
+# Los tiempos van en segundos y los tamaños en bytes, como pide la convención de Prometheus.
+
+log = logging.getLogger("chat.metricas")
+
+# Límites de los histogramas de tiempo: de 50 µs a 10 s
+LIMITES_TIEMPO = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                  0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Nombre legible de cada tipo de trama ("msg_all", "archivo_bloque", ...) para las etiquetas
+NOMBRES_TIPO = {v: k[2:].lower() for k, v in vars(protocolo).items() if k.startswith("T_") and isinstance(v, int)}
+
+_metricas = []
+
+
+class Contador:
+    # Valor que solo crece, opcionalmente separado por una etiqueta (una sola, para que siga siendo barato)
+    tipo = "counter"
+
+    def __init__(self, nombre, ayuda, etiqueta=None):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiqueta = etiqueta
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def sumar(self, cantidad=1, valor_etiqueta=None):
+        with self._lock:
+            self._valores[valor_etiqueta] = self._valores.get(valor_etiqueta, 0) + cantidad
+
+    def valor(self, valor_etiqueta=None):
+        if valor_etiqueta is None and self.etiqueta is not None:
+            return sum(self._valores.values())
+        return self._valores.get(valor_etiqueta, 0)
+
+    def _lineas(self):
+        with self._lock:
+            valores = sorted(self._valores.items(), key=lambda kv: str(kv[0]))
+        for clave, valor in valores:
+            yield f"{self.nombre}{_etiquetas(self.etiqueta, clave)} {valor}"
+
+
+class Histograma:
+    # Distribución en cubetas fijas (acumuladas al exportar, como las de Prometheus)
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiqueta=None, limites=LIMITES_TIEMPO):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiqueta = etiqueta
+        self.limites = limites
+        self._series = {}  # valor de etiqueta -> [cubetas, suma, cantidad]
+        self._lock = threading.Lock()
+
+    def observar(self, valor, valor_etiqueta=None):
+        i = bisect_left(self.limites, valor)
+        with self._lock:
+            serie = self._series.get(valor_etiqueta)
+            if serie is None:
+                serie = self._series[valor_etiqueta] = [[0] * (len(self.limites) + 1), 0.0, 0]
+            serie[0][i] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def medir(self, valor_etiqueta=None):
+        # with metricas.X.medir(): ... observa cuánto tardó el bloque
+        return _Cronometro(self, valor_etiqueta)
+
+    def cantidad(self, valor_etiqueta=None):
+        return sum(s[2] for e, s in self._series.items() if valor_etiqueta in (None, e))
+
+    def percentil(self, p, valor_etiqueta=None):
+        # Estimación: límite superior de la cubeta donde cae el percentil (None si no hay datos)
+        with self._lock:
+            series = [s for e, s in self._series.items() if valor_etiqueta in (None, e)]
+            cubetas = [sum(c) for c in zip(*(s[0] for s in series))]
+        total = sum(cubetas)
+        if not total:
+            return None
+        acumulado = 0
+        for i, cantidad in enumerate(cubetas):
+            acumulado += cantidad
+            if acumulado >= total * p:
+                return self.limites[i] if i < len(self.limites) else float("inf")
+
+    def _lineas(self):
+        with self._lock:
+            series = sorted(((e, [list(s[0]), s[1], s[2]]) for e, s in self._series.items()),
+                            key=lambda kv: str(kv[0]))
+        for clave, (cubetas, suma, cantidad) in series:
+            acumulado = 0
+            for limite, n in zip(self.limites + ("+Inf",), cubetas):
+                acumulado += n
+                yield f"{self.nombre}_bucket{_etiquetas(self.etiqueta, clave, le=limite)} {acumulado}"
+            yield f"{self.nombre}_sum{_etiquetas(self.etiqueta, clave)} {suma:.6f}"
+            yield f"{self.nombre}_count{_etiquetas(self.etiqueta, clave)} {cantidad}"
+
+
+class Medidor:
+    # Valor instantáneo que se calcula recién al leerlo (profundidad de una cola, clientes conectados...)
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, funcion):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.funcion = funcion
+
+    def valor(self):
+        try:
+            return self.funcion()
+        except Exception:
+            return None
+
+    def _lineas(self):
+        valor = self.valor()
+        if valor is not None:
+            yield f"{self.nombre} {valor}"
+
+
+class _Cronometro:
+    __slots__ = ("histograma", "etiqueta", "inicio")
+
+    def __init__(self, histograma, etiqueta):
+        self.histograma = histograma
+        self.etiqueta = etiqueta
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histograma.observar(time.perf_counter() - self.inicio, self.etiqueta)
+
+
+class LockMedido:
+    # threading.Lock que además mide cuánto esperó cada hilo para tomarlo. Si el lock está libre
+    # (lo normal) solo se cuenta la adquisición; el reloj se consulta únicamente cuando hay que esperar.
+    def __init__(self, histograma, contador):
+        self._lock = threading.Lock()
+        self.histograma = histograma
+        self.contador = contador
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self.contador.sumar(1, "libre")
+            return True
+        if not blocking:
+            return False
+        inicio = time.perf_counter()
+        tomado = self._lock.acquire(True, timeout)
+        if tomado:
+            self.contador.sumar(1, "disputado")
+            self.histograma.observar(time.perf_counter() - inicio)
+        return tomado
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def _etiquetas(nombre, valor, le=None):
+    partes = []
+    if nombre is not None and valor is not None:
+        partes.append(f'{nombre}="{str(valor)}"')
+    if le is not None:
+        partes.append(f'le="{le}"')
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+
+def contador(nombre, ayuda, etiqueta=None):
+    metrica = Contador(nombre, ayuda, etiqueta)
+    _metricas.append(metrica)
+    return metrica
+
+
+def histograma(nombre, ayuda, etiqueta=None, limites=LIMITES_TIEMPO):
+    metrica = Histograma(nombre, ayuda, etiqueta, limites)
+    _metricas.append(metrica)
+    return metrica
+
+
+def medidor(nombre, ayuda, funcion):
+    # Si ya existe un medidor con ese nombre se reemplaza su función (servidor.preparar puede registrarlo de nuevo)
+    for metrica in _metricas:
+        if metrica.nombre == nombre:
+            metrica.funcion = funcion
+            return metrica
+    metrica = Medidor(nombre, ayuda, funcion)
+    _metricas.append(metrica)
+    return metrica
+
+
+# MÉTRICAS DEL CHAT
+mensajes_recibidos = contador("chat_mensajes_recibidos_total", "Tramas recibidas de los clientes", "tipo")
+bytes_entrada = contador("chat_bytes_entrada_total", "Bytes recibidos de los clientes (cabecera incluida)")
+bytes_salida = contador("chat_bytes_salida_total", "Bytes escritos en los sockets de los clientes")
+escrituras = contador("chat_escrituras_socket_total", "Llamadas de escritura de los escritores (un lote vectorial cuenta una)")
+entregas = contador("chat_entregas_total", "Mensajes encolados para algún cliente", "tipo")
+handshake = histograma("chat_handshake_segundos", "Desde que se acepta la conexión hasta que el alias queda registrado")
+procesamiento = histograma("chat_procesar_segundos", "Tiempo de procesar_mensajes por mensaje", "tipo")
+reparto = histograma("chat_reparto_segundos", "Tiempo de broadcast / enviar_privado / enviar_archivo", "tipo")
+envio = histograma("chat_envio_segundos", "Tiempo del escritor de un cliente en mandar un lote al socket")
+escritura = histograma("chat_escritura_segundos", "Latencia de escritura de la etapa de persistencia", "destino")
+consultas = histograma("chat_historial_consulta_segundos", "Consultas de páginas del historial", "tipo")
+cache_historial = contador("chat_cache_historial_total", "Colas recientes del historial leídas de memoria, cargadas de la BD o desalojadas", "evento")
+espera_lock = histograma("chat_lock_espera_segundos", "Espera para tomar el lock del registro de clientes cuando estaba ocupado")
+adquisiciones_lock = contador("chat_lock_adquisiciones_total", "Veces que se tomó el lock del registro de clientes", "estado")
+reanudaciones = contador("chat_sesiones_total", "Reanudaciones aceptadas o rechazadas y sesiones vencidas", "resultado")
+buzon = contador("chat_buzon_total", "Mensajes del buzón de desconectados por evento", "evento")
+limites = contador("chat_limites_total", "Mensajes descartados, lecturas frenadas y conexiones cortadas por los límites", "motivo")
+repetidos = contador("chat_mensajes_repetidos_total", "Mensajes reenviados desde el anillo de una sesión al reanudar")
+acuses = contador("chat_acuses_total", "Acuses mandados a los remitentes de mensajes con id", "estado")
+duplicados = contador("chat_mensajes_duplicados_total", "Mensajes con un id ya visto (reintentos): no se repartieron otra vez")
+entrega = histograma("chat_entrega_segundos", "Desde que el servidor acepta un privado con id hasta que llega el recibo del destinatario")
+
+
+def recibido(trama):
+    # Gancho de los ciclos de recepción (manejar_cliente en los dos modos)
+    mensajes_recibidos.sumar(1, NOMBRES_TIPO.get(trama.tipo, trama.tipo))
+    bytes_entrada.sumar(len(trama.carga) + protocolo.CABECERA.size)
+
+
+def texto():
+    lineas = []
+    for metrica in _metricas:
+        lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+        lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+        lineas.extend(metrica._lineas())
+    return "\n".join(lineas) + "\n"
+
+
+def valor(nombre):
+    # Valor de un medidor por nombre (None si no existe o falla)
+    for metrica in _metricas:
+        if metrica.nombre == nombre and isinstance(metrica, Medidor):
+            return metrica.valor()
+    return None
+
+
+def resumen():
+    # Lo que muestra el panel de la interfaz: totales y percentiles ya calculados
+    def ms(segundos):
+        return None if segundos is None else round(segundos * 1000, 2)
+    return {
+        "conectados": valor("chat_clientes_conectados"),
+        "cola_mensajes": valor("chat_cola_mensajes"),
+        "persistencia_pendiente": valor("chat_persistencia_pendiente"),
+        "mensajes": mensajes_recibidos.valor(),
+        "bytes_entrada": bytes_entrada.valor(),
+        "bytes_salida": bytes_salida.valor(),
+        "lock_disputado": adquisiciones_lock.valor("disputado"),
+        "lock_espera_p99_ms": ms(espera_lock.percentil(0.99)),
+        "handshake_p50_ms": ms(handshake.percentil(0.50)),
+        "handshake_p99_ms": ms(handshake.percentil(0.99)),
+        "reparto_p99_ms": ms(reparto.percentil(0.99)),
+        "envio_p99_ms": ms(envio.percentil(0.99)),
+        "escritura_p99_ms": ms(escritura.percentil(0.99)),
+        "limitados": limites.valor(),
+        "duplicados": duplicados.valor(),
+        "entrega_p99_ms": ms(entrega.percentil(0.99)),
+    }
+
+
+# ENDPOINT HTTP
+# http.server (y lo que arrastra: email, ssl, ...) se importa recién al abrir el endpoint: es buena parte
+# del tiempo de importar el servidor y atender clientes no lo necesita.
+def _manejador():
+    from http.server import BaseHTTPRequestHandler
+
+    class _Manejador(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            cuerpo = texto().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, formato, *args):
+            log.debug(formato, *args)
+
+    return _Manejador
+
+
+def iniciar_http(host="127.0.0.1", puerto=9010):
+    # Sirve /metrics en un hilo aparte. Por defecto solo en la máquina local.
+    from http.server import ThreadingHTTPServer
+    servidor = ThreadingHTTPServer((host, puerto), _manejador())
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="metricas", daemon=True).start()
+    log.info("Métricas en http://%s:%s/metrics", host, puerto)
+    return servidor
@@ -0,0 +1,105 @@
+import time
+import logging
+import threading
+from queue import Queue, Empty
+
+import metricas
+from bd import RUTA_BD, abrir, ahora, aplicar_conexiones
+
+# ETAPA DE PERSISTENCIA EN SEGUNDO PLANO (WRITE-BEHIND)
+# La entrega de mensajes ya no espera al disco: el historial de mensajes y el registro de
+# conexiones se dejan en una cola y un hilo propio los escribe en lotes, cada `lote` operaciones
+# o cada `intervalo` segundos, lo que pase primero. Cada lote de conexiones es una sola transacción.
+# Con `conn` el registro de conexiones usa una conexión ya abierta (la del arranque, que con el backend
+# sqlite es también la del historial: las dos se usan solo desde este hilo) en vez de abrir otra.
+
+_FIN = object()
+
+log = logging.getLogger("chat.persistencia")
+
+
+class EtapaPersistencia:
+    def __init__(self, historial, ruta_bd=RUTA_BD, lote=500, intervalo=0.2, conn=None):
+        self.historial = historial
+        self.ruta_bd = ruta_bd
+        self.conn = conn
+        self.lote = lote
+        self.intervalo = intervalo
+        self._cola = Queue()
+        self._hilo = None
+        self.al_escribir = None  # recibe cada lote de mensajes ya confirmado, con sus ids (ver recientes.py)
+        self.lotes_escritos = 0
+        self.operaciones_escritas = 0
+
+    # Operaciones (no bloquean: solo encolan, con la fecha del momento en que ocurrieron)
+    def guardar_mensaje(self, alias, mensaje, destinatario="Todos"):
+        self._cola.put(("mensaje", (alias, mensaje, destinatario, ahora())))
+
+    def registrar_conexion(self, alias, codigo, ip):
+        self._cola.put(("conexion", (alias, codigo, ip, ahora())))
+
+    def registrar_desconexion(self, alias):
+        self._cola.put(("desconexion", (ahora(), alias)))
+
+    def backlog(self):
+        # Operaciones encoladas que todavía no llegaron al disco
+        return self._cola.qsize()
+
+    # Ciclo de vida
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._trabajar, name="persistencia", daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self, timeout=10.0):
+        # Vacía todo lo pendiente antes de terminar
+        if self._hilo and self._hilo.is_alive():
+            self._cola.put(_FIN)
+            self._hilo.join(timeout)
+
+    def _trabajar(self):
+        conn = self.conn if self.conn is not None else abrir(self.ruta_bd)
+        terminar = False
+        while not terminar:
+            primero = self._cola.get()
+            if primero is _FIN:
+                break
+            lote = [primero]
+            limite = time.monotonic() + self.intervalo
+            # Junta más operaciones hasta llenar el lote o vencer el intervalo
+            while len(lote) < self.lote:
+                restante = limite - time.monotonic()
+                try:
+                    op = self._cola.get(timeout=restante) if restante > 0 else self._cola.get_nowait()
+                except Empty:
+                    break
+                if op is _FIN:
+                    terminar = True
+                    break
+                lote.append(op)
+            try:
+                self._escribir(conn, lote)
+            except Exception as e:
+                log.error("Error al persistir %d operaciones: %s", len(lote), e)
+        # Primero el historial, que confirma lo pendiente (puede estar usando esta misma conexión)
+        self.historial.cerrar()
+        conn.close()
+
+    def _escribir(self, conn, lote):
+        mensajes = [datos for tipo, datos in lote if tipo == "mensaje"]
+        conexiones = [(tipo, datos) for tipo, datos in lote if tipo != "mensaje"]
+
+        if mensajes:
+            with metricas.escritura.medir("historial"):
+                filas = self.historial.guardar_lote(mensajes)
+                self.historial.sincronizar()
+            if filas and self.al_escribir is not None:
+                self.al_escribir(filas)
+
+        if conexiones:
+            # Se respeta el orden original: una desconexión nunca se aplica antes de su conexión
+            with metricas.escritura.medir("conexiones"), conn:
+                aplicar_conexiones(conn, conexiones)
+
+        self.lotes_escritos += 1
+        self.operaciones_escritas += len(lote)
@@ -0,0 +1,151 @@
+import threading
+
+from protocolo import (
+    ErrorProtocolo, codificar_para, empaquetar_campos, SEPARADOR, MODO_LEGADO,
+    T_LISTA_USUARIOS, T_PRESENCIA_FOTO, T_PRESENCIA_CAMBIOS
+)
+
+# PRESENCIA (QUIÉN ESTÁ CONECTADO)
+# Antes cada conexión o desconexión le mandaba la lista completa a todos: O(N²) en una avalancha de logins.
+# Ahora cada cliente recibe una sola vez la foto completa (al entrar) y después solo los cambios:
+#   FOTO:    secuencia, "codigo|alias", "codigo|alias", ...
+#   CAMBIOS: secuencia, "+codigo|alias" (entró), "-alias" (salió), ...
+# Los cambios de una ráfaga se juntan durante `espera` segundos y viajan en una sola trama; si alguien
+# entra y sale dentro de la misma ventana no se publica nada. La secuencia aumenta de a uno por trama
+# de cambios: el cliente ignora lo que ya está en su foto y, si detecta un salto, pide la foto otra vez.
+# Los clientes viejos no entienden cambios: siguen recibiendo la lista completa, pero una vez por ráfaga.
+
+ESPERA_PRESENCIA = 0.05
+
+
+def _entrada(alias, codigo):
+    return f"{codigo}|{alias}"
+
+
+class Presencia:
+    # `destinatarios` es la función de servidor.py que devuelve la foto [(alias, info)] de los clientes.
+    # unir() y salir() se llaman con el lock de `clientes` tomado, así la presencia sigue el mismo orden.
+    def __init__(self, destinatarios, espera=ESPERA_PRESENCIA):
+        self.destinatarios = destinatarios
+        self.espera = espera
+        self.secuencia = 0
+        self._miembros = {}     # alias -> codigo: el estado real
+        self._publicados = {}   # alias -> codigo: lo que ya saben los clientes a la secuencia actual
+        self._cambiados = set()
+        self._lock = threading.Lock()
+        self._lock_publicar = threading.Lock()  # las tramas de cambios se encolan siempre en orden
+        self._timer = None
+        self.fotos_enviadas = 0
+        self.cambios_publicados = 0
+
+    def unir(self, alias, codigo):
+        with self._lock:
+            self._miembros[alias] = codigo
+            self._marcar(alias)
+
+    def salir(self, alias):
+        with self._lock:
+            self._miembros.pop(alias, None)
+            self._marcar(alias)
+
+    def _marcar(self, alias):
+        self._cambiados.add(alias)
+        if self._timer is None:
+            self._timer = threading.Timer(self.espera, self.publicar)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def enviar_foto(self, info):
+        # Foto de lo ya publicado, con su secuencia: los cambios siguientes se aplican encima
+        with self._lock:
+            if info["conn"].modo == MODO_LEGADO:
+                datos = info["conn"].codificar(T_LISTA_USUARIOS, self._lista())
+            else:
+                datos = info["conn"].codificar(T_PRESENCIA_FOTO, empaquetar_campos(
+                    str(self.secuencia), *(_entrada(a, c) for a, c in self._publicados.items())))
+            self.fotos_enviadas += 1
+        info["salida"].encolar(datos, bloquear=False)
+
+    def _lista(self):
+        return ",".join(_entrada(a, c) for a, c in self._publicados.items())
+
+    def publicar(self):
+        with self._lock_publicar:
+            with self._lock:
+                self._timer = None
+                cambios = []
+                for alias in self._cambiados:
+                    actual = self._miembros.get(alias)
+                    if actual == self._publicados.get(alias):
+                        continue
+                    if actual is None:
+                        del self._publicados[alias]
+                        cambios.append(f"-{alias}")
+                    else:
+                        self._publicados[alias] = actual
+                        cambios.append("+" + _entrada(alias, actual))
+                self._cambiados.clear()
+                if not cambios:
+                    return
+                self.secuencia += 1
+                self.cambios_publicados += len(cambios)
+                carga = empaquetar_campos(str(self.secuencia), *cambios)
+                lista = self._lista()
+
+            # Se codifica una sola vez por modo y compresión, y los mismos bytes se comparten entre todos
+            codificados = {}
+            for alias, info in self.destinatarios():
+                clave = (info["conn"].modo, info["conn"].codec)
+                if clave not in codificados:
+                    if clave[0] == MODO_LEGADO:
+                        codificados[clave] = codificar_para(MODO_LEGADO, T_LISTA_USUARIOS, lista)
+                    else:
+                        codificados[clave] = codificar_para(clave[0], T_PRESENCIA_CAMBIOS, carga, codec=clave[1])
+                info["salida"].encolar(codificados[clave], bloquear=False)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "conectados": len(self._miembros),
+                "secuencia": self.secuencia,
+                "fotos_enviadas": self.fotos_enviadas,
+                "cambios_publicados": self.cambios_publicados,
+            }
+
+
+# LADO CLIENTE
+class VistaPresencia:
+    # Aplica la foto y los cambios en orden. Cada método devuelve qué cambió para actualizar la interfaz
+    # sin reconstruir la lista entera.
+    def __init__(self):
+        self.secuencia = None
+        self.usuarios = {}  # alias -> codigo
+
+    def foto(self, carga):
+        secuencia, *entradas = carga.decode("utf-8").split(SEPARADOR.decode())
+        self.secuencia = int(secuencia)
+        self.usuarios = {}
+        for entrada in entradas:
+            codigo, alias = entrada.split("|", 1)
+            self.usuarios[alias] = codigo
+        return self.usuarios
+
+    def cambios(self, carga):
+        # Devuelve [(alias, codigo o None si salió)]; lanza ErrorProtocolo si se perdió una trama de cambios
+        secuencia, *entradas = carga.decode("utf-8").split(SEPARADOR.decode())
+        secuencia = int(secuencia)
+        if self.secuencia is None or secuencia <= self.secuencia:
+            return []  # todavía no llegó la foto, o ya está incluido en ella
+        if secuencia != self.secuencia + 1:
+            anterior, self.secuencia = self.secuencia, None  # lo que llegue hasta la nueva foto se ignora
+            raise ErrorProtocolo(f"Se perdieron cambios de presencia ({secuencia} después de {anterior})")
+        self.secuencia = secuencia
+        aplicados = []
+        for entrada in entradas:
+            if entrada.startswith("+"):
+                codigo, alias = entrada[1:].split("|", 1)
+                self.usuarios[alias] = codigo
+                aplicados.append((alias, codigo))
+            elif self.usuarios.pop(entrada[1:], None) is not None:
+                aplicados.append((entrada[1:], None))
+        return aplicados
@@ -0,0 +1,319 @@
+import time
+import struct
+import socket
+import base64
+import threading
+from collections import deque, namedtuple
+
+import compresion
+
+# PROTOCOLO DE TRAMAS COMPARTIDO (CLIENTE Y SERVIDOR)
+# Cada trama lleva una cabecera fija de 8 bytes:
+#   magia (1) | versión (1) | tipo (1) | flags (1) | longitud de la carga (4, big endian)
+# seguida de la carga. Así ya no dependemos de que cada recv() coincida con un mensaje completo.
+
+VERSION = 1
+MAGIA = 0xFF  # 0xFF nunca aparece en UTF-8 -> distingue una trama del protocolo de texto antiguo
+CABECERA = struct.Struct("!BBBBI")
+MAX_CARGA = 64 * 1024 * 1024  # límite de seguridad por trama
+
+# Tipos de trama
+T_ALIAS = 1             # cliente -> servidor: alias propuesto | servidor -> cliente: pedir alias
+T_BIENVENIDA = 2        # servidor -> cliente: alias aceptado
+T_ALIAS_OCUPADO = 3     # servidor -> cliente: alias repetido
+T_MSG_ALL = 4           # cliente -> servidor: mensaje público
+T_MSG_PRIVADO = 5       # cliente -> servidor: destinatario + mensaje
+T_ARCHIVO = 6           # archivo completo (destinatario/remitente, nombre, bytes)
+T_LISTA_USUARIOS = 7    # servidor -> cliente: lista "codigo|alias"
+T_TEXTO = 8             # servidor -> cliente: texto para mostrar tal cual
+T_SALIR = 9             # cliente -> servidor: desconexión
+# Transferencia de archivos por bloques (ver transferencias.py)
+T_ARCHIVO_INICIO = 10   # id, destinatario/remitente, nombre, tamaño
+T_ARCHIVO_BLOQUE = 11   # id, offset, crc32 y los datos del bloque
+T_ARCHIVO_ACK = 12      # id, offset confirmado (todo lo anterior ya está en disco)
+T_ARCHIVO_FIN = 13      # id, sha256 del archivo completo
+T_ARCHIVO_ERROR = 14    # id, motivo
+# Archivos compartidos por referencia (ver almacen.py)
+T_ARCHIVO_REF = 15      # servidor -> cliente: remitente, nombre, sha256, tamaño (sin el contenido)
+T_ARCHIVO_PEDIR = 16    # cliente -> servidor, en una conexión aparte: sha256, offset desde donde leer
+T_ARCHIVO_DATOS = 17    # servidor -> cliente: sha256, tamaño total; detrás va el contenido en crudo
+# Presencia (ver presencia.py)
+T_PRESENCIA_FOTO = 18     # servidor -> cliente: secuencia + todos los "codigo|alias" | cliente -> servidor: pedir la foto
+T_PRESENCIA_CAMBIOS = 19  # servidor -> cliente: secuencia + "+codigo|alias" / "-alias"
+# Historial por páginas (ver historial.ConsultasHistorial)
+T_HISTORIAL_PEDIR = 20    # cliente -> servidor: conversación ("" / "Todos" / alias), cursor, límite, búsqueda
+T_HISTORIAL_PAGINA = 21   # servidor -> cliente: conversación, cursor siguiente ("" = no hay más), "id|fecha|remitente|destinatario|mensaje"...
+T_REANUDAR = 22           # cliente -> servidor, en lugar de T_ALIAS: alias, token de sesión, última secuencia (ver sesiones.py)
+T_SALA = 23               # cliente -> servidor: crear/unir/salir + "#sala" | servidor -> cliente: respuestas y presencia de la sala (ver salas.py)
+T_LIMITE = 24             # servidor -> cliente: motivo, segundos para reintentar, texto (ver admision.py)
+# Ids de mensaje y acuses (ver acuses.py)
+T_ACUSE = 25              # servidor -> cliente: id, estado (aceptado/rechazado/entregado), detalle
+T_RECIBO = 26             # cliente -> servidor: remitente, id de un T_MSG_CON_ID que ya llegó
+T_MSG_CON_ID = 27         # servidor -> cliente: remitente, id, texto para mostrar (un privado que espera recibo)
+
+# En T_ALIAS y T_BIENVENIDA: el cliente / servidor entiende ids y acuses. En T_MSG_ALL y T_MSG_PRIVADO:
+# la carga empieza con el id del mensaje. No choca con los bits de compresion.MASCARA.
+F_ACUSE = 0x80
+
+# Tramas cuya carga puede viajar comprimida (ver compresion.py). En T_ALIAS y T_BIENVENIDA los flags
+# no indican compresión: llevan la negociación de códecs.
+TIPOS_COMPRIMIBLES = frozenset({
+    T_MSG_ALL, T_MSG_PRIVADO, T_ARCHIVO, T_LISTA_USUARIOS, T_TEXTO, T_ARCHIVO_BLOQUE,
+    T_PRESENCIA_FOTO, T_PRESENCIA_CAMBIOS, T_HISTORIAL_PAGINA, T_MSG_CON_ID,
+})
+TIPOS_ARCHIVO = (T_ARCHIVO, T_ARCHIVO_BLOQUE)
+
+# Modos de una conexión
+MODO_TRAMAS = "tramas"
+MODO_LEGADO = "legado"
+
+SEPARADOR = b"\x00"
+RECV_TRAMAS = 64 * 1024
+RECV_LEGADO = 10_000_000  # el protocolo viejo asume un mensaje por recv(), se mantiene igual
+IOV_MAXIMO = 1024         # buffers por sendmsg (límite de writev en Linux)
+
+Trama = namedtuple("Trama", ["tipo", "flags", "carga"])
+
+
+class ErrorProtocolo(Exception):
+    pass
+
+
+def empaquetar_campos(*campos):
+    # Une campos de texto/bytes con el separador nulo. El último campo puede ser binario.
+    partes = []
+    for campo in campos:
+        if isinstance(campo, str):
+            campo = campo.encode("utf-8")
+        partes.append(campo)
+    return SEPARADOR.join(partes)
+
+
+def desempaquetar_campos(carga, cantidad):
+    # Separa la carga en `cantidad` campos; los primeros se devuelven como texto y el último como bytes.
+    partes = carga.split(SEPARADOR, cantidad - 1)
+    if len(partes) != cantidad:
+        raise ErrorProtocolo(f"Se esperaban {cantidad} campos y llegaron {len(partes)}")
+    return [p.decode("utf-8") for p in partes[:-1]] + [partes[-1]]
+
+
+def codificar_trama(tipo, carga=b"", flags=0):
+    if isinstance(carga, str):
+        carga = carga.encode("utf-8")
+    if len(carga) > MAX_CARGA:
+        raise ErrorProtocolo(f"Trama demasiado grande ({len(carga)} bytes)")
+    return CABECERA.pack(MAGIA, VERSION, tipo, flags, len(carga)) + carga
+
+
+class DecodificadorTramas:
+    # Decodificación incremental: se le van pasando bytes tal como llegan del socket
+    # y devuelve solo las tramas completas; lo que sobra queda en el búfer para la próxima vez.
+    def __init__(self):
+        self._bufer = bytearray()
+
+    def alimentar(self, datos):
+        self._bufer += datos
+        tramas = []
+        while len(self._bufer) >= CABECERA.size:
+            magia, version, tipo, flags, longitud = CABECERA.unpack_from(self._bufer)
+            if magia != MAGIA:
+                raise ErrorProtocolo("Byte mágico inválido")
+            if version > VERSION:
+                raise ErrorProtocolo(f"Versión de protocolo no soportada: {version}")
+            if longitud > MAX_CARGA:
+                raise ErrorProtocolo(f"Trama demasiado grande ({longitud} bytes)")
+            fin = CABECERA.size + longitud
+            if len(self._bufer) < fin:
+                break
+            carga = bytes(self._bufer[CABECERA.size:fin])
+            del self._bufer[:fin]
+            if flags & compresion.MASCARA and tipo in TIPOS_COMPRIMIBLES:
+                try:
+                    carga = compresion.descomprimir(flags, carga, MAX_CARGA)
+                except Exception as e:
+                    raise ErrorProtocolo(f"Carga comprimida inválida: {e}")
+                flags &= ~compresion.MASCARA
+            tramas.append(Trama(tipo, flags, carga))
+        return tramas
+
+    def pendiente(self):
+        return len(self._bufer)
+
+
+# COMPATIBILIDAD CON EL PROTOCOLO DE TEXTO ANTIGUO
+def desde_legado(texto):
+    # Convierte un mensaje de texto viejo (MSG_ALL:, MSG_PRIVATE:, FILE:, salir) en una trama.
+    if texto.lower() == "salir":
+        return Trama(T_SALIR, 0, b"")
+
+    if texto.startswith("MSG_ALL:"):
+        return Trama(T_MSG_ALL, 0, texto[len("MSG_ALL:"):].encode("utf-8"))
+
+    if texto.startswith("MSG_PRIVATE:"):
+        partes = texto.split(":", 2)
+        if len(partes) == 3:
+            return Trama(T_MSG_PRIVADO, 0, empaquetar_campos(partes[1], partes[2]))
+
+    if texto.startswith("FILE:"):
+        partes = texto.split(":", 3)
+        if len(partes) == 4:
+            try:
+                contenido = base64.b64decode(partes[3])
+            except Exception:
+                return None
+            return Trama(T_ARCHIVO, 0, empaquetar_campos(partes[1], partes[2], contenido))
+
+    return None
+
+
+def a_legado(tipo, carga):
+    # Convierte una trama del servidor al texto que espera un cliente viejo.
+    if tipo == T_ARCHIVO:
+        remitente, nombre, contenido = desempaquetar_campos(carga, 3)
+        texto = f"FILE:{remitente}:{nombre}:{base64.b64encode(contenido).decode('utf-8')}"
+    elif tipo == T_ALIAS_OCUPADO:
+        texto = "ALIAS_TAKEN"
+    elif tipo == T_SALA:
+        texto = ": ".join(campo.decode("utf-8") for campo in carga.split(SEPARADOR))
+    elif tipo in (T_LIMITE, T_MSG_CON_ID):
+        texto = carga.split(SEPARADOR)[-1].decode("utf-8")
+    else:
+        texto = carga.decode("utf-8")
+    return texto.encode("utf-8")
+
+
+def _nombre_archivo(carga):
+    # Nombre de un T_ARCHIVO (destinatario, nombre, contenido) sin copiar el contenido
+    inicio = carga.find(SEPARADOR) + 1
+    return carga[inicio:carga.find(SEPARADOR, inicio)].decode("utf-8", "ignore")
+
+
+def codificar_para(modo, tipo, carga=b"", flags=0, codec=None):
+    # Codifica un mensaje según el modo de la conexión destino (tramas o texto viejo).
+    # `codec` es el compresor negociado con esa conexión (None = sin compresión).
+    if isinstance(carga, str):
+        carga = carga.encode("utf-8")
+    if modo == MODO_LEGADO:
+        return a_legado(tipo, carga)
+    if codec is not None and tipo in TIPOS_COMPRIMIBLES:
+        nombre = _nombre_archivo(carga) if tipo == T_ARCHIVO else ""
+        carga, bandera = codec.intentar(carga, tipo in TIPOS_ARCHIVO, nombre)
+        flags |= bandera
+    return codificar_trama(tipo, carga, flags)
+
+
+class TramaCompartida:
+    # Un mismo mensaje para muchos destinatarios (broadcast, referencias de archivos): se codifica una
+    # sola vez por combinación de modo y compresión, y todas las colas de salida comparten esos bytes
+    __slots__ = ("tipo", "carga", "_codificadas")
+
+    def __init__(self, tipo, carga):
+        self.tipo = tipo
+        self.carga = carga.encode("utf-8") if isinstance(carga, str) else carga
+        self._codificadas = {}
+
+    def para(self, conexion):
+        clave = (conexion.modo, conexion.codec)
+        datos = self._codificadas.get(clave)
+        if datos is None:
+            datos = self._codificadas[clave] = codificar_para(conexion.modo, self.tipo, self.carga, codec=conexion.codec)
+        return datos
+
+
+def enviar_vector(sock, partes):
+    # Manda varias tramas con sendmsg (writev): una llamada al sistema para todo el lote en vez de una
+    # por trama. sendmsg puede escribir solo una parte; se sigue desde donde quedó. Devuelve las llamadas.
+    pendientes = deque(memoryview(p) for p in partes if p)
+    llamadas = 0
+    while pendientes:
+        enviados = sock.sendmsg([pendientes[i] for i in range(min(len(pendientes), IOV_MAXIMO))])
+        llamadas += 1
+        while enviados:
+            primera = pendientes[0]
+            if enviados >= primera.nbytes:
+                enviados -= primera.nbytes
+                pendientes.popleft()
+            else:
+                pendientes[0] = primera[enviados:]
+                enviados = 0
+    return llamadas
+
+
+class Conexion:
+    # Envuelve un socket y habla el protocolo de tramas o, si el otro extremo es viejo, el de texto.
+    def __init__(self, sock, modo=MODO_TRAMAS, plazo=None):
+        self.sock = sock
+        self.modo = modo
+        self.codec = None  # compresión negociada en el handshake (compresion.Codec)
+        self.acuses = False  # el cliente ofreció F_ACUSE: entiende ids de mensaje y recibos (ver acuses.py)
+        self.plazo = plazo  # instante (time.monotonic) en que vence el handshake; None = sin límite
+        self._decodificador = DecodificadorTramas()
+        self._pendientes = deque()
+        self._lock_envio = threading.Lock()
+
+    def codificar(self, tipo, carga=b"", flags=0):
+        return codificar_para(self.modo, tipo, carga, flags, self.codec)
+
+    def enviar_bytes(self, datos):
+        with self._lock_envio:
+            self.sock.sendall(datos)
+
+    def enviar_varios(self, partes):
+        # Varias tramas de una vez; devuelve cuántas llamadas de escritura hicieron falta
+        if len(partes) == 1 or not hasattr(self.sock, "sendmsg"):
+            self.enviar_bytes(b"".join(partes))
+            return 1
+        with self._lock_envio:
+            return enviar_vector(self.sock, partes)
+
+    def enviar(self, tipo, carga=b"", flags=0):
+        self.enviar_bytes(self.codificar(tipo, carga, flags))
+
+    def alimentar(self, datos):
+        # Permite reinyectar bytes ya leídos del socket (por ejemplo durante la detección de modo).
+        self._pendientes.extend(self._decodificador.alimentar(datos))
+
+    def recibir_bytes(self, tamano):
+        # recv() que, con un plazo puesto, no espera más allá de ese instante (socket.timeout).
+        # Es un plazo para todo el handshake, no por lectura: mandar de a un byte no lo estira.
+        if self.plazo is not None:
+            restante = self.plazo - time.monotonic()
+            if restante <= 0:
+                raise socket.timeout("Se venció el plazo del handshake")
+            self.sock.settimeout(restante)
+        return self.sock.recv(tamano)
+
+    def quitar_plazo(self):
+        self.plazo = None
+        self.sock.settimeout(None)
+
+    def recibir(self):
+        # Devuelve la siguiente trama completa, o None si el otro extremo cerró la conexión.
+        if self.modo == MODO_LEGADO:
+            while True:
+                datos = self.recibir_bytes(RECV_LEGADO)
+                if not datos:
+                    return None
+                trama = desde_legado(datos.decode("utf-8"))
+                if trama is not None:
+                    return trama
+
+        while not self._pendientes:
+            datos = self.recibir_bytes(RECV_TRAMAS)
+            if not datos:
+                return None
+            self.alimentar(datos)
+        return self._pendientes.popleft()
+
+    def close(self):
+        # shutdown() despierta a un hilo que esté bloqueado en recv() sobre este socket
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def es_trama(datos):
+    # True si los primeros bytes recibidos pertenecen al protocolo de tramas.
+    return len(datos) > 0 and datos[0] == MAGIA
@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict, deque
+
+import metricas
+from bd import conversacion_de
+
+# COLAS RECIENTES DEL HISTORIAL, EN MEMORIA
+# Lo que más se pide del historial es la primera página: la que carga el cliente al conectarse (conversación
+# "") y la de una conversación o sala cuando se abre. En vez de ir a SQLite cada vez, se guardan en memoria
+# los últimos `cola` mensajes de cada conversación ("Todos", "ana|beto", "#sala") y de cada alias (lo que
+# mandó o le llegó), y la primera página se arma juntando colas:
+#   - conversación ""      -> Todos + la cola del alias + la de cada sala suya (la misma unión que la consulta)
+#   - cualquier otra       -> la cola de esa conversación
+# Cada cola se carga de la BD la primera vez que hace falta (cuando ese usuario pide su historial, o sea al
+# conectarse) y después se mantiene sola: la etapa de persistencia avisa cada lote ya confirmado, con sus
+# ids, y se agrega a las colas que estén cargadas. La carga se hace con el lock tomado: un lote que se
+# confirma mientras tanto se agrega después, y lo repetido se reconoce por el id.
+# Las colas viven en un LRU con un presupuesto de memoria (bytes aproximados); al pasarse se desalojan las
+# que hace más tiempo nadie pide. Las páginas con cursor, las búsquedas y las de más de `cola` filas siguen
+# yendo a la BD.
+
+SOBRECARGA_FILA = 300  # bytes aproximados de la tupla, el id y los objetos str, además del texto
+
+
+def tamano_fila(fila):
+    return SOBRECARGA_FILA + sum(len(campo) for campo in fila[1:])
+
+
+class _Cola:
+    # Con menos de `maximo` filas la cola tiene la conversación entera; con `maximo`, las más nuevas
+    __slots__ = ("filas", "tamano")
+
+    def __init__(self, filas, maximo):
+        self.filas = deque(filas, maxlen=maximo)
+        self.tamano = sum(map(tamano_fila, filas))
+
+
+class CacheRecientes:
+    def __init__(self, presupuesto=16 * 1024 * 1024, cola=100):
+        self.presupuesto = presupuesto
+        self.cola = cola
+        self._lock = threading.Lock()
+        self._colas = OrderedDict()  # clave -> _Cola, de la menos a la más usada
+        self.bytes = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+
+    @staticmethod
+    def claves(alias, conversacion, salas=()):
+        # Colas que hacen falta para la primera página de `conversacion`, como las condiciones de la consulta
+        if conversacion == "":
+            return [("conversacion", "Todos"), ("alias", alias)] + [("conversacion", sala) for sala in salas]
+        return [("conversacion", conversacion_de(alias, conversacion))]
+
+    def pagina(self, claves, limite, cargar):
+        # Las `limite` filas más nuevas de la unión de las colas, de la más vieja a la más nueva.
+        # `cargar(clave, cantidad)` lee de la BD las más nuevas de una cola que no está en memoria.
+        # Cada cola tiene al menos `limite` filas (o todas las que hay), así que la unión alcanza; las páginas
+        # más largas que `cola` las resuelve la BD (ver ConsultasHistorial.pagina).
+        filas = {}
+        with self._lock:
+            for clave in claves:
+                cola = self._colas.get(clave)
+                if cola is None:
+                    self.fallos += 1
+                    metricas.cache_historial.sumar(1, "fallo")
+                    cola = _Cola(cargar(clave, self.cola), self.cola)
+                    self._colas[clave] = cola
+                    self.bytes += cola.tamano
+                else:
+                    self.aciertos += 1
+                    metricas.cache_historial.sumar(1, "acierto")
+                    self._colas.move_to_end(clave)
+                for fila in list(cola.filas)[-limite:]:
+                    filas[fila[0]] = fila
+            self._ajustar()
+        return [filas[i] for i in sorted(filas)[-limite:]]
+
+    def agregar(self, filas):
+        # Lote recién confirmado en la BD: (id, fecha, remitente, destinatario, mensaje) en orden de id
+        with self._lock:
+            for fila in filas:
+                remitente, destinatario = fila[2], fila[3]
+                claves = {("conversacion", conversacion_de(remitente, destinatario)),
+                          ("alias", remitente), ("alias", destinatario)}
+                for clave in claves:
+                    cola = self._colas.get(clave)
+                    if cola is None or (cola.filas and cola.filas[-1][0] >= fila[0]):
+                        continue
+                    if len(cola.filas) == cola.filas.maxlen:
+                        cola.tamano -= tamano_fila(cola.filas[0])
+                        self.bytes -= tamano_fila(cola.filas[0])
+                    cola.filas.append(fila)
+                    cola.tamano += tamano_fila(fila)
+                    self.bytes += tamano_fila(fila)
+            self._ajustar()
+
+    def _ajustar(self):
+        # Desaloja las colas menos usadas hasta entrar en el presupuesto (la última que quede no se toca)
+        while self.bytes > self.presupuesto and len(self._colas) > 1:
+            _, cola = self._colas.popitem(last=False)
+            self.bytes -= cola.tamano
+            self.desalojos += 1
+            metricas.cache_historial.sumar(1, "desalojo")
+
+    def estadisticas(self):
+        with self._lock:
+            return {"colas": len(self._colas), "bytes": self.bytes, "aciertos": self.aciertos,
+                    "fallos": self.fallos, "desalojos": self.desalojos}
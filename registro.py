@@ -0,0 +1,126 @@
+import sys
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+
+# REGISTRO (LOGS) DEL SERVIDOR
+# Los módulos del servidor escriben con logging.getLogger("chat...") en vez de print().
+#   - Asíncrono: quien loguea solo deja el registro en una cola acotada; un hilo aparte lo formatea y
+#     lo escribe (consola/archivo). Si la cola se llena se descarta y se cuenta, nunca se bloquea.
+#   - Filtrado por nivel: los avisos por mensaje son DEBUG y en INFO ni siquiera se formatean.
+#   - Límite de frecuencia: cada línea "plantilla" (mismo logger, nivel y texto sin argumentos) puede
+#     salir a lo sumo `por_segundo` veces por segundo; lo que se suprime se informa en la siguiente que pasa.
+#   - Búfer circular: las últimas `capacidad` líneas quedan en memoria para que la interfaz gráfica las
+#     lea por tandas desde su propio hilo (ya no se toca Tk desde los hilos del servidor).
+
+FORMATO = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+FORMATO_FECHA = "%H:%M:%S"
+
+
+class LimiteFrecuencia(logging.Filter):
+    # Cubeta de fichas por plantilla: `rafaga` líneas de golpe y después `por_segundo` por segundo
+    def __init__(self, por_segundo=20, rafaga=50):
+        super().__init__()
+        self.por_segundo = por_segundo
+        self.rafaga = rafaga
+        self._cubetas = {}  # clave -> [fichas, última recarga, suprimidas]
+        self._lock = threading.Lock()
+        self.suprimidas = 0
+
+    def filter(self, registro):
+        clave = (registro.name, registro.levelno, registro.msg)
+        ahora = time.monotonic()
+        with self._lock:
+            cubeta = self._cubetas.get(clave)
+            if cubeta is None:
+                if len(self._cubetas) > 10_000:
+                    self._cubetas.clear()
+                cubeta = self._cubetas[clave] = [self.rafaga, ahora, 0]
+            cubeta[0] = min(self.rafaga, cubeta[0] + (ahora - cubeta[1]) * self.por_segundo)
+            cubeta[1] = ahora
+            if cubeta[0] < 1:
+                cubeta[2] += 1
+                self.suprimidas += 1
+                return False
+            cubeta[0] -= 1
+            suprimidas, cubeta[2] = cubeta[2], 0
+        if suprimidas:
+            registro.msg = f"{registro.msg} [{suprimidas} líneas iguales suprimidas]"
+        return True
+
+
+class ColaDescartable(QueueHandler):
+    def __init__(self, cola):
+        super().__init__(cola)
+        self.descartados = 0
+
+    def enqueue(self, registro):
+        try:
+            self.queue.put_nowait(registro)
+        except queue.Full:
+            self.descartados += 1
+
+
+class BuferCircular(logging.Handler):
+    # Últimas líneas ya formateadas. tomar() se llama desde el hilo de la interfaz.
+    def __init__(self, capacidad=2000):
+        super().__init__()
+        self.lineas = deque(maxlen=capacidad)
+
+    def emit(self, registro):
+        self.lineas.append(self.format(registro))
+
+    def tomar(self, maximo=500):
+        tanda = []
+        while self.lineas and len(tanda) < maximo:
+            tanda.append(self.lineas.popleft())
+        return tanda
+
+
+_activo = None  # (QueueListener, ColaDescartable, BuferCircular, LimiteFrecuencia)
+
+
+def configurar(nivel="INFO", archivo=None, por_segundo=20, capacidad_cola=10_000, capacidad_bufer=2000):
+    # Configura el logger "chat" una sola vez por proceso y devuelve el búfer circular
+    global _activo
+    if _activo is not None:
+        logging.getLogger("chat").setLevel(nivel.upper())
+        return _activo[2]
+
+    formato = logging.Formatter(FORMATO, FORMATO_FECHA)
+    salida = logging.FileHandler(archivo, encoding="utf-8") if archivo else logging.StreamHandler(sys.stderr)
+    salida.setFormatter(formato)
+    bufer = BuferCircular(capacidad_bufer)
+    bufer.setFormatter(formato)
+
+    limite = LimiteFrecuencia(por_segundo)
+    entrada = ColaDescartable(queue.Queue(capacidad_cola))
+    entrada.addFilter(limite)
+    oyente = QueueListener(entrada.queue, salida, bufer, respect_handler_level=True)
+    oyente.start()
+
+    logger = logging.getLogger("chat")
+    logger.setLevel(nivel.upper())
+    logger.addHandler(entrada)
+    logger.propagate = False
+    _activo = (oyente, entrada, bufer, limite)
+    return bufer
+
+
+def detener():
+    # Escribe lo que quedó en la cola (se llama al cerrar el servidor)
+    global _activo
+    if _activo is not None:
+        _activo[0].stop()
+        logging.getLogger("chat").removeHandler(_activo[1])
+        _activo = None
+
+
+def estadisticas():
+    if _activo is None:
+        return {}
+    return {"descartados": _activo[1].descartados, "suprimidos": _activo[3].suprimidas,
+            "en_cola": _activo[1].queue.qsize()}
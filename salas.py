@@ -0,0 +1,117 @@
+import re
+import threading
+
+from bd import ahora
+
+# SALAS (CANALES DE GRUPO)
+# Además de "Todos" y de un alias, un mensaje o un archivo puede ir a una sala: un nombre que empieza
+# con "#", así nunca se confunde con un alias. Con T_SALA un cliente crea una sala, entra o sale;
+# los mensajes y archivos para la sala usan las mismas tramas que los privados, con la sala como destinatario.
+# El índice sala -> miembros hace que repartir cueste O(miembros) y no O(clientes conectados). Como en el
+# registro de clientes (ver directorio.py), cada sala guarda una tupla que se reemplaza entera al cambiar:
+# el reparto la recorre sin tomar el lock.
+# La presencia de cada sala es solo para sus miembros: al entrar se recibe la lista de la sala y después
+# quién entra y quién sale. Una sala vive mientras tenga a alguien adentro; su historial queda en la BD
+# (la sala es su propia conversación) y cada miembro solo puede leer lo que se mandó desde que entró:
+# si la sala se vacía y alguien la vuelve a crear con el mismo nombre, no ve lo que se habló antes.
+# En modo multiproceso cada trabajador tiene el índice completo: las altas y bajas viajan por el bus.
+
+PATRON_SALA = re.compile(r"^#[\w-]{1,32}$")
+
+# Acciones (cliente -> servidor, y entre trabajadores)
+CREAR = "crear"
+UNIR = "unir"
+SALIR = "salir"
+
+# Respuestas y avisos (servidor -> cliente): acción, sala y lo que corresponda
+UNIDO = "unido"     # sala, miembros...: la foto de la sala para quien acaba de entrar
+SALIDO = "salio"    # sala
+ERROR = "error"     # sala, motivo
+ENTRO = "+"         # sala, alias
+SE_FUE = "-"        # sala, alias
+
+
+def es_sala(nombre):
+    return nombre.startswith("#")
+
+
+def nombre_valido(nombre):
+    return PATRON_SALA.match(nombre) is not None
+
+
+class Salas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._miembros = {}   # sala -> tupla de alias (se reemplaza entera)
+        self._de_alias = {}   # alias -> set de salas, para sacarlo de todas al desconectarse
+        self._desde = {}      # (sala, alias) -> fecha de entrada (bd.ahora), desde donde puede leer el historial
+        self._vaciadas = {}   # sala -> fecha en que se quedó sin nadie (solo las del último segundo)
+
+    def miembros(self, sala):
+        # Sin lock: la tupla publicada no cambia
+        return self._miembros.get(sala, ())
+
+    def desde(self, alias):
+        # {sala: fecha de entrada} de las salas del alias, para ConsultasHistorial.pagina
+        with self._lock:
+            return {sala: self._desde[(sala, alias)] for sala in self._de_alias.get(alias, ())}
+
+    def unir(self, sala, alias, accion=UNIR):
+        # Devuelve (entró, motivo): entró es False si ya estaba; motivo no es None si no se pudo.
+        # Con accion=None (cambios que llegan de otro trabajador) no se chequea si la sala existe.
+        with self._lock:
+            actuales = self._miembros.get(sala)
+            if accion == CREAR and actuales is not None:
+                return False, "La sala ya existe"
+            if accion == UNIR and actuales is None:
+                return False, "La sala no existe"
+            actuales = actuales or ()
+            if alias in actuales:
+                return False, None
+            self._miembros[sala] = actuales + (alias,)
+            self._de_alias.setdefault(alias, set()).add(sala)
+            desde = ahora()
+            if self._vaciadas.get(sala) == desde:
+                # Vuelta a crear en el mismo segundo en que se vació: las fechas del historial no alcanzan
+                # para separar las dos, así que se empieza a leer desde el segundo siguiente
+                desde += "~"
+            self._desde[(sala, alias)] = desde
+        return True, None
+
+    def salir(self, sala, alias):
+        with self._lock:
+            return self._salir(sala, alias)
+
+    def _salir(self, sala, alias):
+        actuales = self._miembros.get(sala, ())
+        if alias not in actuales:
+            return False
+        restantes = tuple(a for a in actuales if a != alias)
+        if restantes:
+            self._miembros[sala] = restantes
+        else:
+            del self._miembros[sala]
+            fecha = ahora()
+            self._vaciadas = {s: f for s, f in self._vaciadas.items() if f == fecha}
+            self._vaciadas[sala] = fecha
+        del self._desde[(sala, alias)]
+        salas = self._de_alias.get(alias)
+        salas.discard(sala)
+        if not salas:
+            del self._de_alias[alias]
+        return True
+
+    def quitar(self, alias):
+        # Saca al alias de todas sus salas y devuelve cuáles eran
+        with self._lock:
+            salas = sorted(self._de_alias.get(alias, ()))
+            for sala in salas:
+                self._salir(sala, alias)
+        return salas
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "salas": len(self._miembros),
+                "miembros": sum(len(m) for m in self._miembros.values()),
+            }
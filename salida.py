@@ -0,0 +1,189 @@
+import time
+import threading
+from collections import deque
+
+import metricas
+
+# COLAS DE SALIDA POR CLIENTE
+# Cada cliente tiene una cola acotada con los mensajes ya codificados que le faltan por recibir
+# (bytes, o un generador de bytes para envíos largos como archivos) y un escritor propio que los
+# va mandando al socket. Así el reparto (broadcast, privados, archivos, lista de usuarios) solo
+# encola y nunca se queda bloqueado en el send() de un cliente lento.
+# El escritor junta las tramas chicas que encuentra en la cola y las manda en una sola escritura
+# vectorial (sendmsg/writev, o writelines en asyncio). Con `demora` > 0, si encuentra pocas espera
+# hasta ese tiempo a que lleguen más: un poco de latencia a cambio de muchas menos llamadas al sistema
+# durante una ráfaga de broadcasts.
+
+# Qué hacer cuando la cola de un cliente se llena
+POLITICA_DESCARTAR = "descartar_antiguo"   # se tira el mensaje más viejo para hacer lugar
+POLITICA_DESCONECTAR = "desconectar"       # el cliente no da abasto: se lo desconecta
+POLITICA_CONTRAPRESION = "contrapresion"   # quien encola espera a que haya lugar (con límite de tiempo)
+POLITICAS = (POLITICA_DESCARTAR, POLITICA_DESCONECTAR, POLITICA_CONTRAPRESION)
+
+VECTOR_MAXIMO = 256       # tramas por escritura vectorial (1 = una escritura por trama)
+DEMORA_COALESCER = 0.001  # segundos que el escritor puede esperar a juntar más tramas (0 = no espera)
+
+
+class ColaSalida:
+    def __init__(self, capacidad=1000, politica=POLITICA_DESCONECTAR, espera_maxima=5.0,
+                 vector=VECTOR_MAXIMO, demora=DEMORA_COALESCER):
+        if politica not in POLITICAS:
+            raise ValueError(f"Política de desborde desconocida: {politica}")
+        self.capacidad = capacidad
+        self.politica = politica
+        self.espera_maxima = espera_maxima  # solo para contrapresión; al vencer se desconecta
+        self.vector = max(1, vector)
+        self.demora = demora
+        self._cola = deque()
+        self._cond = threading.Condition()
+        self.cerrada = False
+        self.encolados = 0
+        self.enviados = 0
+        self.escrituras = 0       # llamadas de escritura al socket que hizo el escritor
+        self.descartados = 0
+        self.maxima_profundidad = 0
+        self.envio_maximo = 0.0   # segundos del lote más lento que mandó el escritor
+        self.envio_total = 0.0
+        self.al_encolar = None    # aviso opcional para escritores asíncronos
+        self.al_desbordar = None  # se llama cuando la política decide desconectar
+
+    def encolar(self, datos, bloquear=True):
+        # Devuelve True si el mensaje quedó en la cola. Nunca toca el socket.
+        desconectar = False
+        with self._cond:
+            if self.cerrada:
+                return False
+            if len(self._cola) >= self.capacidad:
+                if self.politica == POLITICA_DESCARTAR:
+                    self._cola.popleft()
+                    self.descartados += 1
+                elif self.politica == POLITICA_CONTRAPRESION and bloquear:
+                    hay_lugar = self._cond.wait_for(
+                        lambda: self.cerrada or len(self._cola) < self.capacidad, self.espera_maxima
+                    )
+                    if self.cerrada:
+                        return False
+                    desconectar = not hay_lugar
+                else:
+                    desconectar = True
+
+            if desconectar:
+                self.descartados += 1
+                self.cerrada = True
+                self._cond.notify_all()
+            else:
+                self._cola.append(datos)
+                self.encolados += 1
+                self.maxima_profundidad = max(self.maxima_profundidad, len(self._cola))
+                self._cond.notify_all()
+
+        if desconectar:
+            if self.al_desbordar:
+                self.al_desbordar()
+            return False
+        if self.al_encolar:
+            self.al_encolar()
+        return True
+
+    def tomar(self, timeout=None):
+        # Espera y devuelve todo lo pendiente como lista; None si la cola se cerró y quedó vacía.
+        # Si hay menos de `vector` tramas, espera hasta `demora` a que se junten más.
+        with self._cond:
+            self._cond.wait_for(lambda: self._cola or self.cerrada, timeout)
+            if self.demora and self._cola and len(self._cola) < self.vector:
+                self._cond.wait_for(lambda: self.cerrada or len(self._cola) >= self.vector, self.demora)
+            return self._sacar_todo()
+
+    def tomar_lote(self):
+        # Igual que tomar() pero sin esperar: puede devolver una lista vacía.
+        with self._cond:
+            return self._sacar_todo()
+
+    def _sacar_todo(self):
+        if not self._cola:
+            return None if self.cerrada else []
+        lote = list(self._cola)
+        self._cola.clear()
+        self._cond.notify_all()
+        return lote
+
+    def marcar_enviados(self, cantidad, segundos=0.0, tamano=0, escrituras=0):
+        # El escritor avisa cuántos mensajes mandó, cuánto tardó el lote, cuántos bytes eran
+        # y en cuántas llamadas de escritura los mandó
+        with self._cond:
+            self.enviados += cantidad
+            self.escrituras += escrituras
+            self.envio_total += segundos
+            self.envio_maximo = max(self.envio_maximo, segundos)
+        metricas.envio.observar(segundos)
+        metricas.bytes_salida.sumar(tamano)
+        metricas.escrituras.sumar(escrituras)
+
+    def cerrar(self):
+        with self._cond:
+            self.cerrada = True
+            self._cond.notify_all()
+        if self.al_encolar:
+            self.al_encolar()
+
+    def esperar_lugar(self, cantidad, timeout=None):
+        # Para quien encola muchos mensajes seguidos (el buzón): espera a que el escritor haga lugar
+        with self._cond:
+            return self._cond.wait_for(lambda: self.cerrada or len(self._cola) + cantidad <= self.capacidad, timeout)
+
+    def profundidad(self):
+        return len(self._cola)
+
+    def estadisticas(self):
+        with self._cond:
+            return {
+                "profundidad": len(self._cola),
+                "maxima_profundidad": self.maxima_profundidad,
+                "encolados": self.encolados,
+                "enviados": self.enviados,
+                "escrituras": self.escrituras,
+                "descartados": self.descartados,
+                "envio_medio_ms": round(self.envio_total / self.enviados * 1000, 3) if self.enviados else 0.0,
+                "envio_maximo_ms": round(self.envio_maximo * 1000, 3),
+                "politica": self.politica,
+                "cerrada": self.cerrada,
+            }
+
+
+def escritor_hilo(conexion, cola):
+    # Hilo escritor de un cliente (modo hilos): vacía su cola hacia el socket.
+    # Si el send falla se cierra la conexión y el hilo lector se encarga de la limpieza.
+    try:
+        while True:
+            lote = cola.tomar()
+            if lote is None:
+                break
+            inicio = time.perf_counter()
+            tamano = 0
+            escrituras = 0
+            juntas = []
+            for datos in lote:
+                if isinstance(datos, (bytes, bytearray)):
+                    juntas.append(datos)
+                    tamano += len(datos)
+                    if len(juntas) >= cola.vector:
+                        escrituras += conexion.enviar_varios(juntas)
+                        juntas = []
+                else:
+                    # Un generador (por ejemplo un archivo por bloques) se manda parte por parte,
+                    # después de lo que estaba antes en la cola
+                    if juntas:
+                        escrituras += conexion.enviar_varios(juntas)
+                        juntas = []
+                    for parte in datos:
+                        conexion.enviar_bytes(parte)
+                        tamano += len(parte)
+                        escrituras += 1
+            if juntas:
+                escrituras += conexion.enviar_varios(juntas)
+            cola.marcar_enviados(len(lote), time.perf_counter() - inicio, tamano, escrituras)
+    except OSError:
+        pass
+    finally:
+        cola.cerrar()
+        conexion.close()
@@ -0,0 +1,142 @@
+import os
+import signal
+import logging
+import argparse
+import threading
+
+import registro
+from bd import RUTA_BD
+
+# ARRANQUE DEL SERVIDOR (CON O SIN INTERFAZ)
+# Punto de entrada para correr el servidor como demonio: host, puerto, BD y logs se configuran por
+# línea de comandos o por variables de entorno (CHAT_HOST, CHAT_PUERTO, CHAT_BD, CHAT_LOG_NIVEL,
+# CHAT_LOG_ARCHIVO, CHAT_METRICAS, CHAT_VECTOR, CHAT_DEMORA_MS, CHAT_GRACIA, CHAT_CACHE_MB, CHAT_VENTANA_IDS y los límites por cliente:
+# CHAT_MAX_CONEXIONES, CHAT_MAX_POR_IP, CHAT_MENSAJES_SEG, CHAT_MENSAJES_IP, CHAT_BYTES_SEG, CHAT_BYTES_IP,
+# CHAT_COLA_ENTRADA, CHAT_HANDSHAKE, CHAT_MAX_ARCHIVO_MB, CHAT_SUBIDAS_ALIAS), en lugar de la IP fija de antes. Sin --interfaz no se abre ninguna ventana: los logs van a
+# consola o al archivo. Con --interfaz la ventana es un lector más del búfer circular de registro.py.
+#   python servicio.py --puerto 5010 --modo asyncio --log-archivo servidor.log
+#   python servicio.py --interfaz
+# Para varios procesos ver cluster.py.
+
+log = logging.getLogger("chat.servicio")
+
+
+def leer_argumentos(argv=None):
+    entorno = os.environ.get
+    parser = argparse.ArgumentParser(description="Servidor de chat")
+    parser.add_argument("--host", default=entorno("CHAT_HOST", "0.0.0.0"))
+    parser.add_argument("--puerto", type=int, default=int(entorno("CHAT_PUERTO", "5010")))
+    parser.add_argument("--bd", default=entorno("CHAT_BD", RUTA_BD), help="ruta de la base SQLite")
+    parser.add_argument("--modo", choices=("hilos", "asyncio"), default=entorno("CHAT_MODO", "hilos"))
+    parser.add_argument("--backlog", type=int, default=int(entorno("CHAT_BACKLOG", "1024")))
+    parser.add_argument("--log-nivel", default=entorno("CHAT_LOG_NIVEL", "INFO"),
+                        help="DEBUG muestra cada mensaje enviado")
+    parser.add_argument("--log-archivo", default=entorno("CHAT_LOG_ARCHIVO"), help="por defecto, stderr")
+    parser.add_argument("--metricas", default=entorno("CHAT_METRICAS", "127.0.0.1:9010"),
+                        help="host:puerto del endpoint /metrics (vacío para no abrirlo)")
+    parser.add_argument("--vector", type=int, default=int(entorno("CHAT_VECTOR", "256")),
+                        help="tramas por escritura vectorial a cada cliente (1 = una escritura por trama)")
+    parser.add_argument("--demora-ms", type=float, default=float(entorno("CHAT_DEMORA_MS", "1")),
+                        help="espera máxima para juntar tramas chicas en una escritura (0 = no esperar)")
+    parser.add_argument("--gracia", type=float, default=float(entorno("CHAT_GRACIA", "30")),
+                        help="segundos que se guarda la sesión de un cliente que perdió la conexión")
+    # Admisión y límites por cliente (ver admision.py); 0 desactiva cada uno
+    parser.add_argument("--max-conexiones", type=int, default=int(entorno("CHAT_MAX_CONEXIONES", "10000")),
+                        help="conexiones abiertas a la vez; las que sobran se rechazan al aceptarlas")
+    parser.add_argument("--max-por-ip", type=int, default=int(entorno("CHAT_MAX_POR_IP", "64")))
+    parser.add_argument("--mensajes-por-segundo", type=float, default=float(entorno("CHAT_MENSAJES_SEG", "50")),
+                        help="mensajes por segundo de cada alias; los que se pasan se descartan")
+    parser.add_argument("--mensajes-por-ip", type=float, default=float(entorno("CHAT_MENSAJES_IP", "200")))
+    parser.add_argument("--bytes-por-segundo", type=float, default=float(entorno("CHAT_BYTES_SEG", str(4 * 1024 * 1024))),
+                        help="bytes por segundo de cada alias; si se pasa se le lee más despacio")
+    parser.add_argument("--bytes-por-ip", type=float, default=float(entorno("CHAT_BYTES_IP", str(16 * 1024 * 1024))))
+    parser.add_argument("--cola-entrada", type=int, default=int(entorno("CHAT_COLA_ENTRADA", "10000")),
+                        help="mensajes esperando a procesar_mensajes antes de empezar a descartar")
+    parser.add_argument("--tiempo-handshake", type=float, default=float(entorno("CHAT_HANDSHAKE", "10")),
+                        help="segundos para mandar el alias desde que se acepta la conexión")
+    parser.add_argument("--max-archivo-mb", type=float, default=float(entorno("CHAT_MAX_ARCHIVO_MB", "1024")),
+                        help="tamaño máximo de un archivo; uno más grande se rechaza antes de empezar a subirlo")
+    parser.add_argument("--subidas-por-alias", type=int, default=int(entorno("CHAT_SUBIDAS_ALIAS", "4")),
+                        help="subidas de archivos abiertas a la vez por alias")
+    parser.add_argument("--cache-mb", type=float, default=float(entorno("CHAT_CACHE_MB", "16")),
+                        help="memoria para las últimas páginas del historial (0 = leer siempre de la BD)")
+    parser.add_argument("--ventana-ids", type=float, default=float(entorno("CHAT_VENTANA_IDS", "300")),
+                        help="segundos que se recuerda el id de un mensaje (reintentos sin duplicados y recibos)")
+    parser.add_argument("--interfaz", action="store_true", help="mostrar la ventana de Tk")
+    return parser.parse_args(argv)
+
+
+def configurar(servidor, args):
+    # Antes de servidor.preparar(), que es donde se arman la admisión, el limitador y la caché.
+    # La usan servicio.main y cada trabajador de cluster.py: la configuración es la misma en los dos modos
+    servidor.VECTOR_SALIDA = args.vector
+    servidor.DEMORA_SALIDA = args.demora_ms / 1000
+    servidor.GRACIA_SESION = args.gracia
+    servidor.DURACION_IDS = args.ventana_ids
+    servidor.PRESUPUESTO_CACHE = int(args.cache_mb * 1024 * 1024)
+    servidor.MAXIMO_CONEXIONES = args.max_conexiones
+    servidor.MAXIMO_POR_IP = args.max_por_ip
+    servidor.MENSAJES_POR_SEGUNDO = args.mensajes_por_segundo
+    servidor.MENSAJES_POR_IP = args.mensajes_por_ip
+    servidor.BYTES_POR_SEGUNDO = args.bytes_por_segundo
+    servidor.BYTES_POR_IP = args.bytes_por_ip
+    servidor.CAPACIDAD_ENTRADA = args.cola_entrada
+    servidor.TIEMPO_HANDSHAKE = args.tiempo_handshake
+    servidor.MAXIMO_ARCHIVO = int(args.max_archivo_mb * 1024 * 1024)
+    servidor.SUBIDAS_POR_ALIAS = args.subidas_por_alias
+
+
+def abrir_metricas(direccion, desplazamiento=0):
+    # "host:puerto" -> endpoint /metrics. Si el puerto está ocupado el servidor sigue sin él.
+    import metricas
+    host, _, puerto = direccion.rpartition(":")
+    try:
+        return metricas.iniciar_http(host or "127.0.0.1", int(puerto) + desplazamiento)
+    except (OSError, ValueError) as e:
+        log.error("No se pudo abrir el endpoint de métricas en %s: %s", direccion, e)
+
+
+def main(argv=None):
+    args = leer_argumentos(argv)
+    bufer = registro.configurar(args.log_nivel, args.log_archivo)
+
+    # servidor.py se importa después de configurar los logs y antes de arrancar abre la BD pedida
+    import servidor
+    configurar(servidor, args)
+    servidor.preparar(args.bd)
+    if args.modo == "asyncio":
+        import servidor_asyncio
+        servidor_asyncio.iniciar_servidor(args.host, args.puerto, args.backlog)
+    else:
+        servidor.iniciar_servidor(args.host, args.puerto, args.backlog)
+    if args.metricas:
+        abrir_metricas(args.metricas)
+
+    if args.interfaz:
+        if not servidor.importar_tk():
+            log.error("Tk no está disponible; se sigue sin interfaz")
+        else:
+            try:
+                root = servidor.tk.Tk()
+            except servidor.tk.TclError as e:
+                log.error("No se pudo abrir la interfaz (%s); se sigue sin interfaz", e)
+            else:
+                servidor.InterfazServidor(root, bufer)
+                root.mainloop()
+                servidor.cerrar()
+                return
+
+    # Sin interfaz: el hilo principal solo espera SIGINT/SIGTERM para cerrar ordenadamente
+    fin = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: fin.set())
+    try:
+        while not fin.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        pass
+    log.info("Servidor detenido")
+    servidor.cerrar()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,224 +1,944 @@
 import socket
 import threading
-import json
 import os
-import base64
-import uuid
 import time
 import random 
+import atexit
+import logging
 from queue import Queue
-import tkinter as tk
-from tkinter import scrolledtext
-
-#BD
-import sqlite3
-from datetime import datetime
-
-#INICIALIZACIÓN DE BASE DE DATOS
-def init_db():
-    #crea el archivo historial db
-    conn = sqlite3.connect("historial.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS historial_conexiones (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            alias TEXT NOT NULL,
-            codigo TEXT NOT NULL,
-            ip TEXT NOT NULL,
-            fecha_conexion TEXT NOT NULL,
-            fecha_desconexion TEXT
-        );
-    """)
-    conn.commit()
-    conn.close()
+from protocolo import (
+    Conexion, ErrorProtocolo, es_trama, desempaquetar_campos, empaquetar_campos,
+    MODO_TRAMAS, MODO_LEGADO, T_ALIAS, T_BIENVENIDA, T_ALIAS_OCUPADO, T_MSG_ALL,
+    T_MSG_PRIVADO, T_ARCHIVO, T_TEXTO, T_SALIR,
+    T_ARCHIVO_INICIO, T_ARCHIVO_BLOQUE, T_ARCHIVO_ACK, T_ARCHIVO_FIN, T_ARCHIVO_ERROR,
+    T_ARCHIVO_REF, T_ARCHIVO_PEDIR, T_PRESENCIA_FOTO, T_HISTORIAL_PEDIR, T_HISTORIAL_PAGINA, T_REANUDAR, T_SALA,
+    T_LIMITE, T_ACUSE, T_RECIBO, T_MSG_CON_ID, F_ACUSE, CABECERA, SEPARADOR, Trama, TramaCompartida
+)
+from transferencias import RegistroSubidas, bloques_archivo, abrir_descarga, referencia_de, TIPOS_TRANSFERENCIA
+from almacen import AlmacenContenido
+from presencia import Presencia
+from directorio import Directorio
+from salas import Salas, es_sala, nombre_valido, CREAR, UNIR, SALIR, UNIDO, SALIDO, ERROR, ENTRO, SE_FUE
+from admision import Admision, Limitador, RECHAZO, TEXTOS, COLA_LLENA, HANDSHAKE
+from acuses import VentanaIds, separar_id, ACEPTADO, RECHAZADO, ENTREGADO, EN_BUZON, DURACION
+from bd import abrir, migrar, RUTA_BD
+from historial import crear_historial, ConsultasHistorial
+from recientes import CacheRecientes
+from persistencia import EtapaPersistencia
+from buzon import Buzon, ENTREGAR, GUARDADO, DEMASIADO_GRANDE, RECHAZOS
+from salida import ColaSalida, escritor_hilo, POLITICA_DESCONECTAR, VECTOR_MAXIMO, DEMORA_COALESCER
+import metricas
+import compresion
+import sesiones
 
-def registrar_conexion(alias, codigo, ip):
-    
-    fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    conn = sqlite3.connect("historial.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO historial_conexiones(alias, codigo, ip, fecha_conexion)
-        VALUES (?, ?, ?, ?)
-    """, (alias, codigo, ip, fecha))
-    conn.commit()
-    conn.close()
+log = logging.getLogger("chat.servidor")  # ver registro.py: asíncrono, por nivel y con límite de frecuencia
 
-def registrar_desconexion(alias):
-    fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    conn = sqlite3.connect("historial.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE historial_conexiones
-        SET fecha_desconexion = ?
-        WHERE alias = ? AND fecha_desconexion IS NULL
-    """, (fecha, alias))
-    conn.commit()
-    conn.close()
+clientes = Directorio()        # Registro global: alias → {conn, codigo, salida, sesion} (ver directorio.py)
+# Solo para modificar el registro (entradas, salidas y vencimientos): las lecturas no lo toman.
+# Lo que es de una conexión se ordena con su propio lock (el de su sesión y el de su cola y su socket).
+# Es un threading.Lock que además mide la espera cuando está ocupado.
+lock = metricas.LockMedido(metricas.espera_lock, metricas.adquisiciones_lock)
+reservas = set()               # alias ya tomados que todavía no entran a `clientes` (ver reservar_alias)
+cola_mensajes = Queue()        # Cola segura para manejo de mensajes (acotada por CAPACIDAD_ENTRADA, ver encolar_entrada)
+
+# Cola de salida por cliente: capacidad, qué hacer cuando un cliente lento la llena y cómo se juntan
+# las tramas en cada escritura al socket (ver salida.py)
+CAPACIDAD_SALIDA = 1000
+POLITICA_SALIDA = POLITICA_DESCONECTAR
+VECTOR_SALIDA = VECTOR_MAXIMO
+DEMORA_SALIDA = DEMORA_COALESCER
+
+# Admisión y límites por cliente (ver admision.py); 0 desactiva cada uno. servicio.py los toma de la línea de comandos.
+MAXIMO_CONEXIONES = 10000             # conexiones abiertas a la vez (con o sin handshake terminado)
+MAXIMO_POR_IP = 64
+MENSAJES_POR_SEGUNDO = 50             # por alias
+MENSAJES_POR_IP = 200
+BYTES_POR_SEGUNDO = 4 * 1024 * 1024   # por alias
+BYTES_POR_IP = 16 * 1024 * 1024
+CAPACIDAD_ENTRADA = 10000             # mensajes esperando en cola_mensajes antes de empezar a descartar
+TIEMPO_HANDSHAKE = 10.0               # segundos para mandar el alias (o reanudar) desde que se acepta la conexión
+admision = None
+limitador = None
 
-# Inicializa BD al iniciar servidor
-init_db()
+# Segundos que se recuerda el id de cada mensaje, para reconocer reintentos y aceptar recibos (ver acuses.py)
+DURACION_IDS = DURACION
+ids = None
 
-clientes = {}                  # Diccionario global: alias → {codigo}
-lock = threading.Lock()        # Evita conflictos entre threads
-cola_mensajes = Queue()        # Cola segura para manejo de mensajes
+# Segundos que un alias queda reservado después de un corte, esperando que el cliente se reconecte
+GRACIA_SESION = sesiones.GRACIA
 
-#GUARDAR MENSAJES EN JSON
-def guardar_mensaje_json(alias, mensaje, destinatario="Todos"):
-    
-    archivo = f"{alias}_chat.json"
-    chat = []
+# Archivos subidos por bloques: parciales y completos viven en disco, no en memoria.
+# Los completos pasan al almacén por contenido: un archivo repetido ocupa disco una sola vez.
+# Tamaño máximo de cada archivo y subidas abiertas a la vez por alias; 0 desactiva cada uno.
+MAXIMO_ARCHIVO = 1024 * 1024 * 1024
+SUBIDAS_POR_ALIAS = 4
+almacen = None
+subidas = None
 
-    if os.path.exists(archivo):
-        with open(archivo, "r", encoding="utf-8") as f:
-            chat = json.load(f)
+#HISTORIAL Y REGISTRO DE CONEXIONES
+# Backend configurable (ver historial.py): "sqlite" (por defecto), "jsonl" o "json" (el formato original).
+# Nada de esto escribe en disco en el momento: la etapa de persistencia lo encola y lo escribe en lotes
+# desde su propio hilo, así la entrega de mensajes y el handshake no esperan al disco.
+TIPO_HISTORIAL = "sqlite"
+historial = None
+persistencia = None
+consultas = None   # lectura del historial por páginas (solo con el backend sqlite)
+buzon = None       # privados y archivos para quien no está conectado (ver buzon.py)
+# Memoria para las últimas páginas de cada conversación (ver recientes.py); 0 = leer siempre de la BD
+PRESUPUESTO_CACHE = 16 * 1024 * 1024
 
-    chat.append({"remitente": alias, "destinatario": destinatario, "mensaje": mensaje})
+def preparar(ruta_bd=RUTA_BD):
+    # Abre la BD (aplicando las migraciones pendientes), el almacén de archivos y la etapa de persistencia.
+    # Importar este módulo no toca el disco: esto se hace una vez, al arrancar el servidor.
+    # La conexión con que se migra es la misma con la que después escriben el historial (backend sqlite) y el
+    # registro de conexiones, los dos desde el hilo de persistencia. El buzón (su escritor y las lecturas del
+    # vaciado) y las consultas del historial (pool de solo lectura) abren las suyas: trabajan desde otros
+    # hilos y no tienen que esperar detrás de la persistencia.
+    global almacen, subidas, historial, persistencia, consultas, buzon, admision, limitador, ids
+    if persistencia is not None:
+        return
+    admision = Admision(MAXIMO_CONEXIONES, MAXIMO_POR_IP)
+    limitador = Limitador(MENSAJES_POR_SEGUNDO, BYTES_POR_SEGUNDO, MENSAJES_POR_IP, BYTES_POR_IP)
+    ids = VentanaIds(DURACION_IDS)
+    conn = abrir(ruta_bd)
+    migrar(conn)
+    almacen = AlmacenContenido("almacen")
+    subidas = RegistroSubidas("transferencias", almacen=almacen, max_tamano=MAXIMO_ARCHIVO,
+                              max_por_usuario=SUBIDAS_POR_ALIAS)
+    if TIPO_HISTORIAL == "sqlite":
+        historial = crear_historial(TIPO_HISTORIAL, ruta=ruta_bd, conn=conn)
+        recientes = CacheRecientes(PRESUPUESTO_CACHE) if PRESUPUESTO_CACHE else None
+        consultas = ConsultasHistorial(ruta_bd, recientes=recientes)
+    else:
+        historial = crear_historial(TIPO_HISTORIAL)
+    persistencia = EtapaPersistencia(historial, ruta_bd=ruta_bd, conn=conn)
+    if consultas is not None and consultas.recientes is not None:
+        # Cada lote confirmado se agrega a las colas en memoria que estén cargadas
+        persistencia.al_escribir = consultas.recientes.agregar
+        metricas.medidor("chat_cache_historial_bytes", "Memoria aproximada de las colas recientes del historial",
+                         lambda: consultas.recientes.bytes)
+    persistencia.iniciar()
+    atexit.register(persistencia.detener)
+    buzon = Buzon(ruta_bd)
 
-    with open(archivo, "w", encoding="utf-8") as f:
-        json.dump(chat, f, indent=4, ensure_ascii=False)
+    # Medidores: se leen recién cuando alguien pide las métricas
+    metricas.medidor("chat_clientes_conectados", "Clientes conectados a este proceso", lambda: len(clientes))
+    metricas.medidor("chat_conexiones_abiertas", "Conexiones abiertas, incluidas las que están en el handshake",
+                     lambda: admision.abiertas)
+    metricas.medidor("chat_cola_mensajes", "Mensajes esperando en cola_mensajes", cola_mensajes.qsize)
+    metricas.medidor("chat_persistencia_pendiente", "Operaciones que todavía no llegaron al disco", persistencia.backlog)
+    metricas.medidor("chat_presencia_secuencia", "Secuencia de la última trama de presencia", lambda: presencia.secuencia)
+    metricas.medidor("chat_compresion_bytes_ahorrados", "Bytes que la compresión le ahorró a la red",
+                     lambda: sum(c.bytes_originales - c.bytes_comprimidos for c in compresion.CODECS.values()))
+    metricas.medidor("chat_almacen_bytes", "Bytes ocupados por el almacén de archivos", lambda: almacen.estadisticas()["bytes"])
+    metricas.medidor("chat_ids_recordados", "Ids de mensaje recordados para reconocer reintentos", lambda: len(ids))
+    metricas.medidor("chat_buzon_pendientes", "Mensajes esperando en el buzón a que su destinatario vuelva", buzon.pendientes)
+    metricas.medidor("chat_sesiones_cortadas", "Alias reservados esperando una reconexión",
+                     lambda: sum(1 for _, info in destinatarios() if info["sesion"] and info["sesion"].cortada))
+
+def cerrar():
+    # Vacía a disco lo pendiente (historial, conexiones y logs) antes de terminar el proceso
+    if persistencia is not None:
+        persistencia.detener()
+    if buzon is not None:
+        buzon.cerrar()
+    import registro
+    registro.detener()
+
+def guardar_mensaje(alias, mensaje, destinatario="Todos"):
+    persistencia.guardar_mensaje(alias, mensaje, destinatario)
+
+def registrar_conexion(alias, codigo, ip):
+    persistencia.registrar_conexion(alias, codigo, ip)
+
+def registrar_desconexion(alias):
+    persistencia.registrar_desconexion(alias)
 
 #FUNCIONES PARA ENVÍO DE MENSAJES
-def broadcast(texto, remitente):
-    #Envía mensajes a TODOS los usuarios excepto al remitente.
-    with lock:
-        for alias, info in clientes.items():
-            if alias != remitente:
-                try:
-                    info["conn"].send(f"{remitente} (Todos): {texto}".encode("utf-8"))
-                except:
-                    pass
-
-def enviar_privado(destinatario, texto, remitente):
+# Cada cliente se guarda como un objeto Conexion: ella decide si el mensaje viaja como trama o como texto viejo.
+# Los repartos recorren la foto del registro sin tomar ningún lock; el mensaje se codifica una vez
+# y se deja en la cola de salida de cada cliente, y su escritor lo manda al socket.
+# Con `sala` solo se recorren sus miembros (los que estén conectados a este proceso), no todo el registro.
+def destinatarios(excepto=None, sala=None):
+    if sala is not None:
+        lista = []
+        for alias in salas.miembros(sala):
+            info = clientes.get(alias)
+            if info is not None and alias != excepto:
+                lista.append((alias, info))
+        return lista
+    lista = clientes.items()
+    if excepto is None:
+        return lista
+    return [(alias, info) for alias, info in lista if alias != excepto]
+
+def entregar(info, tipo, carga):
+    return encolar_trama(info, TramaCompartida(tipo, carga))
+
+def encolar_trama(info, trama, deshacer=False):
+    # Los mensajes de chat además quedan en el anillo de la sesión, por si hay que reenviarlos al reanudar.
+    # Durante un corte la cola está cerrada: solo se guardan en el anillo.
+    # Con `deshacer`, lo que la cola no acepta tampoco queda en el anillo: quien llama lo guarda en otro lado.
+    # A quien no entiende recibos (no ofreció F_ACUSE) un privado con id le llega como texto común.
+    if trama.tipo == T_MSG_CON_ID and not info["acuses"]:
+        trama = TramaCompartida(T_TEXTO, trama.carga.rsplit(SEPARADOR, 1)[-1])
+    sesion = info["sesion"]
+    if sesion is None or trama.tipo not in sesiones.REPETIBLES:
+        return info["salida"].encolar(trama.para(info["conn"]))
+    with sesion.lock:
+        sesion.guardar(trama.tipo, trama.carga)
+        if info["salida"].encolar(trama.para(info["conn"])):
+            return True
+        if deshacer:
+            sesion.deshacer()
+        return False
+
+def broadcast(texto, remitente, sala=None, propagar=True):
+    #Envía mensajes a TODOS los usuarios excepto al remitente (o solo a los miembros de `sala`).
+    # El texto se arma y se codifica una sola vez: todas las colas reciben los mismos bytes.
+    tipo = "publico" if sala is None else "sala"
+    with metricas.reparto.medir(tipo):
+        lista = destinatarios(excepto=remitente, sala=sala)
+        trama = TramaCompartida(T_TEXTO, f"{remitente} ({sala or 'Todos'}): {texto}")
+        for alias, info in lista:
+            encolar_trama(info, trama)
+    metricas.entregas.sumar(len(lista), tipo)
+    if propagar and bus is not None:
+        bus.difundir("broadcast", texto, remitente, sala)
+
+def enviar_privado(destinatario, texto, remitente, propagar=True, id_mensaje=""):
     #Envía mensajes privados entre dos usuarios.
+    # Si el destinatario no está conectado (en ningún trabajador) el mensaje queda en su buzón.
+    # Con `id_mensaje` le llega con el remitente y el id, para que su cliente mande el recibo (ver acuses.py).
+    # Devuelve lo que decidió el buzón (ver buzon.py): ENTREGAR, GUARDADO o el motivo del rechazo; REMOTO si
+    # pasó a otro trabajador, que es el que lo decide (ver entregar_remoto).
+    info = clientes.get(destinatario)
+    if info is None and propagar and bus is not None:
+        bus.enviar_a(destinatario, "privado", destinatario, texto, remitente, id_mensaje)
+        return REMOTO
+    texto = f"{remitente} (Privado): {texto}"
+    if id_mensaje:
+        trama = TramaCompartida(T_MSG_CON_ID, empaquetar_campos(remitente, id_mensaje, texto))
+    else:
+        trama = TramaCompartida(T_TEXTO, texto)
+    with metricas.reparto.medir("privado"):
+        return entregar_o_guardar(destinatario, trama)
+
+def entregar_o_guardar(destinatario, trama):
+    # El buzón decide con su propio lock si el destinatario puede recibirlo ya (ver buzon.py)
+    resultado, info = buzon.guardar_o_devolver(destinatario, trama.tipo, trama.carga, conectado)
+    if info is not None:
+        if encolar_trama(info, trama, deshacer=True):
+            metricas.entregas.sumar(1, "privado")
+        elif buzon.guardar(destinatario, trama.tipo, trama.carga):
+            # La cola se cerró (o se llenó) entre la decisión y el encolado: queda en el buzón, como un archivo
+            resultado = GUARDADO
+        else:
+            resultado = DEMASIADO_GRANDE
+    return resultado
+
+def conectado(alias):
+    # Para el buzón: un alias cuya sesión está cortada (esperando que vuelva, ver soltar_cliente) sigue en
+    # `clientes`, pero su cola está cerrada; lo que es solo para él va al buzón y se le entrega al reanudar
+    info = clientes.get(alias)
+    if info is None or (info["sesion"] is not None and info["sesion"].cortada is not None):
+        return None
+    return info
+
+def enviar_archivo(subida, propagar=True):
+    # Reparte un archivo ya guardado en disco. A un destinatario puntual se le encola un generador que
+    # lee el archivo de a un bloque recién cuando su escritor llega a él. Para "Todos" solo se manda una
+    # referencia (remitente, nombre, sha256, tamaño) y cada cliente lo pide al almacén si lo quiere;
+    # los clientes viejos no saben pedirlo y siguen recibiendo el FILE: en base64 completo.
+    # A una sala le llega lo mismo que a "Todos", solo a sus miembros.
+    # Como enviar_privado, devuelve lo que decidió el buzón o REMOTO (ENTREGAR para "Todos" y las salas).
+    sala = subida.destinatario if es_sala(subida.destinatario) else None
+    if sala is not None or subida.destinatario.lower() == "todos":
+        with metricas.reparto.medir("archivo"):
+            referencia = TramaCompartida(T_ARCHIVO_REF, referencia_de(subida))
+            lista = destinatarios(excepto=subida.remitente, sala=sala)
+            for alias, info in lista: #itera sobre clientes conectados
+                if info["conn"].modo == MODO_LEGADO:
+                    info["salida"].encolar(bloques_archivo(MODO_LEGADO, subida))
+                else:
+                    encolar_trama(info, referencia)
+        metricas.entregas.sumar(len(lista), "archivo")
+        if propagar and bus is not None:
+            bus.difundir("archivo", subida)
+        return ENTREGAR
+    info = clientes.get(subida.destinatario)
+    if info is None and propagar and bus is not None:
+        bus.enviar_a(subida.destinatario, "archivo", subida)
+        return REMOTO
+    # Para alguien desconectado queda en el buzón una referencia al almacén, como las de "Todos"
+    resultado, info = buzon.guardar_o_devolver(subida.destinatario, T_ARCHIVO_REF, referencia_de(subida), conectado)
+    if info: #enviar el archivo directamente
+        if info["salida"].encolar(bloques_archivo(info["conn"].modo, subida, info["conn"].codec)):
+            metricas.entregas.sumar(1, "archivo")
+        else:
+            # La conexión se cortó entre la decisión y el encolado: el archivo no está en el anillo
+            # de la sesión, así que también queda su referencia en el buzón
+            buzon.guardar(subida.destinatario, T_ARCHIVO_REF, referencia_de(subida))
+            resultado = GUARDADO
+    return resultado
+
+#MODO MULTIPROCESO
+# Con cluster.py este proceso es uno de varios trabajadores y `bus` es su enlace con el enrutador:
+# alias, presencia y entregas a clientes de otros trabajadores pasan por ahí. Con un solo proceso es None.
+bus = None
+REMOTO = "remoto"  # un privado o un archivo que pasó a otro trabajador: el historial y el acuse los pone él
+
+def entregar_remoto(evento, *args):
+    # Entregas que llegan de otro trabajador: solo a los clientes de este proceso, sin volver a propagar.
+    # Los privados y archivos para un alias que no está en ningún trabajador vuelven al del remitente,
+    # que los guarda en el buzón (o los rechaza).
+    if evento == "broadcast":
+        broadcast(*args, propagar=False)
+    elif evento == "privado":
+        destinatario, texto, remitente, id_mensaje = args
+        resultado = enviar_privado(destinatario, texto, remitente, propagar=False, id_mensaje=id_mensaje)
+        cerrar_privado(remitente, destinatario, texto, id_mensaje, resultado)
+    elif evento == "archivo":
+        subida = args[0]
+        resultado = enviar_archivo(subida, propagar=False)
+        if not es_sala(subida.destinatario) and subida.destinatario.lower() != "todos":
+            cerrar_archivo(subida, resultado)
+    elif evento == "sala":
+        cambiar_sala(*args, propagar=False)
+    elif evento == "recibo":
+        acusar_recibo(*args)
+    elif evento == "acuse":
+        acusar(*args, propagar=False)
+
+#SALAS
+# Índice sala -> miembros (ver salas.py). Crear, entrar y salir se atienden en procesar_mensajes,
+# en orden con los mensajes: un mensaje a la sala nunca se adelanta a la entrada de su autor.
+salas = Salas()
+
+def atender_sala(alias, trama):
+    accion, sala = desempaquetar_campos(trama.carga, 2)
+    sala = sala.decode("utf-8").strip()
+    if accion in (CREAR, UNIR):
+        if not nombre_valido(sala):
+            responder(alias, T_SALA, empaquetar_campos(ERROR, sala, "Nombre inválido: #nombre, hasta 32 letras, números, - o _"))
+            return
+        entro, motivo = salas.unir(sala, alias, accion)
+        if motivo:
+            responder(alias, T_SALA, empaquetar_campos(ERROR, sala, motivo))
+            return
+        # La foto de la sala va primero; después los demás miembros ven la entrada
+        responder(alias, T_SALA, empaquetar_campos(UNIDO, sala, *salas.miembros(sala)))
+        if entro:
+            cambiar_sala(UNIR, sala, alias, aplicado=True)
+    elif accion == SALIR:
+        if salas.salir(sala, alias):
+            cambiar_sala(SALIR, sala, alias, aplicado=True)
+        responder(alias, T_SALA, empaquetar_campos(SALIDO, sala))
+    else:
+        raise ErrorProtocolo(f"Acción de sala desconocida: {accion}")
+
+def cambiar_sala(accion, sala, alias, aplicado=False, propagar=True):
+    # Aplica una entrada o salida (si no se aplicó ya) y se la avisa a los miembros de la sala.
+    # Lo que llega de otro trabajador se aplica sin chequeos: allá ya se validó.
+    if not aplicado:
+        cambio = salas.unir(sala, alias, None)[0] if accion == UNIR else salas.salir(sala, alias)
+        if not cambio:
+            return
+    trama = TramaCompartida(T_SALA, empaquetar_campos(ENTRO if accion == UNIR else SE_FUE, sala, alias))
+    for miembro, info in destinatarios(excepto=alias, sala=sala):
+        encolar_trama(info, trama)
+    if propagar and bus is not None:
+        bus.difundir("sala", accion, sala, alias)
+
+def dejar_salas(alias):
+    # Al desconectarse del todo (o cuando otro trabajador avisa que salió). No se propaga: cada
+    # trabajador recibe la salida del alias por el bus y lo saca de sus salas por su cuenta.
+    for sala in salas.quitar(alias):
+        cambiar_sala(SALIR, sala, alias, aplicado=True, propagar=False)
+
+def en_sala(alias, sala):
+    # Para mandar a una sala o leer su historial hay que estar adentro
+    if alias in salas.miembros(sala):
+        return True
+    responder(alias, T_SALA, empaquetar_campos(ERROR, sala, "No estás en la sala"))
+    return False
+
+#PRESENCIA
+# En vez de mandarle la lista completa a todos en cada conexión/desconexión, cada cliente recibe
+# una foto al entrar y después solo los cambios, agrupados por ráfaga (ver presencia.py).
+presencia = Presencia(destinatarios)
+
+def enviar_foto_presencia(alias):
+    # El cliente la pide si detecta que se perdió algún cambio
+    info = clientes.get(alias)
+    if info:
+        presencia.enviar_foto(info)
+
+def estadisticas_salida():
+    # Profundidad de cola, descartes y enviados de cada cliente conectado.
+    return {alias: info["salida"].estadisticas() for alias, info in destinatarios()}
+
+def iniciar_escritor(conexion, cola):
+    # Las conexiones asyncio traen su propio escritor; en modo hilos cada cliente tiene un hilo escritor.
+    if hasattr(conexion, "iniciar_escritor"):
+        conexion.iniciar_escritor(cola)
+    else:
+        threading.Thread(target=escritor_hilo, args=(conexion, cola), daemon=True).start()
+
+#SUBIDA DE ARCHIVOS POR BLOQUES
+def responder(alias, tipo, carga=b""):
+    info = clientes.get(alias)
+    if info:
+        entregar(info, tipo, carga)
+
+# Lo que escribe en disco se atiende en el lector del cliente (en asyncio, en el executor), no en
+# procesar_mensajes: también el archivo entero en una sola trama de los clientes viejos
+TIPOS_A_DISCO = TIPOS_TRANSFERENCIA + (T_ARCHIVO,)
+
+def atender_transferencia(alias, trama):
+    # Se ejecuta en el hilo lector del propio cliente: cada uno escribe sus bloques a disco
+    # sin pasar por procesar_mensajes, y recibe un ACK por bloque para poder reanudar.
+    id_transferencia = ""
+    try:
+        if trama.tipo == T_ARCHIVO:
+            # Archivo entero en una trama (clientes viejos): se pasa a disco (y se calcula su sha256) acá,
+            # y el reparto sigue el orden normal de los mensajes, como el de una subida por bloques
+            destinatario, nombre_archivo, contenido = desempaquetar_campos(trama.carga, 3)
+            subida = subidas.guardar_completo(alias, destinatario, os.path.basename(nombre_archivo), contenido)
+            cola_mensajes.put((alias, Trama(T_ARCHIVO_FIN, 0, subida.id.encode("ascii"))))
+
+        elif trama.tipo == T_ARCHIVO_INICIO:
+            id_transferencia, destinatario, nombre, tamano = desempaquetar_campos(trama.carga, 4)
+            offset = subidas.iniciar(alias, id_transferencia, destinatario, os.path.basename(nombre), int(tamano))
+            responder(alias, T_ARCHIVO_ACK, empaquetar_campos(id_transferencia, str(offset)))
+
+        elif trama.tipo == T_ARCHIVO_BLOQUE:
+            id_transferencia, offset = subidas.bloque(alias, trama.carga)
+            responder(alias, T_ARCHIVO_ACK, empaquetar_campos(id_transferencia, str(offset)))
+
+        elif trama.tipo == T_ARCHIVO_FIN:
+            id_transferencia, sha256 = desempaquetar_campos(trama.carga, 2)
+            subida = subidas.finalizar(alias, id_transferencia, sha256.decode("ascii"))
+            responder(alias, T_ARCHIVO_FIN, empaquetar_campos(subida.id, subida.sha256))
+            # El reparto sigue el orden normal de los mensajes
+            cola_mensajes.put((alias, Trama(T_ARCHIVO_FIN, 0, subida.id.encode("ascii"))))
+
+    except (ErrorProtocolo, ValueError, OSError) as e:
+        responder(alias, T_ARCHIVO_ERROR, empaquetar_campos(id_transferencia, str(e)))
+
+#IDS DE MENSAJE Y ACUSES
+# (ver acuses.py) procesar_mensajes registra el id antes de repartir y acusa al terminar; un id repetido
+# solo recibe de nuevo el mismo acuse. Los recibos se atienden en el lector del destinatario y van al
+# trabajador del remitente, que es el que tiene el id en su ventana.
+def acusar(alias, id_mensaje, estado, detalle="", propagar=True):
+    if not id_mensaje:
+        return
+    if clientes.get(alias) is None and propagar and bus is not None:
+        # El privado se entregó en otro trabajador: el acuse vuelve por el bus al del remitente
+        bus.enviar_a(alias, "acuse", alias, id_mensaje, estado, detalle)
+        return
+    carga = empaquetar_campos(id_mensaje, estado, detalle)
+    ids.acusar(alias, id_mensaje, carga)
+    metricas.acuses.sumar(1, estado)
+    responder(alias, T_ACUSE, carga)
+
+def repetido(alias, id_mensaje):
+    # True si el id ya se procesó: se le repite el acuse y el mensaje no se reparte otra vez
+    carga = ids.buscar(alias, id_mensaje)
+    if carga is None:
+        return False
+    metricas.duplicados.sumar(1)
+    if carga:
+        responder(alias, T_ACUSE, carga)
+    return True
+
+def atender_recibo(alias, trama):
+    # T_RECIBO de `alias`: ya le llegó el privado `id_mensaje` de `remitente`
+    try:
+        remitente, id_mensaje = desempaquetar_campos(trama.carga, 2)
+        id_mensaje = id_mensaje.decode("utf-8")
+    except (ErrorProtocolo, UnicodeDecodeError) as e:
+        log.warning("Recibo inválido de %s: %s", alias, e)
+        return
+    if clientes.get(remitente) is None and bus is not None:
+        bus.enviar_a(remitente, "recibo", remitente, id_mensaje, alias)
+        return
+    acusar_recibo(remitente, id_mensaje, alias)
+
+def cerrar_privado(remitente, destinatario, texto, id_mensaje, resultado):
+    # Historial y acuse de un privado, en el proceso que decidió qué pasó con él
+    if resultado in RECHAZOS:
+        # No hay a quién entregárselo ni dónde guardarlo: no se acepta ni va al historial
+        acusar(remitente, id_mensaje, RECHAZADO, resultado)
+        log.debug("%s mandó un privado a %s que no se pudo entregar: %s", remitente, destinatario, resultado)
+        return
+    guardar_mensaje(remitente, texto, destinatario)
+    acusar(remitente, id_mensaje, ACEPTADO, EN_BUZON if resultado == GUARDADO else "")
+    log.debug("%s mandó un mensaje privado a %s", remitente, destinatario)
+
+def cerrar_archivo(subida, resultado):
+    # Lo mismo para un archivo: la subida ya terminó, así que un rechazo llega como error de esa transferencia
+    if resultado in RECHAZOS:
+        responder(subida.remitente, T_ARCHIVO_ERROR, empaquetar_campos(
+            subida.id, f"No se pudo entregar a {subida.destinatario}: {resultado}"))
+        return
+    guardar_mensaje(subida.remitente, f"Archivo enviado: {subida.nombre}", subida.destinatario)
+    log.info("%s envió un archivo a %s", subida.remitente, subida.destinatario)
+
+def acusar_recibo(remitente, id_mensaje, destinatario):
+    # Solo cuenta si el id está en la ventana, era para `destinatario` y no se había acusado ya
+    segundos = ids.entregar(remitente, id_mensaje, destinatario)
+    if segundos is None:
+        return
+    metricas.entrega.observar(segundos)
+    metricas.acuses.sumar(1, ENTREGADO)
+    responder(remitente, T_ACUSE, empaquetar_campos(id_mensaje, ENTREGADO, destinatario))
+
+#HISTORIAL POR PÁGINAS
+# Se atiende en el hilo lector del cliente (en asyncio, en el executor): una consulta a la BD
+# no frena a procesar_mensajes ni a los demás clientes.
+def _entrada_historial(fila):
+    id_mensaje, fecha, remitente, destinatario, mensaje = fila
+    return f"{id_mensaje}|{fecha}|{remitente}|{destinatario}|" + mensaje.replace("\x00", "")
+
+def responder_historial(alias, trama):
+    try:
+        conversacion, antes, limite, busqueda = desempaquetar_campos(trama.carga, 4)
+        busqueda = busqueda.decode("utf-8")
+        filas, siguiente = [], None
+        if consultas is not None and (not es_sala(conversacion) or en_sala(alias, conversacion)):
+            # En modo multiproceso los otros trabajadores escriben en la misma BD sin pasar por la caché
+            # de este: ahí se lee siempre de la BD
+            with metricas.consultas.medir("busqueda" if busqueda else "pagina"):
+                filas, siguiente = consultas.pagina(alias, conversacion, antes, limite or 50, busqueda,
+                                                    salas.desde(alias), cache=bus is None)
+    except Exception as e:
+        log.warning("Consulta de historial inválida de %s: %s", alias, e)
+        conversacion, filas, siguiente = "", [], None
+    responder(alias, T_HISTORIAL_PAGINA, empaquetar_campos(
+        conversacion, "" if siguiente is None else str(siguiente), *map(_entrada_historial, filas)))
+
+#HANDSHAKE DE ALIAS
+PROMPT_ALIAS = "Escribe tu alias: "
+
+def detectar_conexion(conn, plazo=None):
+    # El servidor habla primero en texto plano (lo entienden clientes viejos y nuevos).
+    # La primera respuesta decide el modo: si empieza con el byte mágico es un cliente de tramas.
+    # Con `plazo`, todas las lecturas hasta quitar_plazo() vencen en ese instante (socket.timeout).
+    conexion = Conexion(conn, MODO_LEGADO, plazo)
+    conn.send(PROMPT_ALIAS.encode("utf-8"))
+    datos = conexion.recibir_bytes(1024)
+    if es_trama(datos):
+        conexion.modo = MODO_TRAMAS
+        conexion.alimentar(datos)
+        return conexion, None
+    return conexion, datos.decode("utf-8").strip()
+
+def alias_de(trama, conexion):
+    # Además del alias, los flags de T_ALIAS traen los códecs de compresión que entiende el cliente
+    # y si maneja ids y acuses (F_ACUSE)
+    if trama is None:
+        return None
+    if trama.tipo != T_ALIAS:
+        raise ErrorProtocolo(f"Se esperaba el alias y llegó una trama de tipo {trama.tipo}")
+    conexion.codec = compresion.elegir(trama.flags)
+    conexion.acuses = bool(trama.flags & F_ACUSE)
+    return trama.carga.decode("utf-8").strip()
+
+def leer_alias(conexion):
+    # Lee el alias propuesto según el modo de la conexión. Devuelve None si el cliente se fue.
+    if conexion.modo == MODO_LEGADO:
+        datos = conexion.recibir_bytes(1024)
+        return datos.decode("utf-8").strip() if datos else None
+    return alias_de(conexion.recibir(), conexion)
+
+#DESCARGA DE ARCHIVOS COMPARTIDOS
+def servir_descarga(conexion, trama):
+    # Conexión que en vez del alias manda T_ARCHIVO_PEDIR: se le manda el objeto del almacén con
+    # sendfile() (el kernel copia del archivo al socket, sin pasar por memoria de Python) y se cierra.
+    try:
+        archivo, offset, cabecera = abrir_descarga(almacen, trama.carga)
+    except (ErrorProtocolo, ValueError, OSError):
+        conexion.enviar(T_ARCHIVO_ERROR, empaquetar_campos("", "El archivo ya no está disponible"))
+        return
+    with archivo:
+        conexion.enviar_bytes(cabecera)
+        conexion.sock.sendfile(archivo, offset)
+
+def reservar_alias(alias, conexion, ip):
+    # Registra el alias si está libre y devuelve el código asignado; None si ya existe.
+    # La bienvenida es lo primero que entra en la cola de salida del cliente, antes que cualquier reparto.
+    # En modo multiproceso el alias además tiene que estar libre en todos los trabajadores.
+    # Los nombres que empiezan con "#" son de salas: nunca se aceptan como alias.
+    if es_sala(alias) or (bus is not None and not bus.reservar(alias)):
+        conexion.enviar(T_ALIAS_OCUPADO)
+        return None
+    # Todo lo que es de esta conexión se arma antes: con el lock solo se chequea y se publica el alias
+    # Asigna un código de usuario (100–999)
+    codigo = str(random.randint(100, 999))
+    # Solo los clientes de tramas pueden reanudar: a los de texto viejo no se les da sesión
+    sesion = sesiones.Sesion() if conexion.modo == MODO_TRAMAS else None
+    cola = nueva_cola(conexion, alias, sesion)
+    info = {"conn": conexion, "codigo": codigo, "salida": cola, "sesion": sesion, "acuses": conexion.acuses}
     with lock:
-        if destinatario in clientes:
-            try:
-                clientes[destinatario]["conn"].send(
-                    f"{remitente} (Privado): {texto}".encode("utf-8")
-                )
-            except:
-                pass
-
-def enviar_archivo(remitente, destinatario, nombre_archivo, contenido_b64):   
-    # Envía archivos codificados en base64. Se mandan como texto siguiendo el formato FILE:.
-    mensaje = f"FILE:{remitente}:{nombre_archivo}:{contenido_b64}"
-
-    with lock: #Utiliza un objeto lock (cerrojo) para asegurar que el acceso al diccionario compartido clientes sea seguro
-        if destinatario.lower() == "todos":
-            for alias, info in clientes.items(): #itera sobre clientes conectados
-                if alias != remitente:
-                    try:
-                        info["conn"].send(mensaje.encode("utf-8"))
-                    except:
-                        pass
-        elif destinatario in clientes: #enviar el archivo directamente
-            try:
-                clientes[destinatario]["conn"].send(mensaje.encode("utf-8"))
-            except:
-                pass
-
-def enviar_lista_usuarios():
-    #Notifica a todos los clientes la lista actualizada de usuarios conectados.
+        # Evita duplicados
+        ocupado = alias in clientes or alias in reservas
+        if not ocupado:
+            reservas.add(alias)
+
+    if ocupado:
+        conexion.enviar(T_ALIAS_OCUPADO)
+        return None
+    # El buzón se marca con el nombre ya reservado y antes de publicarlo: lo que llegue desde ahora va
+    # detrás de lo que ya tiene en el buzón, y el lock del buzón nunca se toma dentro del lock global
+    buzon.marcar(alias)
     with lock:
-        lista = [f"{info['codigo']}|{alias}" for alias, info in clientes.items()]
-        mensaje = ",".join(lista)
+        reservas.discard(alias)
+        clientes.agregar(alias, info)
+        presencia.unir(alias, codigo)
+    presencia.enviar_foto(info)
+    # REGISTRO BD
+    registrar_conexion(alias, codigo, ip)
+    if bus is not None:
+        bus.unir(alias, codigo)
+    iniciar_escritor(conexion, cola)
+    # Lo que le llegó mientras no estaba, en orden y de a lotes, sin el lock global
+    vaciar_buzon(alias, info, cola)
+    return codigo
+
+def vaciar_buzon(alias, info, cola):
+    buzon.vaciar(alias, lambda tipo, carga: encolar_trama(info, TramaCompartida(tipo, carga)),
+                 lambda cantidad: cola.esperar_lugar(cantidad, cola.espera_maxima))
+
+def nueva_cola(conexion, alias, sesion, base=0):
+    # Cola de salida de una conexión recién aceptada: la bienvenida va primero que cualquier otra cosa.
+    # En sus flags va el códec elegido (desde ahí el cliente puede recibir y mandar comprimido) y F_ACUSE
+    # si el cliente lo ofreció; en la carga el token de sesión y la secuencia desde la que se cuenta.
+    cola = ColaSalida(CAPACIDAD_SALIDA, POLITICA_SALIDA, vector=VECTOR_SALIDA, demora=DEMORA_SALIDA)
+    cola.al_desbordar = conexion.close
+    bandera = (conexion.codec.bandera if conexion.codec else 0) | (F_ACUSE if conexion.acuses else 0)
+    cola.encolar(conexion.codificar(T_BIENVENIDA, sesiones.carga_bienvenida(alias, sesion, base), bandera))
+    return cola
+
+def reanudar_sesion(conexion, trama):
+    # T_REANUDAR en lugar de T_ALIAS: si el token es el de la sesión del alias, la conexión nueva toma su
+    # lugar (aunque la vieja todavía no se haya dado cuenta del corte) y recibe lo que quedó en el anillo.
+    # Devuelve el alias, o None si hay que hacer el handshake normal.
+    try:
+        alias, token, ultima = sesiones.leer_reanudacion(trama.carga)
+    except (ErrorProtocolo, ValueError):
+        return None
+    conexion.codec = compresion.elegir(trama.flags)
+    conexion.acuses = bool(trama.flags & F_ACUSE)
+    # No hace falta el lock del registro: el cambio de conexión se ordena con el lock de la sesión, que
+    # también toman soltar_cliente y vencer_sesion antes de tocar esta entrada
+    info = clientes.get(alias)
+    sesion = info["sesion"] if info else None
+    if sesion is None or not sesion.valida(token):
+        metricas.reanudaciones.sumar(1, "rechazada")
+        return None
+    with sesion.lock:
+        if clientes.get(alias) is not info:
+            metricas.reanudaciones.sumar(1, "rechazada")
+            return None  # la sesión venció justo ahora
+        anterior, vieja = info["conn"], info["salida"]
+        buzon.marcar(alias)  # lo que quedó en el buzón durante el corte va antes que lo nuevo
+        base, perdidos = sesion.reanudar(ultima)
+        cola = nueva_cola(conexion, alias, sesion, base)
+        for tipo, carga in perdidos:
+            cola.encolar(conexion.codificar(tipo, carga))
+        info["conn"], info["salida"], info["acuses"] = conexion, cola, conexion.acuses
+    presencia.enviar_foto(info)
+    vieja.cerrar()
+    if anterior is not conexion:
+        anterior.close()
+    metricas.reanudaciones.sumar(1, "aceptada")
+    metricas.repetidos.sumar(len(perdidos))
+    iniciar_escritor(conexion, cola)
+    log.info("%s reanudó su sesión (%d mensajes reenviados)", alias, len(perdidos))
+    vaciar_buzon(alias, info, cola)
+    return alias
+
+def soltar_cliente(alias, conexion, definitivo):
+    # Se terminó la conexión de `alias`. Con T_SALIR (o sin sesión) se libera todo; si fue un corte,
+    # el alias queda reservado GRACIA_SESION segundos y sigue en la presencia esperando que vuelva.
+    # Un corte solo toca la sesión; el lock del registro se toma únicamente para sacar el alias.
+    info = clientes.get(alias)
+    if info is None:
+        return
+    sesion = info["sesion"]
+    if sesion is None:
+        with lock:
+            if clientes.get(alias) is not info or info["conn"] is not conexion:
+                return
+            clientes.quitar(alias)
+            presencia.salir(alias)
+    elif definitivo:
+        with lock, sesion.lock:
+            if clientes.get(alias) is not info or info["conn"] is not conexion:
+                return  # ya la reemplazó una reanudación
+            clientes.quitar(alias)
+            presencia.salir(alias)
+    else:
+        with sesion.lock:
+            if info["conn"] is not conexion:
+                return  # ya la reemplazó una reanudación
+            corte = sesion.cortar()
+    info["salida"].cerrar()
+    if definitivo or sesion is None:
+        terminar_cliente(alias)
+        return
+    temporizador = threading.Timer(GRACIA_SESION, vencer_sesion, (alias, sesion, corte))
+    temporizador.daemon = True
+    temporizador.start()
+    log.info("%s perdió la conexión; su sesión se guarda %s s", alias, GRACIA_SESION)
+
+def vencer_sesion(alias, sesion, corte):
+    # Orden de los locks: primero el del registro, después el de la sesión (nunca al revés)
+    with lock, sesion.lock:
+        info = clientes.get(alias)
+        if info is None or info["sesion"] is not sesion or sesion.cortada is None or sesion.cortes != corte:
+            return  # se reanudó (o volvió a cortarse y corre otro temporizador)
+        clientes.quitar(alias)
+        presencia.salir(alias)
+    metricas.reanudaciones.sumar(1, "vencida")
+    terminar_cliente(alias)
+
+def terminar_cliente(alias):
+    subidas.abandonar(alias)
+    dejar_salas(alias)
+    liberar_alias(alias)
+    registrar_desconexion(alias)
+    log.info("%s se ha desconectado", alias)
+
+def liberar_alias(alias):
+    # Después de sacar al cliente de `clientes`: el alias vuelve a quedar libre en los demás trabajadores
+    if bus is not None:
+        bus.salir(alias)
 
-        for info in clientes.values():
-            try:
-                info["conn"].send(mensaje.encode("utf-8"))
-            except:
-                pass
+#ADMISIÓN Y LÍMITES POR CLIENTE
+# (ver admision.py) El tope de conexiones se chequea al aceptar, antes de crear el hilo o la tarea.
+# Cada trama que llega pasa por admitir() en el lector de su cliente, antes de encolarla, y la cola
+# de entrada es acotada: lo que no entra se descarta y se le avisa al cliente con T_LIMITE.
+def rechazo(motivo):
+    # Antes del handshake no se sabe si el cliente habla tramas: el rechazo va en texto plano
+    metricas.limites.sumar(1, motivo)
+    return f"{RECHAZO} {TEXTOS[motivo]}".encode("utf-8")
+
+def rechazar_conexion(conn, addr, motivo):
+    log.info("Conexión de %s rechazada (%s)", addr, motivo)
+    try:
+        # Sin bloquear el ciclo de aceptación: el texto entra de sobra en el búfer de un socket nuevo
+        conn.setblocking(False)
+        conn.send(rechazo(motivo))
+    except OSError:
+        pass
+    conn.close()
+
+def avisar_limite(alias, motivo, segundos=0.0):
+    # A lo sumo un aviso cada tanto por motivo: a un cliente que inunda no se le contesta con otra inundación
+    if limitador.avisar(alias, motivo):
+        responder(alias, T_LIMITE, empaquetar_campos(motivo, f"{segundos:.1f}", TEXTOS[motivo]))
+
+def admitir(alias, ip, trama):
+    # Devuelve (aceptada, espera): si la trama sigue adelante y cuántos segundos tiene que dejar de leer
+    # el lector de este cliente por haberse pasado de bytes. Los bloques y el fin de un archivo y los recibos
+    # solo cuentan bytes (un recibo por privado recibido no tiene que gastar las fichas de los mensajes propios).
+    # El inicio de una subida sí gasta una ficha: abre un archivo en disco.
+    espera, motivo = limitador.datos(alias, ip, len(trama.carga) + CABECERA.size)
+    if motivo:
+        metricas.limites.sumar(1, motivo)
+        avisar_limite(alias, motivo, espera)
+    if (trama.tipo in TIPOS_TRANSFERENCIA and trama.tipo != T_ARCHIVO_INICIO) or trama.tipo == T_RECIBO:
+        return True, espera
+    motivo, segundos = limitador.mensaje(alias, ip)
+    if motivo:
+        metricas.limites.sumar(1, motivo)
+        avisar_limite(alias, motivo, segundos)
+        return False, espera
+    return True, espera
+
+def encolar_entrada(alias, trama):
+    # Si procesar_mensajes no da abasto se descarta lo nuevo en vez de dejar crecer la memoria sin límite.
+    # Lo que encola el propio servidor (el fin de una subida ya guardada) no pasa por acá.
+    if CAPACIDAD_ENTRADA and cola_mensajes.qsize() >= CAPACIDAD_ENTRADA:
+        metricas.limites.sumar(1, COLA_LLENA)
+        avisar_limite(alias, COLA_LLENA)
+        return False
+    cola_mensajes.put((alias, trama))
+    return True
 
 #MANEJO PRINCIPAL DE CLIENTES (THREAD POR CLIENTE)
 def manejar_cliente(conn, addr):
     #Atiende un cliente desde que se conecta hasta que se desconecta. Se ejecuta en un hilo independiente por cada usuario.
    
     alias = ""
+    registrado = False
+    salio = False
+    conexion = Conexion(conn, MODO_LEGADO)
+    inicio = time.perf_counter()
+    # Todo el handshake tiene un plazo: quien se conecta y no manda nada no retiene el hilo para siempre
+    plazo = time.monotonic() + TIEMPO_HANDSHAKE if TIEMPO_HANDSHAKE else None
 
     try:
         # Solicitar alias único
-        while True:
-            conn.send("Escribe tu alias: ".encode("utf-8"))
-            alias = conn.recv(1024).decode("utf-8").strip()
-
-            with lock:
-                # Evita duplicados
-                if alias in clientes:
-                    conn.send("ALIAS_TAKEN".encode("utf-8"))
-                    continue
-                else:
-                    # Asigna un código de usuario (100–999)
-                    codigo = str(random.randint(100, 999))
-                    clientes[alias] = {"conn": conn, "codigo": codigo}
-                    conn.send(f"Bienvenido, {alias}.\n".encode("utf-8"))
+        conexion, alias = detectar_conexion(conn, plazo)
+        if alias is None:
+            trama = conexion.recibir()
+            if trama is not None and trama.tipo == T_ARCHIVO_PEDIR:
+                conexion.quitar_plazo()
+                servir_descarga(conexion, trama)
+                return
+            if trama is not None and trama.tipo == T_REANUDAR:
+                alias = reanudar_sesion(conexion, trama)
+                registrado = alias is not None
+                if not registrado:
+                    # Sesión vencida o inválida: se sigue con el handshake normal
+                    conexion.enviar(T_ALIAS, PROMPT_ALIAS)
+                    alias = leer_alias(conexion)
+            else:
+                alias = alias_de(trama, conexion)
+        while alias and not registrado:
+            if reservar_alias(alias, conexion, addr[0]):
+                registrado = True
+                break
+            conexion.enviar(T_ALIAS, PROMPT_ALIAS)
+            alias = leer_alias(conexion)
 
-                    # REGISTRO BD
-                    registrar_conexion(alias, codigo, addr[0])
-                    break
+        if not registrado:
+            return
 
-        print(f"{alias} se ha conectado desde {addr}")
-        enviar_lista_usuarios()
+        conexion.quitar_plazo()
+        metricas.handshake.observar(time.perf_counter() - inicio)
+        log.info("%s se ha conectado desde %s (protocolo %s)", alias, addr, conexion.modo)
 
         # Ciclo principal de recepción de mensajes
         while True:
-            mensaje = conn.recv(10_000_000).decode("utf-8")
-            if not mensaje or mensaje.lower() == "salir":
+            trama = conexion.recibir()
+            if trama is None:
                 break
-            cola_mensajes.put((alias, mensaje))
+            if trama.tipo == T_SALIR:
+                salio = True
+                break
+            metricas.recibido(trama)
+            aceptada, espera = admitir(alias, addr[0], trama)
+            if espera:
+                # Se pasó de bytes: mientras este hilo no lee, TCP frena al cliente
+                time.sleep(espera)
+            if not aceptada:
+                continue
+            if trama.tipo in TIPOS_A_DISCO:
+                atender_transferencia(alias, trama)
+                continue
+            if trama.tipo == T_HISTORIAL_PEDIR:
+                responder_historial(alias, trama)
+                continue
+            if trama.tipo == T_RECIBO:
+                atender_recibo(alias, trama)
+                continue
+            encolar_entrada(alias, trama)
+
+    except socket.timeout:
+        metricas.limites.sumar(1, HANDSHAKE)
+        log.info("%s no terminó el handshake a tiempo", addr)
 
     except Exception as e:
-        print(f"Error con cliente {addr}: {e}")
+        log.warning("Error con cliente %s: %s", addr, e)
 
     finally:
-        # Eliminar usuario de lista global
-        with lock:
-            if alias in clientes:
-                del clientes[alias]
-
-        registrar_desconexion(alias)
-        conn.close()
-        print(f"{alias} se ha desconectado")
-        enviar_lista_usuarios()
+        conexion.close()
+        admision.salir(addr[0])
+        if registrado:
+            # Eliminar usuario de lista global (o reservarlo un rato si fue un corte)
+            soltar_cliente(alias, conexion, salio)
 
 #PROCESADOR DE MENSAJES
 def procesar_mensajes():  
     #Hilo que procesa todos los mensajes encolados, garantiza orden y evita condiciones de carrera.
   
     while True:
-        alias, mensaje = cola_mensajes.get()
-
-        if mensaje.startswith("MSG_ALL:"):
-            texto = mensaje[len("MSG_ALL:"):]
-            broadcast(texto, alias)
-            guardar_mensaje_json(alias, texto, "Todos")
-            print(f"{alias} mandó un mensaje público")
-
-        elif mensaje.startswith("MSG_PRIVATE:"):
-            partes = mensaje.split(":", 2)
-            if len(partes) == 3:
-                destinatario = partes[1]
-                texto = partes[2]
-                enviar_privado(destinatario, texto, alias)
-                guardar_mensaje_json(alias, texto, destinatario)
-                print(f"{alias} mandó un mensaje privado a {destinatario}")
-
-        elif mensaje.startswith("FILE:"):
-            partes = mensaje.split(":", 3)
-            if len(partes) == 4:
-                destinatario = partes[1]
-                nombre_archivo = partes[2]
-                contenido_b64 = partes[3]
-                enviar_archivo(alias, destinatario, nombre_archivo, contenido_b64)
-                guardar_mensaje_json(alias, f"Archivo enviado: {nombre_archivo}", destinatario)
-                print(f"{alias} envió un archivo a {destinatario}")
+        alias, trama = cola_mensajes.get()
+        inicio = time.perf_counter()
+        id_mensaje = ""
+
+        try:
+            # Con id (ver acuses.py): se registra antes de repartir y se acusa al final
+            id_mensaje, trama = separar_id(trama)
+            if id_mensaje and repetido(alias, id_mensaje):
+                log.debug("%s reintentó un mensaje ya procesado", alias)
 
+            elif trama.tipo == T_MSG_ALL:
+                texto = trama.carga.decode("utf-8")
+                if id_mensaje:
+                    ids.registrar(alias, id_mensaje)
+                broadcast(texto, alias)
+                guardar_mensaje(alias, texto, "Todos")
+                acusar(alias, id_mensaje, ACEPTADO)
+                log.debug("%s mandó un mensaje público", alias)
+
+            elif trama.tipo == T_MSG_PRIVADO:
+                # El destinatario puede ser un alias o una sala
+                destinatario, texto = desempaquetar_campos(trama.carga, 2)
+                texto = texto.decode("utf-8")
+                if id_mensaje:
+                    ids.registrar(alias, id_mensaje, None if es_sala(destinatario) else destinatario)
+                if not es_sala(destinatario):
+                    resultado = enviar_privado(destinatario, texto, alias, id_mensaje=id_mensaje)
+                    if resultado != REMOTO:
+                        cerrar_privado(alias, destinatario, texto, id_mensaje, resultado)
+                elif en_sala(alias, destinatario):
+                    broadcast(texto, alias, destinatario)
+                    guardar_mensaje(alias, texto, destinatario)
+                    acusar(alias, id_mensaje, ACEPTADO)
+                    log.debug("%s mandó un mensaje a la sala %s", alias, destinatario)
+                else:
+                    acusar(alias, id_mensaje, RECHAZADO, "No estás en la sala")
+
+            elif trama.tipo == T_ARCHIVO_FIN:
+                # Subida ya guardada en disco por atender_transferencia (por bloques o entera)
+                subida = subidas.completa(trama.carga.decode("ascii"))
+                if not es_sala(subida.destinatario) or en_sala(alias, subida.destinatario):
+                    resultado = enviar_archivo(subida)
+                    if resultado != REMOTO:
+                        cerrar_archivo(subida, resultado)
+
+            elif trama.tipo == T_SALA:
+                atender_sala(alias, trama)
+
+            elif trama.tipo == T_PRESENCIA_FOTO:
+                enviar_foto_presencia(alias)
+
+        except Exception as e:
+            log.warning("Mensaje inválido de %s: %s", alias, e)
+            acusar(alias, id_mensaje, RECHAZADO, "Mensaje inválido")
+
+        metricas.procesamiento.observar(time.perf_counter() - inicio, metricas.NOMBRES_TIPO.get(trama.tipo))
         cola_mensajes.task_done()
 
 #INTERFAZ GRÁFICA (TKINTER)
+# tkinter se importa recién cuando se pide la ventana (servicio.py --interfaz): sin interfaz no se carga
+tk = scrolledtext = None
+
+def importar_tk():
+    # Devuelve False si no hay tkinter (benchmarks, máquinas sin pantalla): el servidor sigue sin ventana
+    global tk, scrolledtext
+    try:
+        import tkinter as tk
+        from tkinter import scrolledtext
+    except ImportError:
+        return False
+    return True
+
 class InterfazServidor:
     #Interfaz gráfica que muestra actividad del servidor en tiempo real, Personalizada con colores suaves y botones útiles.
-    def __init__(self, root):
+    # Es un lector más de los logs: cada INTERVALO_MS el hilo de Tk toma una tanda del búfer circular
+    # de registro.py y la inserta de una sola vez. Los hilos del servidor nunca tocan la ventana.
+    # El panel de estadísticas se arma con metricas.resumen() una vez por segundo.
+    INTERVALO_MS = 200
+    INTERVALO_METRICAS_MS = 1000
+    MAX_LINEAS = 5000
+
+    def __init__(self, root, bufer):
         self.root = root
         self.root.title("Servidor de Chat")
         self.root.geometry("600x400")
@@ -242,6 +962,18 @@ class InterfazServidor:
         )
         self.area_texto.pack(expand=True, fill='both', padx=10, pady=10)
 
+        # Panel de estadísticas en vivo
+        self.etiqueta_metricas = tk.Label(
+            root,
+            text="",
+            justify=tk.LEFT,
+            anchor="w",
+            bg=fondo_general,
+            fg=texto_color,
+            font=("Consolas", 9)
+        )
+        self.etiqueta_metricas.pack(fill="x", padx=10)
+
         # Botonera
         self.frame_botones = tk.Frame(root, bg=fondo_general)
         self.frame_botones.pack(fill="x", pady=5)
@@ -268,21 +1000,44 @@ class InterfazServidor:
         )
         self.boton_salir.pack(side=tk.RIGHT, padx=10)
 
-        # Redirección de print() hacia la interfaz
-        self._stdout = print
-        self.redirigir_print()
+        self.bufer = bufer
+        self.root.after(self.INTERVALO_MS, self.leer_logs)
+        self._anterior = (time.monotonic(), 0)
+        self.root.after(self.INTERVALO_METRICAS_MS, self.actualizar_metricas)
 
-    def redirigir_print(self):
-        #Redirige todo lo que se imprime en consola hacia la interfaz gráfica.
-    
-        def nuevo_print(*args, **kwargs):
-            texto = " ".join(str(arg) for arg in args)
+    def leer_logs(self):
+        #Vuelca en la ventana las líneas de log nuevas (una inserción por tanda, no una por línea).
+        tanda = self.bufer.tomar()
+        if tanda:
             self.area_texto.config(state='normal')
-            self.area_texto.insert(tk.END, texto + "\n")
+            self.area_texto.insert(tk.END, "\n".join(tanda) + "\n")
+            # La ventana también es acotada: se borran las líneas más viejas
+            sobrantes = int(self.area_texto.index("end-1c").split(".")[0]) - self.MAX_LINEAS
+            if sobrantes > 0:
+                self.area_texto.delete("1.0", f"{sobrantes + 1}.0")
             self.area_texto.config(state='disabled')
             self.area_texto.yview(tk.END)
-            self._stdout(*args, **kwargs)
-        globals()['print'] = nuevo_print
+        self.root.after(self.INTERVALO_MS, self.leer_logs)
+
+    def actualizar_metricas(self):
+        #Refresca el panel de estadísticas (mensajes por segundo calculados contra la lectura anterior).
+        datos = metricas.resumen()
+        ahora = time.monotonic()
+        instante, mensajes = self._anterior
+        por_segundo = (datos["mensajes"] - mensajes) / max(ahora - instante, 1e-6)
+        self._anterior = (ahora, datos["mensajes"])
+        ms = lambda v: "-" if v is None else f"{v:g} ms"
+        self.etiqueta_metricas.config(text=(
+            f"Conectados: {datos['conectados']}   Mensajes: {datos['mensajes']} ({por_segundo:.1f}/s)   "
+            f"Cola: {datos['cola_mensajes']}   Disco pendiente: {datos['persistencia_pendiente']}\n"
+            f"Entrada: {datos['bytes_entrada'] / 1024:.0f} KB   Salida: {datos['bytes_salida'] / 1024:.0f} KB   "
+            f"Lock disputado: {datos['lock_disputado']} (p99 {ms(datos['lock_espera_p99_ms'])})\n"
+            f"Handshake p50/p99: {ms(datos['handshake_p50_ms'])} / {ms(datos['handshake_p99_ms'])}   "
+            f"Envío p99: {ms(datos['envio_p99_ms'])}   Escritura BD p99: {ms(datos['escritura_p99_ms'])}   "
+            f"Limitados: {datos['limitados']}\n"
+            f"Reintentos repetidos: {datos['duplicados']}   Recibo de entrega p99: {ms(datos['entrega_p99_ms'])}"
+        ))
+        self.root.after(self.INTERVALO_METRICAS_MS, self.actualizar_metricas)
 
     def limpiar_texto(self):
         #Limpia la ventana de logs.
@@ -292,34 +1047,47 @@ class InterfazServidor:
 
     def cerrar_servidor(self):
         #Cierra servidor y finaliza la aplicación.
-        print("Servidor cerrado manualmente.")
+        log.info("Servidor cerrado manualmente.")
+        cerrar()
         self.root.quit()
         os._exit(0)
 
-#MAIN DEL SERVIDOR
-if __name__ == "__main__":
+#ARRANQUE DEL SERVIDOR (MODO HILOS)
+def aceptar_conexiones(servidor):
+    #Acepta nuevos clientes y lanza un hilo por cada uno (si no se pasaron del tope de conexiones).
+
+    while True:
+        conn, addr = servidor.accept()
+        motivo = admision.entrar(addr[0])
+        if motivo:
+            rechazar_conexion(conn, addr, motivo)
+            continue
+        hilo = threading.Thread(target=manejar_cliente, args=(conn, addr), daemon=True)
+        hilo.start()
+
+def iniciar_servidor(host, puerto, backlog=1024, reuse_port=False):
+    # Abre el socket y arranca los hilos de aceptación y de procesamiento. Devuelve el socket del servidor.
+    # reuse_port permite que varios procesos (cluster.py) escuchen en el mismo puerto.
+    preparar()
     servidor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    servidor.bind(("10.18.90.109", 5010))
-    servidor.listen(5)
-    print("Servidor en espera de conexiones...")
+    servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    servidor.bind((host, puerto))
+    servidor.listen(backlog)
+    log.info("Servidor en espera de conexiones en %s:%s", host, puerto)
 
     # Thread que procesa mensajes
     threading.Thread(target=procesar_mensajes, daemon=True).start()
 
-    def aceptar_conexiones():
-        #Acepta nuevos clientes y lanza un hilo por cada uno.
-    
-        while True:
-            conn, addr = servidor.accept()
-            hilo = threading.Thread(target=manejar_cliente, args=(conn, addr))
-            hilo.start()
-
     # Thread que acepta conexiones
-    threading.Thread(target=aceptar_conexiones, daemon=True).start()
-
-    # Inicia interfaz gráfica
-    root = tk.Tk()
-    app = InterfazServidor(root)
-    root.mainloop()
-
+    threading.Thread(target=aceptar_conexiones, args=(servidor,), daemon=True).start()
+    return servidor
 
+#MAIN DEL SERVIDOR
+# El arranque (host, puerto, BD, modo, con o sin interfaz) está en servicio.py; esto equivale a
+# `python servicio.py --interfaz`.
+if __name__ == "__main__":
+    import sys
+    import servicio
+    servicio.main(["--interfaz"] + sys.argv[1:])
@@ -0,0 +1,289 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+
+import servidor
+import metricas
+from admision import HANDSHAKE
+from transferencias import abrir_descarga
+from protocolo import (
+    DecodificadorTramas, ErrorProtocolo, codificar_para, desde_legado, es_trama, empaquetar_campos,
+    MODO_TRAMAS, MODO_LEGADO, RECV_TRAMAS, RECV_LEGADO, T_ALIAS, T_SALIR,
+    T_ARCHIVO_PEDIR, T_ARCHIVO_ERROR, T_HISTORIAL_PEDIR, T_REANUDAR, T_RECIBO
+)
+
+# SERVIDOR CON ASYNCIO
+# Un solo hilo con el event loop atiende todas las conexiones (lectura y handshake),
+# en lugar de un hilo del sistema por cliente. El ruteo sigue siendo el de servidor.py:
+# broadcast, enviar_privado, enviar_archivo y la presencia trabajan con el
+# diccionario `clientes`, solo que ahí se guarda una ConexionAsync en vez de una Conexion.
+
+log = logging.getLogger("chat.asyncio")
+
+
+class ConexionAsync:
+    # Misma interfaz de envío que protocolo.Conexion, pero escribe en un StreamWriter.
+    # Se puede llamar desde cualquier hilo (por ejemplo desde procesar_mensajes):
+    # la escritura real siempre se agenda en el event loop.
+    def __init__(self, reader, writer, modo, loop, plazo=None):
+        self.reader = reader
+        self.writer = writer
+        self.modo = modo
+        self.loop = loop
+        self.codec = None
+        self.acuses = False
+        self.plazo = plazo  # como en protocolo.Conexion: instante (time.monotonic) en que vence el handshake
+        self._decodificador = DecodificadorTramas()
+        self._pendientes = deque()
+
+    def codificar(self, tipo, carga=b"", flags=0):
+        return codificar_para(self.modo, tipo, carga, flags, self.codec)
+
+    def enviar_bytes(self, datos):
+        if self.writer.is_closing():
+            raise ConnectionError("Conexión cerrada")
+        self.loop.call_soon_threadsafe(self.writer.write, datos)
+
+    def enviar(self, tipo, carga=b"", flags=0):
+        self.enviar_bytes(self.codificar(tipo, carga, flags))
+
+    def alimentar(self, datos):
+        self._pendientes.extend(self._decodificador.alimentar(datos))
+
+    async def leer(self, tamano):
+        # reader.read que, con un plazo puesto, no espera más allá de ese instante (asyncio.TimeoutError)
+        if self.plazo is None:
+            return await self.reader.read(tamano)
+        return await asyncio.wait_for(self.reader.read(tamano), max(0.0, self.plazo - time.monotonic()))
+
+    async def recibir(self):
+        # Devuelve la siguiente trama completa, o None si el otro extremo cerró la conexión.
+        if self.modo == MODO_LEGADO:
+            while True:
+                datos = await self.leer(RECV_LEGADO)
+                if not datos:
+                    return None
+                trama = desde_legado(datos.decode("utf-8"))
+                if trama is not None:
+                    return trama
+
+        while not self._pendientes:
+            datos = await self.leer(RECV_TRAMAS)
+            if not datos:
+                return None
+            self.alimentar(datos)
+        return self._pendientes.popleft()
+
+    async def leer_alias(self):
+        # Igual que servidor.leer_alias, pero sin bloquear el event loop.
+        if self.modo == MODO_LEGADO:
+            datos = await self.leer(1024)
+            return datos.decode("utf-8").strip() if datos else None
+        return servidor.alias_de(await self.recibir(), self)
+
+    def iniciar_escritor(self, cola):
+        # Tarea del event loop que vacía la cola de salida del cliente. Puede llamarse desde otro hilo.
+        evento = asyncio.Event()
+        cola.al_encolar = lambda: self.loop.call_soon_threadsafe(evento.set)
+        self.loop.call_soon_threadsafe(lambda: self.loop.create_task(self._escribir(cola, evento)))
+
+    async def _escribir(self, cola, evento):
+        try:
+            while True:
+                lote = cola.tomar_lote()
+                if lote is None:
+                    break
+                if not lote:
+                    await evento.wait()
+                    evento.clear()
+                    continue
+                if cola.demora and len(lote) < cola.vector:
+                    # Ventana corta para juntar más tramas chicas en la misma escritura
+                    await asyncio.sleep(cola.demora)
+                    lote += cola.tomar_lote() or []
+                inicio = time.perf_counter()
+                tamano = 0
+                escrituras = 0
+                juntas = []
+                for datos in lote:
+                    if isinstance(datos, (bytes, bytearray)):
+                        juntas.append(datos)
+                        tamano += len(datos)
+                        if len(juntas) >= cola.vector:
+                            escrituras += self._escribir_varios(juntas)
+                            juntas = []
+                    else:
+                        # Envíos largos (archivos por bloques): se drena después de cada parte. Cada parte
+                        # se lee del disco (y se comprime) en el executor; en el loop solo se escribe
+                        if juntas:
+                            escrituras += self._escribir_varios(juntas)
+                            juntas = []
+                        partes = iter(datos)
+                        while True:
+                            parte = await self.loop.run_in_executor(None, next, partes, None)
+                            if parte is None:
+                                break
+                            self.writer.write(parte)
+                            tamano += len(parte)
+                            escrituras += 1
+                            await self.writer.drain()
+                if juntas:
+                    escrituras += self._escribir_varios(juntas)
+                await self.writer.drain()
+                cola.marcar_enviados(len(lote), time.perf_counter() - inicio, tamano, escrituras)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            cola.cerrar()
+            self.writer.close()
+
+    def _escribir_varios(self, partes):
+        # writelines entrega el lote entero al transporte, que lo manda en una sola escritura
+        if len(partes) == 1:
+            self.writer.write(partes[0])
+        else:
+            self.writer.writelines(partes)
+        return 1
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+async def servir_descarga(conexion, trama):
+    # Igual que servidor.servir_descarga: loop.sendfile usa os.sendfile sobre el socket del transporte.
+    try:
+        archivo, offset, cabecera = abrir_descarga(servidor.almacen, trama.carga)
+    except (ErrorProtocolo, ValueError, OSError):
+        conexion.writer.write(conexion.codificar(T_ARCHIVO_ERROR, empaquetar_campos("", "El archivo ya no está disponible")))
+        await conexion.writer.drain()
+        return
+    with archivo:
+        conexion.writer.write(cabecera)
+        await conexion.writer.drain()
+        await conexion.loop.sendfile(conexion.writer.transport, archivo, offset)
+
+
+async def manejar_cliente(reader, writer):
+    # Versión asíncrona de servidor.manejar_cliente: mismo handshake de alias y mismo ciclo de recepción.
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info("peername")
+    motivo = servidor.admision.entrar(addr[0])
+    if motivo:
+        log.info("Conexión de %s rechazada (%s)", addr, motivo)
+        writer.write(servidor.rechazo(motivo))
+        writer.close()
+        return
+    alias = ""
+    registrado = False
+    salio = False
+    plazo = time.monotonic() + servidor.TIEMPO_HANDSHAKE if servidor.TIEMPO_HANDSHAKE else None
+    conexion = ConexionAsync(reader, writer, MODO_LEGADO, loop, plazo)
+    inicio = time.perf_counter()
+
+    try:
+        # El primer mensaje del cliente decide si habla tramas o texto viejo
+        writer.write(servidor.PROMPT_ALIAS.encode("utf-8"))
+        datos = await conexion.leer(1024)
+        if es_trama(datos):
+            conexion.modo = MODO_TRAMAS
+            conexion.alimentar(datos)
+            trama = await conexion.recibir()
+            if trama is not None and trama.tipo == T_ARCHIVO_PEDIR:
+                conexion.plazo = None
+                await servir_descarga(conexion, trama)
+                return
+            if trama is not None and trama.tipo == T_REANUDAR:
+                alias = await loop.run_in_executor(None, servidor.reanudar_sesion, conexion, trama)
+                registrado = alias is not None
+                if not registrado:
+                    # Sesión vencida o inválida: se sigue con el handshake normal
+                    conexion.enviar(T_ALIAS, servidor.PROMPT_ALIAS)
+                    alias = await conexion.leer_alias()
+            else:
+                alias = servidor.alias_de(trama, conexion)
+        else:
+            alias = datos.decode("utf-8").strip()
+
+        while alias and not registrado:
+            # reservar_alias toca la BD: se ejecuta fuera del event loop
+            if await loop.run_in_executor(None, servidor.reservar_alias, alias, conexion, addr[0]):
+                registrado = True
+                break
+            conexion.enviar(T_ALIAS, servidor.PROMPT_ALIAS)
+            alias = await conexion.leer_alias()
+
+        if not registrado:
+            return
+
+        conexion.plazo = None
+        metricas.handshake.observar(time.perf_counter() - inicio)
+        log.info("%s se ha conectado desde %s (protocolo %s, asyncio)", alias, addr, conexion.modo)
+
+        # Ciclo principal de recepción: los mensajes van a la misma cola que en el modo hilos
+        while True:
+            trama = await conexion.recibir()
+            if trama is None:
+                break
+            if trama.tipo == T_SALIR:
+                salio = True
+                break
+            metricas.recibido(trama)
+            aceptada, espera = servidor.admitir(alias, addr[0], trama)
+            if espera:
+                # Se pasó de bytes: mientras no se lee de este cliente, TCP lo frena
+                await asyncio.sleep(espera)
+            if not aceptada:
+                continue
+            if trama.tipo in servidor.TIPOS_A_DISCO:
+                # Escribe el bloque (o el archivo entero) a disco y calcula su sha256 al terminar:
+                # fuera del event loop. Se espera antes de leer la trama siguiente, así el orden se mantiene.
+                await loop.run_in_executor(None, servidor.atender_transferencia, alias, trama)
+                continue
+            if trama.tipo == T_HISTORIAL_PEDIR:
+                await loop.run_in_executor(None, servidor.responder_historial, alias, trama)
+                continue
+            if trama.tipo == T_RECIBO:
+                servidor.atender_recibo(alias, trama)
+                continue
+            servidor.encolar_entrada(alias, trama)
+
+    except asyncio.TimeoutError:
+        metricas.limites.sumar(1, HANDSHAKE)
+        log.info("%s no terminó el handshake a tiempo", addr)
+
+    except Exception as e:
+        log.warning("Error con cliente %s: %s", addr, e)
+
+    finally:
+        writer.close()
+        servidor.admision.salir(addr[0])
+        if registrado:
+            # Mismo cierre que en el modo hilos (con reserva del alias si fue un corte)
+            await loop.run_in_executor(None, servidor.soltar_cliente, alias, conexion, salio)
+
+
+async def servir(host, puerto, backlog=1024, reuse_port=False):
+    # Arranca el hilo procesador de mensajes y el servidor asyncio; corre hasta que se cancele.
+    servidor.preparar()
+    threading.Thread(target=servidor.procesar_mensajes, daemon=True).start()
+    server = await asyncio.start_server(manejar_cliente, host, puerto, backlog=backlog, reuse_address=True,
+                                        reuse_port=reuse_port)
+    log.info("Servidor asyncio en espera de conexiones en %s:%s", host, puerto)
+    async with server:
+        await server.serve_forever()
+
+
+def iniciar_servidor(host, puerto, backlog=1024):
+    # Equivalente a servidor.iniciar_servidor: corre el event loop en un hilo aparte
+    # para que el hilo principal pueda quedarse con la interfaz gráfica.
+    hilo = threading.Thread(target=asyncio.run, args=(servir(host, puerto, backlog),), daemon=True)
+    hilo.start()
+    return hilo
+
+
+if __name__ == "__main__":
+    import sys
+    import servicio
+    servicio.main(["--modo", "asyncio"] + sys.argv[1:])
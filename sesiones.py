@@ -0,0 +1,121 @@
+import hmac
+import time
+import random
+import secrets
+import threading
+from collections import deque
+
+from protocolo import empaquetar_campos, desempaquetar_campos, ErrorProtocolo, T_TEXTO, T_ARCHIVO_REF, T_MSG_CON_ID, T_ACUSE
+
+# SESIONES Y REANUDACIÓN
+# En el handshake el servidor le da a cada cliente de tramas un token de sesión (va en la bienvenida
+# junto con la secuencia desde la que cuenta). Si la conexión se corta sin T_SALIR, el alias no se libera:
+# queda reservado GRACIA segundos, sigue figurando en la presencia (nadie ve una salida y una entrada)
+# y los mensajes que le llegan se siguen guardando en su anillo. Si el cliente vuelve a tiempo manda
+# T_REANUDAR (alias, token, última secuencia recibida) en lugar de T_ALIAS y recibe lo que se perdió.
+# La secuencia no viaja en cada mensaje: los dos lados cuentan las tramas REPETIBLES en el mismo orden.
+# El anillo es acotado: si el corte fue tan largo que algo ya salió de él, la bienvenida trae una base
+# mayor que la que tenía el cliente y él sabe cuántos mensajes se perdieron (quedan en el historial).
+
+GRACIA = 30.0
+CAPACIDAD_ANILLO = 500   # menos que la cola de salida: reenviar el anillo entero nunca la desborda
+
+# Los archivos privados por bloques no se guardan. Los acuses sí: un recibo que llega durante el corte
+# no se pierde (un ACEPTADO perdido igual se recupera: el cliente reintenta y el servidor lo repite).
+REPETIBLES = frozenset({T_TEXTO, T_ARCHIVO_REF, T_MSG_CON_ID, T_ACUSE})
+
+# Reconexión del cliente: espera exponencial con variación al azar, para que un corte que afecta a
+# muchos clientes a la vez no los haga volver todos juntos
+ESPERA_INICIAL = 0.5
+ESPERA_MAXIMA = 30.0
+
+
+class Sesion:
+    # Lado servidor. `lock` ordena el anillo y la cola de salida del cliente: guardar un mensaje y
+    # encolarlo es atómico respecto de una reanudación que cambia la cola.
+    def __init__(self, capacidad=CAPACIDAD_ANILLO):
+        self.token = secrets.token_urlsafe(24)
+        self.secuencia = 0
+        self.lock = threading.Lock()
+        self.cortada = None   # time.monotonic() del corte, None mientras está conectada
+        self.cortes = 0
+        self._anillo = deque(maxlen=capacidad)  # (secuencia, tipo, carga): la carga se comparte con el reparto
+
+    def valida(self, token):
+        return hmac.compare_digest(self.token.encode(), token.encode("utf-8"))
+
+    def guardar(self, tipo, carga):
+        self.secuencia += 1
+        self._anillo.append((self.secuencia, tipo, carga))
+
+    def deshacer(self):
+        # Saca lo último guardado (que nunca llegó a la cola del cliente), con lock tomado
+        self._anillo.pop()
+        self.secuencia -= 1
+
+    def cortar(self):
+        # Devuelve el número de corte, para que el vencimiento de uno viejo no afecte a uno nuevo
+        self.cortada = time.monotonic()
+        self.cortes += 1
+        return self.cortes
+
+    def reanudar(self, ultima):
+        # Devuelve (base, [(tipo, carga)]): lo que el cliente no recibió después de `ultima`
+        self.cortada = None
+        ultima = max(0, min(ultima, self.secuencia))
+        primera = self._anillo[0][0] if self._anillo else self.secuencia + 1
+        base = max(ultima, primera - 1)
+        return base, [(tipo, carga) for secuencia, tipo, carga in self._anillo if secuencia > base]
+
+
+def carga_bienvenida(alias, sesion, base=0):
+    # Sin sesión (clientes de texto viejo) la bienvenida es solo el saludo
+    saludo = f"Bienvenido, {alias}.\n"
+    if sesion is None:
+        return saludo
+    return empaquetar_campos(saludo, sesion.token, str(base))
+
+
+def leer_reanudacion(carga):
+    # T_REANUDAR -> (alias, token, última secuencia)
+    alias, token, ultima = desempaquetar_campos(carga, 3)
+    return alias, token, int(ultima)
+
+
+# LADO CLIENTE
+class SesionCliente:
+    def __init__(self, alias, token, secuencia):
+        self.alias = alias
+        self.token = token
+        self.secuencia = secuencia
+
+    @classmethod
+    def desde_bienvenida(cls, alias, carga):
+        # None si el servidor no da sesiones (versiones anteriores)
+        try:
+            _, token, base = desempaquetar_campos(carga, 3)
+            return cls(alias, token, int(base))
+        except (ErrorProtocolo, ValueError):
+            return None
+
+    def contar(self, trama):
+        if trama.tipo in REPETIBLES:
+            self.secuencia += 1
+
+    def reanudacion(self):
+        return empaquetar_campos(self.alias, self.token, str(self.secuencia))
+
+    def reanudada(self, carga):
+        # Bienvenida de la reanudación: devuelve cuántos mensajes se perdieron sin remedio
+        _, _, base = desempaquetar_campos(carga, 3)
+        perdidos = max(0, int(base) - self.secuencia)
+        self.secuencia = int(base)
+        return perdidos
+
+
+def esperas_reconexion(inicial=ESPERA_INICIAL, maxima=ESPERA_MAXIMA):
+    # Generador de esperas: 0.5, 1, 2, 4... hasta `maxima`, cada una entre el 50% y el 100% del valor
+    espera = inicial
+    while True:
+        yield espera * random.uniform(0.5, 1.0)
+        espera = min(espera * 2, maxima)
@@ -0,0 +1,126 @@
+import pytest
+
+import acuses
+from acuses import (
+    VentanaIds, PendientesCliente, separar_id, ACEPTADO, ENTREGADO, RECHAZADO, MAX_ID, RECORDADOS,
+)
+from protocolo import ErrorProtocolo, Trama, F_ACUSE, T_MSG_ALL, T_MSG_PRIVADO, T_TEXTO, empaquetar_campos
+
+
+class Reloj:
+    # Reemplaza a time.monotonic en acuses.py
+    def __init__(self):
+        self.instante = 1000.0
+
+    def __call__(self):
+        return self.instante
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(acuses.time, "monotonic", reloj)
+    return reloj
+
+
+def test_separar_id():
+    trama = Trama(T_MSG_PRIVADO, F_ACUSE, empaquetar_campos("abc", "eva", "hola"))
+    id_mensaje, resto = separar_id(trama)
+    assert id_mensaje == "abc"
+    assert resto == Trama(T_MSG_PRIVADO, 0, empaquetar_campos("eva", "hola"))
+    # Sin el flag, o en un tipo que no lleva id, la trama queda como está
+    sin_flag = Trama(T_MSG_ALL, 0, b"hola")
+    assert separar_id(sin_flag) == ("", sin_flag)
+    otro_tipo = Trama(T_TEXTO, F_ACUSE, b"hola")
+    assert separar_id(otro_tipo) == ("", otro_tipo)
+
+
+@pytest.mark.parametrize("id_mensaje", ["", "x" * (MAX_ID + 1)])
+def test_separar_id_invalido(id_mensaje):
+    with pytest.raises(ErrorProtocolo):
+        separar_id(Trama(T_MSG_ALL, F_ACUSE, empaquetar_campos(id_mensaje, "hola")))
+
+
+def test_ventana_reconoce_el_reintento(reloj):
+    ventana = VentanaIds()
+    assert ventana.buscar("ana", "1") is None
+    ventana.registrar("ana", "1")
+    ventana.acusar("ana", "1", b"acuse")
+    assert ventana.buscar("ana", "1") == b"acuse"
+    # El id es por alias
+    assert ventana.buscar("eva", "1") is None
+
+
+def test_ventana_olvida_lo_vencido(reloj):
+    ventana = VentanaIds(duracion=10)
+    ventana.registrar("ana", "1")
+    reloj.instante += 5
+    ventana.registrar("ana", "2")
+    reloj.instante += 5
+    assert ventana.buscar("ana", "1") is None
+    assert ventana.buscar("ana", "2") == b""
+    assert len(ventana) == 1
+
+
+def test_ventana_acotada(reloj):
+    ventana = VentanaIds(maximo=3)
+    for i in range(5):
+        ventana.registrar("ana", str(i))
+    assert len(ventana) == 3
+    assert ventana.buscar("ana", "1") is None
+    assert ventana.buscar("ana", "4") == b""
+
+
+def test_recibo_solo_del_destinatario_y_una_vez(reloj):
+    ventana = VentanaIds()
+    ventana.registrar("ana", "1", destinatario="eva")
+    ventana.registrar("ana", "2")  # a Todos: no tiene recibos
+    reloj.instante += 1.5
+    assert ventana.entregar("ana", "1", "beto") is None
+    assert ventana.entregar("ana", "1", "eva") == pytest.approx(1.5)
+    assert ventana.entregar("ana", "1", "eva") is None
+    assert ventana.entregar("ana", "2", "eva") is None
+    assert ventana.entregar("ana", "3", "eva") is None
+
+
+def test_pendientes_aceptado_y_recibo(reloj):
+    pendientes = PendientesCliente()
+    id_mensaje = pendientes.nuevo(T_MSG_PRIVADO, b"carga")
+    reloj.instante += 0.5
+    assert pendientes.acusar(id_mensaje, ACEPTADO) == pytest.approx(0.5)
+    assert pendientes.acusar(id_mensaje, ACEPTADO) is None
+    reloj.instante += 1
+    # El recibo se mide desde el primer envío
+    assert pendientes.acusar(id_mensaje, ENTREGADO) == pytest.approx(1.5)
+    assert pendientes.acusar(id_mensaje, ENTREGADO) is None
+    assert pendientes.para_reintentar(todos=True) == ([], [])
+
+
+def test_pendientes_rechazado_no_se_reintenta(reloj):
+    pendientes = PendientesCliente()
+    id_mensaje = pendientes.nuevo(T_MSG_ALL, b"carga")
+    assert pendientes.acusar(id_mensaje, RECHAZADO) is not None
+    reloj.instante += 100
+    assert pendientes.para_reintentar() == ([], [])
+
+
+def test_pendientes_reintenta_con_el_mismo_id_hasta_abandonar(reloj):
+    pendientes = PendientesCliente(espera=5, intentos=3)
+    id_mensaje = pendientes.nuevo(T_MSG_ALL, b"carga")
+    assert pendientes.para_reintentar() == ([], [])
+    reloj.instante += 5
+    assert pendientes.para_reintentar() == ([(id_mensaje, T_MSG_ALL, b"carga")], [])
+    # Al reconectar se reintenta todo sin esperar
+    assert pendientes.para_reintentar(todos=True) == ([(id_mensaje, T_MSG_ALL, b"carga")], [])
+    reloj.instante += 5
+    assert pendientes.para_reintentar() == ([], [(T_MSG_ALL, b"carga")])
+    assert pendientes.acusar(id_mensaje, ACEPTADO) is None
+
+
+def test_pendientes_recuerda_una_cantidad_acotada_de_aceptados(reloj):
+    pendientes = PendientesCliente()
+    ids = [pendientes.nuevo(T_MSG_PRIVADO, b"") for _ in range(RECORDADOS + 1)]
+    for id_mensaje in ids:
+        pendientes.acusar(id_mensaje, ACEPTADO)
+    assert pendientes.acusar(ids[0], ENTREGADO) is None
+    assert pendientes.acusar(ids[-1], ENTREGADO) is not None
@@ -0,0 +1,106 @@
+import pytest
+
+import admision
+from admision import Limitador, Admision, RAFAGA, MENSAJES, MENSAJES_IP, BYTES, BYTES_IP, CONEXIONES, CONEXIONES_IP
+
+
+class Reloj:
+    # Reemplaza a time.monotonic en admision.py para que las cubetas se llenen cuando el test dice
+    def __init__(self):
+        self.instante = 1000.0
+
+    def __call__(self):
+        return self.instante
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(admision.time, "monotonic", reloj)
+    return reloj
+
+
+def test_rafaga_y_despues_a_la_tasa(reloj):
+    limitador = Limitador(mensajes=5)
+    for _ in range(int(5 * RAFAGA)):
+        assert limitador.mensaje("ana", "1.1.1.1") == (None, 0.0)
+    motivo, espera = limitador.mensaje("ana", "1.1.1.1")
+    assert motivo == MENSAJES and espera == pytest.approx(0.2)
+    reloj.instante += 0.2
+    assert limitador.mensaje("ana", "1.1.1.1") == (None, 0.0)
+    # Otro alias tiene su propia cubeta
+    assert limitador.mensaje("eva", "1.1.1.1") == (None, 0.0)
+
+
+def test_el_rechazo_no_gasta_la_otra_cubeta(reloj):
+    limitador = Limitador(mensajes=1, mensajes_ip=10)
+    limitador.mensaje("ana", "1.1.1.1")
+    limitador.mensaje("ana", "1.1.1.1")
+    for _ in range(5):
+        assert limitador.mensaje("ana", "1.1.1.1")[0] == MENSAJES
+    # Los rechazos de ana no le comieron fichas de la IP a los demás
+    for i in range(18):
+        assert limitador.mensaje(f"otro{i}", "1.1.1.1")[0] is None
+    assert limitador.mensaje("eva", "1.1.1.1")[0] == MENSAJES_IP
+
+
+def test_datos_frena_con_la_mas_restrictiva(reloj):
+    limitador = Limitador(datos=1000, datos_ip=100000)
+    assert limitador.datos("ana", "1.1.1.1", 2000) == (0.0, None)
+    espera, motivo = limitador.datos("ana", "1.1.1.1", 3000)
+    assert motivo == BYTES and espera == pytest.approx(3.0)
+    reloj.instante += 3.0
+    assert limitador.datos("ana", "1.1.1.1", 0) == (0.0, None)
+
+    limitador = Limitador(datos=100000, datos_ip=1000)
+    assert limitador.datos("ana", "1.1.1.1", 2500)[1] == BYTES_IP
+
+
+def test_sin_tasa_no_limita(reloj):
+    limitador = Limitador()
+    for _ in range(1000):
+        assert limitador.mensaje("ana", "1.1.1.1") == (None, 0.0)
+    assert limitador.datos("ana", "1.1.1.1", 10 ** 9) == (0.0, None)
+    assert limitador.estadisticas() == {"cubetas": 0}
+
+
+def test_avisos_espaciados(reloj):
+    limitador = Limitador(mensajes=1)
+    assert limitador.avisar("ana", MENSAJES)
+    assert not limitador.avisar("ana", MENSAJES)
+    assert limitador.avisar("ana", BYTES)
+    reloj.instante += Limitador.AVISAR_CADA
+    assert limitador.avisar("ana", MENSAJES)
+
+
+def test_limpieza_olvida_cubetas_llenas(reloj):
+    limitador = Limitador(mensajes=1)
+    limitador.mensaje("ana", "1.1.1.1")
+    limitador.mensaje("eva", "1.1.1.1")
+    assert limitador.estadisticas() == {"cubetas": 2}
+    reloj.instante += Limitador.LIMPIAR_CADA
+    limitador.mensaje("beto", "1.1.1.1")
+    assert limitador.estadisticas() == {"cubetas": 1}
+
+
+def test_admision_por_total_y_por_ip():
+    puerta = Admision(maximo=3, por_ip=2)
+    assert puerta.entrar("1.1.1.1") is None
+    assert puerta.entrar("1.1.1.1") is None
+    assert puerta.entrar("1.1.1.1") == CONEXIONES_IP
+    assert puerta.entrar("2.2.2.2") is None
+    assert puerta.entrar("3.3.3.3") == CONEXIONES
+    assert puerta.abiertas == 3
+    puerta.salir("1.1.1.1")
+    assert puerta.entrar("1.1.1.1") is None
+    for ip in ("1.1.1.1", "1.1.1.1", "2.2.2.2"):
+        puerta.salir(ip)
+    assert puerta.abiertas == 0
+    assert puerta.entrar("3.3.3.3") is None
+
+
+def test_admision_sin_topes():
+    puerta = Admision()
+    for _ in range(100):
+        assert puerta.entrar("1.1.1.1") is None
+    assert puerta.abiertas == 100
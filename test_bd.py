@@ -0,0 +1,116 @@
+import sqlite3
+
+import pytest
+
+import bd
+from bd import MIGRACIONES, abrir, migrar, init_db, version_esquema, aplicar_conexiones, conversacion_de, PoolConexiones
+
+ULTIMA = MIGRACIONES[-1][0]
+
+
+def hasta(conn, version):
+    # Aplica solo las migraciones hasta `version`, como una BD creada por una versión anterior del servidor
+    for numero, _, sentencias in MIGRACIONES:
+        if numero > version:
+            break
+        with conn:
+            for sql in sentencias:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {numero}")
+
+
+@pytest.fixture
+def ruta(tmp_path):
+    return str(tmp_path / "historial.db")
+
+
+def test_versiones_en_orden():
+    versiones = [version for version, _, _ in MIGRACIONES]
+    assert versiones == list(range(1, len(versiones) + 1))
+
+
+def test_bd_nueva_queda_en_la_ultima_version(ruta):
+    assert init_db(ruta) == ULTIMA
+    conn = abrir(ruta)
+    tablas = {fila[0] for fila in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'index')")}
+    assert {"historial_conexiones", "mensajes", "mensajes_fts", "buzon",
+            "idx_conexiones_abiertas", "idx_mensajes_conversacion", "idx_buzon_destinatario"} <= tablas
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_migrar_dos_veces_no_hace_nada(ruta):
+    init_db(ruta)
+    conn = abrir(ruta)
+    conn.execute("INSERT INTO mensajes(remitente, destinatario, mensaje, fecha, conversacion) "
+                 "VALUES ('ana', 'Todos', 'hola', '', 'Todos')")
+    conn.commit()
+    assert migrar(conn) == ULTIMA
+    assert conn.execute("SELECT COUNT(*) FROM mensajes").fetchone()[0] == 1
+
+
+def test_conversaciones_de_mensajes_viejos(ruta):
+    # Una BD en la versión 3 (antes de la columna conversacion) con mensajes ya guardados
+    conn = abrir(ruta)
+    hasta(conn, 3)
+    filas = [("ana", "Todos", "a todos"), ("beto", "ana", "privado"), ("ana", "beto", "respuesta"), ("eva", "todos", "x")]
+    with conn:
+        conn.executemany("INSERT INTO mensajes(remitente, destinatario, mensaje, fecha) VALUES (?, ?, ?, '')", filas)
+    assert migrar(conn) == ULTIMA
+    guardadas = conn.execute("SELECT remitente, destinatario, conversacion FROM mensajes ORDER BY id").fetchall()
+    # La migración calcula lo mismo que conversacion_de, que es lo que usan los mensajes nuevos
+    assert [c for _, _, c in guardadas] == ["Todos", "ana|beto", "ana|beto", "Todos"]
+    assert all(c == conversacion_de(r, d) for r, d, c in guardadas)
+
+
+def test_busqueda_incluye_mensajes_anteriores_a_fts(ruta):
+    conn = abrir(ruta)
+    hasta(conn, 4)
+    with conn:
+        conn.execute("INSERT INTO mensajes(remitente, destinatario, mensaje, fecha, conversacion) "
+                     "VALUES ('ana', 'Todos', 'nos vemos en la estación', '', 'Todos')")
+    migrar(conn)
+    with conn:
+        conn.execute("INSERT INTO mensajes(remitente, destinatario, mensaje, fecha, conversacion) "
+                     "VALUES ('beto', 'Todos', 'la estacion de siempre', '', 'Todos')")
+    # El rebuild de la migración 5 indexa lo viejo y los triggers lo nuevo, sin distinguir acentos
+    encontrados = conn.execute("SELECT rowid FROM mensajes_fts WHERE mensajes_fts MATCH 'estacion' ORDER BY rowid").fetchall()
+    assert [fila[0] for fila in encontrados] == [1, 2]
+
+
+def test_migracion_fallida_no_deja_la_version_a_medias(ruta, monkeypatch):
+    conn = abrir(ruta)
+    hasta(conn, 5)
+    rota = (6, "rota", ["CREATE TABLE buzon (id INTEGER)", "esto no es SQL"])
+    monkeypatch.setattr(bd, "MIGRACIONES", MIGRACIONES[:5] + [rota])
+    with pytest.raises(sqlite3.OperationalError):
+        migrar(conn)
+    assert version_esquema(conn) == 5
+    monkeypatch.undo()
+    assert migrar(conn) == ULTIMA
+
+
+def test_conexiones_en_orden(ruta):
+    init_db(ruta)
+    pool = PoolConexiones(ruta, tamano=2)
+    with pool.transaccion() as conn:
+        aplicar_conexiones(conn, [
+            ("conexion", ("ana", "123", "127.0.0.1", "2026-01-01 10:00:00")),
+            ("desconexion", ("2026-01-01 10:05:00", "ana")),
+            ("conexion", ("ana", "124", "127.0.0.1", "2026-01-01 10:06:00")),
+        ])
+    with pool.conexion() as conn:
+        filas = conn.execute("SELECT codigo, fecha_desconexion FROM historial_conexiones ORDER BY id").fetchall()
+    assert filas == [("123", "2026-01-01 10:05:00"), ("124", None)]
+    pool.cerrar()
+
+
+def test_transaccion_del_pool_revierte_si_falla(ruta):
+    init_db(ruta)
+    pool = PoolConexiones(ruta, tamano=1)
+    with pytest.raises(RuntimeError):
+        with pool.transaccion() as conn:
+            aplicar_conexiones(conn, [("conexion", ("ana", "123", "127.0.0.1", "2026-01-01 10:00:00"))])
+            raise RuntimeError
+    with pool.conexion() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM historial_conexiones").fetchone()[0] == 0
+    pool.cerrar()
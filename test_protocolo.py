@@ -0,0 +1,98 @@
+import base64
+
+import pytest
+
+import compresion
+from protocolo import (
+    DecodificadorTramas, ErrorProtocolo, Trama, CABECERA, MAGIA, VERSION,
+    codificar_trama, codificar_para, desde_legado, a_legado, es_trama, empaquetar_campos, desempaquetar_campos,
+    MODO_TRAMAS, MODO_LEGADO, T_MSG_ALL, T_MSG_PRIVADO, T_ARCHIVO, T_TEXTO, T_SALIR, T_ALIAS_OCUPADO,
+)
+
+
+def test_trama_partida_en_varios_recv():
+    trama = codificar_trama(T_MSG_ALL, "hola a todos")
+    decodificador = DecodificadorTramas()
+    # Un byte por vez: nada sale hasta que llega el último
+    for byte in trama[:-1]:
+        assert decodificador.alimentar(bytes([byte])) == []
+    assert decodificador.alimentar(trama[-1:]) == [Trama(T_MSG_ALL, 0, b"hola a todos")]
+    assert decodificador.pendiente() == 0
+
+
+def test_varias_tramas_en_un_recv():
+    datos = codificar_trama(T_MSG_ALL, "uno") + codificar_trama(T_TEXTO, "dos") + codificar_trama(T_SALIR)
+    tramas = DecodificadorTramas().alimentar(datos)
+    assert [(t.tipo, t.carga) for t in tramas] == [(T_MSG_ALL, b"uno"), (T_TEXTO, b"dos"), (T_SALIR, b"")]
+
+
+def test_lo_que_sobra_queda_para_el_siguiente_recv():
+    primera = codificar_trama(T_MSG_ALL, "completa")
+    segunda = codificar_trama(T_MSG_ALL, "partida")
+    decodificador = DecodificadorTramas()
+    assert [t.carga for t in decodificador.alimentar(primera + segunda[:5])] == [b"completa"]
+    assert decodificador.pendiente() == 5
+    assert [t.carga for t in decodificador.alimentar(segunda[5:])] == [b"partida"]
+
+
+def test_carga_binaria_con_separadores():
+    carga = empaquetar_campos("ana", "foto.png", bytes(range(256)) * 4)
+    trama, = DecodificadorTramas().alimentar(codificar_trama(T_ARCHIVO, carga))
+    destinatario, nombre, contenido = desempaquetar_campos(trama.carga, 3)
+    assert (destinatario, nombre, contenido) == ("ana", "foto.png", bytes(range(256)) * 4)
+
+
+def test_cabecera_invalida():
+    with pytest.raises(ErrorProtocolo):
+        DecodificadorTramas().alimentar(b"MSG_ALL:hola")
+    with pytest.raises(ErrorProtocolo):
+        DecodificadorTramas().alimentar(CABECERA.pack(MAGIA, VERSION + 1, T_TEXTO, 0, 0))
+
+
+def test_campos_faltantes():
+    with pytest.raises(ErrorProtocolo):
+        desempaquetar_campos(b"solo uno", 2)
+
+
+@pytest.mark.parametrize("nombre", sorted(compresion.CODECS))
+def test_trama_comprimida(nombre):
+    codec = compresion.CODECS[nombre]
+    texto = "repetido " * 500
+    datos = codificar_para(MODO_TRAMAS, T_TEXTO, texto, codec=codec)
+    assert len(datos) < len(texto)
+    trama, = DecodificadorTramas().alimentar(datos)
+    assert trama.carga == texto.encode("utf-8")
+    assert trama.flags & compresion.MASCARA == 0
+
+
+def test_primer_mensaje_decide_el_modo():
+    assert es_trama(codificar_trama(T_MSG_ALL, "hola"))
+    assert not es_trama("ana".encode("utf-8"))
+    assert not es_trama(b"MSG_ALL:hola")
+
+
+def test_legado_a_tramas():
+    assert desde_legado("salir") == Trama(T_SALIR, 0, b"")
+    assert desde_legado("MSG_ALL:hola: qué tal") == Trama(T_MSG_ALL, 0, "hola: qué tal".encode("utf-8"))
+    assert desde_legado("MSG_PRIVATE:eva:nos vemos: mañana") == Trama(
+        T_MSG_PRIVADO, 0, empaquetar_campos("eva", "nos vemos: mañana"))
+    contenido = b"\x00\x01binario"
+    trama = desde_legado("FILE:eva:a.bin:" + base64.b64encode(contenido).decode("ascii"))
+    assert trama.tipo == T_ARCHIVO
+    assert desempaquetar_campos(trama.carga, 3) == ["eva", "a.bin", contenido]
+
+
+def test_legado_desconocido_o_roto():
+    assert desde_legado("hola") is None
+    assert desde_legado("MSG_PRIVATE:eva") is None
+    assert desde_legado("FILE:eva:a.bin:no es base64!") is None
+
+
+def test_tramas_a_legado():
+    assert codificar_para(MODO_LEGADO, T_TEXTO, "ana (Todos): hola") == "ana (Todos): hola".encode("utf-8")
+    assert a_legado(T_ALIAS_OCUPADO, b"") == b"ALIAS_TAKEN"
+    datos = a_legado(T_ARCHIVO, empaquetar_campos("ana", "a.bin", b"\x00\xff"))
+    assert datos == b"FILE:ana:a.bin:" + base64.b64encode(b"\x00\xff")
+    # Ida y vuelta: lo que entiende un cliente viejo vuelve a ser la misma trama
+    trama = desde_legado(datos.decode("utf-8"))
+    assert desempaquetar_campos(trama.carga, 3) == ["ana", "a.bin", b"\x00\xff"]
@@ -0,0 +1,128 @@
+import pytest
+
+import bd
+import salas as modulo_salas
+from salas import Salas, es_sala, nombre_valido, CREAR, UNIR
+from historial import HistorialSQLite, ConsultasHistorial
+from recientes import CacheRecientes
+
+
+class Reloj:
+    # Reemplaza a bd.ahora en salas.py: cada test decide en qué segundo pasa cada cosa
+    def __init__(self):
+        self.segundo = 0
+
+    def __call__(self):
+        return f"2026-01-01 10:00:{self.segundo:02d}"
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(modulo_salas, "ahora", reloj)
+    return reloj
+
+
+def test_nombres():
+    assert es_sala("#general") and not es_sala("ana")
+    assert nombre_valido("#mi-sala_2")
+    assert not nombre_valido("#")
+    assert not nombre_valido("#con espacio")
+    assert not nombre_valido("#" + "x" * 33)
+
+
+def test_crear_unir_y_salir():
+    s = Salas()
+    assert s.unir("#a", "ana", UNIR) == (False, "La sala no existe")
+    assert s.unir("#a", "ana", CREAR) == (True, None)
+    assert s.unir("#a", "eva", CREAR) == (False, "La sala ya existe")
+    assert s.unir("#a", "eva", UNIR) == (True, None)
+    assert s.unir("#a", "eva", UNIR) == (False, None)  # ya estaba
+    assert s.miembros("#a") == ("ana", "eva")
+    assert s.salir("#a", "ana")
+    assert not s.salir("#a", "ana")
+    assert s.miembros("#a") == ("eva",)
+    # Cuando se va el último la sala deja de existir
+    assert s.salir("#a", "eva")
+    assert s.miembros("#a") == ()
+    assert s.unir("#a", "ana", UNIR) == (False, "La sala no existe")
+    assert s.estadisticas() == {"salas": 0, "miembros": 0}
+
+
+def test_cambios_de_otro_trabajador_no_chequean_si_existe():
+    s = Salas()
+    assert s.unir("#a", "ana", None) == (True, None)
+    assert s.miembros("#a") == ("ana",)
+
+
+def test_la_tupla_publicada_no_cambia():
+    s = Salas()
+    s.unir("#a", "ana", CREAR)
+    foto = s.miembros("#a")
+    s.unir("#a", "eva", UNIR)
+    assert foto == ("ana",)
+
+
+def test_quitar_lo_saca_de_todas():
+    s = Salas()
+    s.unir("#a", "ana", CREAR)
+    s.unir("#b", "ana", CREAR)
+    s.unir("#b", "eva", UNIR)
+    assert s.quitar("ana") == ["#a", "#b"]
+    assert s.miembros("#b") == ("eva",)
+    assert s.desde("ana") == {}
+    assert s.estadisticas() == {"salas": 1, "miembros": 1}
+
+
+def test_desde_es_la_entrada_de_cada_uno(reloj):
+    s = Salas()
+    s.unir("#a", "ana", CREAR)
+    reloj.segundo = 5
+    s.unir("#a", "eva", UNIR)
+    assert s.desde("ana") == {"#a": "2026-01-01 10:00:00"}
+    assert s.desde("eva") == {"#a": "2026-01-01 10:00:05"}
+
+
+def test_sala_vuelta_a_crear_en_el_mismo_segundo(reloj):
+    s = Salas()
+    s.unir("#a", "ana", CREAR)
+    s.salir("#a", "ana")
+    s.unir("#a", "eva", CREAR)
+    # Lo de la sala anterior pudo haberse escrito en este mismo segundo: se lee desde el siguiente
+    assert s.desde("eva")["#a"] > "2026-01-01 10:00:00"
+    assert s.desde("eva")["#a"] < "2026-01-01 10:00:01"
+    reloj.segundo = 1
+    s.unir("#b", "eva", CREAR)
+    assert s.desde("eva")["#b"] == "2026-01-01 10:00:01"
+
+
+@pytest.fixture
+def historial(tmp_path):
+    ruta = str(tmp_path / "historial.db")
+    bd.init_db(ruta)
+    escritor = HistorialSQLite(ruta)
+    yield ruta, escritor
+    escritor.cerrar()
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_historial_de_una_sala_vuelta_a_crear(historial, reloj, cache):
+    ruta, escritor = historial
+    s = Salas()
+    s.unir("#a", "ana", CREAR)
+    escritor.guardar_lote([("ana", "secreto", "#a", "2026-01-01 10:00:00")])
+    s.salir("#a", "ana")
+    reloj.segundo = 3
+    s.unir("#a", "beto", CREAR)
+    escritor.guardar_lote([("beto", "nuevo", "#a", "2026-01-01 10:00:03")])
+    s.unir("#a", "eva", UNIR)
+    escritor.sincronizar()
+
+    consultas = ConsultasHistorial(ruta, recientes=CacheRecientes() if cache else None)
+    for alias in ("beto", "eva"):
+        for conversacion in ("#a", ""):
+            filas, _ = consultas.pagina(alias, conversacion, salas=s.desde(alias))
+            assert [fila[4] for fila in filas] == ["nuevo"]
+    # Quien no está en la sala no lee nada de ella
+    assert consultas.pagina("ana", "#a", salas=s.desde("ana"))[0] == []
+    consultas.cerrar()
@@ -0,0 +1,173 @@
+import os
+import hashlib
+
+import pytest
+
+from protocolo import (
+    DecodificadorTramas, ErrorProtocolo, desempaquetar_campos,
+    MODO_TRAMAS, T_ARCHIVO_INICIO, T_ARCHIVO_BLOQUE, T_ARCHIVO_FIN,
+)
+from transferencias import (
+    ReceptorArchivo, RegistroSubidas, EmisorArchivo, TAMANO_BLOQUE,
+    bloques_archivo, empaquetar_bloque, desempaquetar_bloque, nuevo_id,
+)
+
+CONTENIDO = os.urandom(3 * TAMANO_BLOQUE + 1234)
+SHA = hashlib.sha256(CONTENIDO).hexdigest()
+
+
+def partes(contenido=CONTENIDO):
+    return [(offset, contenido[offset:offset + TAMANO_BLOQUE]) for offset in range(0, len(contenido), TAMANO_BLOQUE)]
+
+
+def test_receptor_sigue_desde_lo_que_ya_esta_en_disco(tmp_path):
+    ruta = str(tmp_path / "a.parte")
+    receptor = ReceptorArchivo(ruta, len(CONTENIDO))
+    for offset, datos in partes()[:2]:
+        receptor.escribir(offset, datos)
+    receptor.cerrar()
+
+    # Otro receptor (reconexión o reinicio del servidor) arranca donde quedó el archivo parcial
+    receptor = ReceptorArchivo(ruta, len(CONTENIDO))
+    assert receptor.recibido == 2 * TAMANO_BLOQUE
+    for offset, datos in partes():
+        receptor.escribir(offset, datos)  # los bloques que ya estaban se ignoran
+    assert receptor.completo()
+    receptor.terminar(SHA, str(tmp_path / "a"))
+    assert (tmp_path / "a").read_bytes() == CONTENIDO
+    assert not os.path.exists(ruta)
+
+
+def test_receptor_recorta_un_parcial_mas_largo_que_lo_anunciado(tmp_path):
+    ruta = tmp_path / "a.parte"
+    ruta.write_bytes(b"x" * 100)
+    receptor = ReceptorArchivo(str(ruta), 40)
+    assert receptor.recibido == 40
+    receptor.cerrar()
+    assert ruta.stat().st_size == 40
+
+
+def test_receptor_rechaza_huecos_y_excesos(tmp_path):
+    receptor = ReceptorArchivo(str(tmp_path / "a.parte"), 10)
+    with pytest.raises(ErrorProtocolo):
+        receptor.escribir(5, b"xx")
+    receptor.escribir(0, b"12345")
+    with pytest.raises(ErrorProtocolo):
+        receptor.escribir(5, b"123456")
+    receptor.cerrar()
+
+
+def test_receptor_con_sha_distinto_borra_el_parcial(tmp_path):
+    ruta = str(tmp_path / "a.parte")
+    receptor = ReceptorArchivo(ruta, 3)
+    receptor.escribir(0, b"abc")
+    with pytest.raises(ErrorProtocolo):
+        receptor.terminar("0" * 64, str(tmp_path / "a"))
+    assert not os.path.exists(ruta)
+    assert not os.path.exists(tmp_path / "a")
+
+
+def test_bloque_con_crc_invalido():
+    carga = bytearray(empaquetar_bloque(nuevo_id(), 0, b"datos"))
+    carga[-1] ^= 0xFF
+    with pytest.raises(ErrorProtocolo):
+        desempaquetar_bloque(bytes(carga))
+
+
+def test_subida_reanudada_con_el_mismo_id(tmp_path):
+    registro = RegistroSubidas(str(tmp_path))
+    id_transferencia = nuevo_id()
+    assert registro.iniciar("ana", id_transferencia, "eva", "a.bin", len(CONTENIDO)) == 0
+    registro.bloque("ana", empaquetar_bloque(id_transferencia, 0, partes()[0][1]))
+    with pytest.raises(ErrorProtocolo):
+        registro.iniciar("beto", id_transferencia, "eva", "a.bin", len(CONTENIDO))
+    with pytest.raises(ErrorProtocolo):
+        registro.bloque("beto", empaquetar_bloque(id_transferencia, TAMANO_BLOQUE, partes()[1][1]))
+    registro.abandonar("ana")  # se desconectó
+
+    offset = registro.iniciar("ana", id_transferencia, "eva", "a.bin", len(CONTENIDO))
+    assert offset == TAMANO_BLOQUE
+    for offset, datos in partes()[1:]:
+        registro.bloque("ana", empaquetar_bloque(id_transferencia, offset, datos))
+    subida = registro.finalizar("ana", id_transferencia, SHA)
+    assert (subida.remitente, subida.destinatario, subida.tamano, subida.sha256) == ("ana", "eva", len(CONTENIDO), SHA)
+    assert registro.completa(id_transferencia) == subida
+    assert registro.completa(id_transferencia) is None  # se reparte una sola vez
+
+
+class ConexionFalsa:
+    # Lleva las tramas del emisor directo al registro del servidor y devuelve los ACK;
+    # con `cortar_en` la conexión se cae al intentar mandar ese bloque
+    def __init__(self, registro, emisor, cortar_en=None):
+        self.registro = registro
+        self.emisor = emisor
+        self.cortar_en = cortar_en
+        self.bloques = []
+
+    def enviar(self, tipo, carga):
+        if tipo == T_ARCHIVO_INICIO:
+            id_transferencia, destinatario, nombre, tamano = desempaquetar_campos(carga, 4)
+            self.emisor.confirmar(self.registro.iniciar("ana", id_transferencia, destinatario, nombre, int(tamano)))
+        elif tipo == T_ARCHIVO_BLOQUE:
+            if len(self.bloques) == self.cortar_en:
+                raise ConnectionError("se cortó")
+            _, offset = self.registro.bloque("ana", carga)
+            self.bloques.append(desempaquetar_bloque(carga)[1])
+            self.emisor.confirmar(offset)
+        elif tipo == T_ARCHIVO_FIN:
+            id_transferencia, sha256 = desempaquetar_campos(carga, 2)
+            self.registro.finalizar("ana", id_transferencia, sha256.decode("ascii"))
+            self.emisor.finalizar()
+
+
+def test_emisor_retoma_desde_el_ultimo_ack(tmp_path):
+    origen = tmp_path / "origen.bin"
+    origen.write_bytes(CONTENIDO)
+    registro = RegistroSubidas(str(tmp_path / "servidor"))
+    emisor = EmisorArchivo("eva", str(origen))
+
+    with pytest.raises(ConnectionError):
+        emisor.enviar(ConexionFalsa(registro, emisor, cortar_en=2), espera=1)
+    registro.abandonar("ana")
+
+    conexion = ConexionFalsa(registro, emisor)
+    emisor.enviar(conexion, espera=1)
+    # La conexión nueva solo lleva lo que faltaba
+    assert conexion.bloques == [offset for offset, _ in partes()[2:]]
+    subida = registro.completa(emisor.id)
+    assert open(subida.ruta, "rb").read() == CONTENIDO
+
+
+def test_bloques_archivo_rearman_el_original(tmp_path):
+    registro = RegistroSubidas(str(tmp_path / "servidor"))
+    subida = registro.guardar_completo("ana", "eva", "a.bin", CONTENIDO)
+
+    tramas = DecodificadorTramas().alimentar(b"".join(bloques_archivo(MODO_TRAMAS, subida)))
+    assert tramas[0].tipo == T_ARCHIVO_INICIO and tramas[-1].tipo == T_ARCHIVO_FIN
+    id_transferencia, remitente, nombre, tamano, sha256 = desempaquetar_campos(tramas[0].carga, 5)
+    assert (remitente, nombre, int(tamano), sha256.decode("ascii")) == ("ana", "a.bin", len(CONTENIDO), SHA)
+
+    receptor = ReceptorArchivo(str(tmp_path / "b.parte"), len(CONTENIDO))
+    for trama in tramas[1:-1]:
+        _, offset, datos = desempaquetar_bloque(trama.carga)
+        receptor.escribir(offset, datos)
+    receptor.terminar(SHA, str(tmp_path / "b.bin"))
+    assert (tmp_path / "b.bin").read_bytes() == CONTENIDO
+
+
+def test_topes_de_subida(tmp_path):
+    registro = RegistroSubidas(str(tmp_path), max_tamano=100, max_por_usuario=2)
+    with pytest.raises(ErrorProtocolo, match="máximo de 100 bytes"):
+        registro.iniciar("ana", nuevo_id(), "eva", "a.bin", 101)
+    with pytest.raises(ErrorProtocolo):
+        registro.guardar_completo("ana", "eva", "a.bin", b"x" * 101)
+    assert os.listdir(tmp_path) == []  # se rechaza antes de abrir el parcial
+
+    primera, segunda = nuevo_id(), nuevo_id()
+    registro.iniciar("ana", primera, "eva", "a.bin", 10)
+    registro.iniciar("ana", segunda, "eva", "b.bin", 10)
+    with pytest.raises(ErrorProtocolo, match="Ya hay 2 subidas en curso"):
+        registro.iniciar("ana", nuevo_id(), "eva", "c.bin", 10)
+    # Retomar una que ya está abierta no cuenta como otra, y el tope es por usuario
+    assert registro.iniciar("ana", primera, "eva", "a.bin", 10) == 0
+    registro.iniciar("beto", nuevo_id(), "eva", "d.bin", 10)
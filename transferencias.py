@@ -0,0 +1,477 @@
+import os
+import re
+import time
+import zlib
+import base64
+import struct
+import socket
+import hashlib
+import threading
+from collections import namedtuple
+
+from compresion import ya_comprimido
+from protocolo import (
+    ErrorProtocolo, codificar_para, codificar_trama, empaquetar_campos, desempaquetar_campos,
+    CABECERA, MAGIA, MAX_CARGA, SEPARADOR, MODO_LEGADO, T_ARCHIVO_INICIO, T_ARCHIVO_BLOQUE, T_ARCHIVO_ACK,
+    T_ARCHIVO_FIN, T_ARCHIVO_ERROR, T_ARCHIVO_PEDIR, T_ARCHIVO_DATOS
+)
+
+# TRANSFERENCIA DE ARCHIVOS POR BLOQUES
+# Un archivo viaja como INICIO (id, destino, nombre, tamaño), una serie de BLOQUEs de 64 KB con su
+# offset y CRC32, y un FIN con el SHA-256 del archivo completo. Quien recibe escribe cada bloque
+# directo a disco y confirma con ACK hasta qué offset tiene todo; si la conexión se corta, el emisor
+# vuelve a mandar INICIO con el mismo id y sigue desde el último offset confirmado.
+# Ni el emisor, ni el servidor, ni el receptor tienen nunca el archivo entero en memoria.
+# Los archivos para "Todos" no se empujan a cada cliente: el servidor los guarda en su almacén
+# (almacen.py) y reparte una Referencia; cada cliente lo descarga cuando quiere, por una conexión aparte.
+
+TAMANO_BLOQUE = 64 * 1024
+VENTANA = 16 * TAMANO_BLOQUE       # bytes enviados sin confirmar como máximo
+BLOQUE_LEGADO = 48 * 1024          # múltiplo de 3: los trozos en base64 se pueden concatenar
+CABECERA_BLOQUE = struct.Struct("!32sQI")  # id (hex), offset, crc32
+TIPOS_TRANSFERENCIA = (T_ARCHIVO_INICIO, T_ARCHIVO_BLOQUE, T_ARCHIVO_ACK, T_ARCHIVO_FIN, T_ARCHIVO_ERROR)
+
+_ID_VALIDO = re.compile(r"^[0-9a-f]{32}$")
+
+Subida = namedtuple("Subida", ["id", "remitente", "destinatario", "nombre", "tamano", "ruta", "sha256"])
+Referencia = namedtuple("Referencia", ["remitente", "nombre", "sha256", "tamano"])
+
+
+def nuevo_id():
+    # 32 dígitos hexadecimales al azar, como uuid4().hex pero sin importar uuid (que arrastra platform)
+    return os.urandom(16).hex()
+
+
+def validar_id(id_transferencia):
+    # El id se usa como nombre de archivo: solo se acepta hexadecimal
+    if not _ID_VALIDO.match(id_transferencia):
+        raise ErrorProtocolo(f"Id de transferencia inválido: {id_transferencia!r}")
+    return id_transferencia
+
+
+def empaquetar_bloque(id_transferencia, offset, datos):
+    return CABECERA_BLOQUE.pack(id_transferencia.encode("ascii"), offset, zlib.crc32(datos)) + datos
+
+
+def desempaquetar_bloque(carga):
+    if len(carga) < CABECERA_BLOQUE.size:
+        raise ErrorProtocolo("Bloque de archivo incompleto")
+    id_bytes, offset, crc = CABECERA_BLOQUE.unpack_from(carga)
+    datos = carga[CABECERA_BLOQUE.size:]
+    if zlib.crc32(datos) != crc:
+        raise ErrorProtocolo(f"CRC inválido en el bloque de offset {offset}")
+    return id_bytes.decode("ascii"), offset, datos
+
+
+def calcular_sha256(ruta):
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+class ReceptorArchivo:
+    # Escribe en disco los bloques que van llegando. Si el archivo parcial ya existe
+    # (transferencia reanudada) continúa desde su tamaño actual.
+    def __init__(self, ruta_parcial, tamano):
+        self.ruta = ruta_parcial
+        self.tamano = tamano
+        existe = os.path.exists(ruta_parcial)
+        self._f = open(ruta_parcial, "r+b" if existe else "w+b")
+        self.recibido = min(os.path.getsize(ruta_parcial), tamano) if existe else 0
+        self._f.truncate(self.recibido)
+        self._f.seek(self.recibido)
+
+    def escribir(self, offset, datos):
+        # Devuelve el offset confirmado. Los bloques repetidos (reenvíos tras reanudar) se ignoran.
+        if offset + len(datos) <= self.recibido:
+            return self.recibido
+        if offset != self.recibido:
+            raise ErrorProtocolo(f"Bloque fuera de orden: se esperaba el offset {self.recibido} y llegó {offset}")
+        if self.recibido + len(datos) > self.tamano:
+            raise ErrorProtocolo("El archivo supera el tamaño anunciado")
+        self._f.write(datos)
+        self.recibido += len(datos)
+        return self.recibido
+
+    def completo(self):
+        return self.recibido == self.tamano
+
+    def terminar(self, sha256, ruta_final):
+        # Verifica tamaño y SHA-256 y mueve el archivo a su ruta final
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        if not self.completo():
+            raise ErrorProtocolo(f"Faltan datos: llegaron {self.recibido} de {self.tamano} bytes")
+        if calcular_sha256(self.ruta) != sha256:
+            os.remove(self.ruta)
+            raise ErrorProtocolo("El SHA-256 del archivo no coincide")
+        os.replace(self.ruta, ruta_final)
+
+    def cerrar(self):
+        if not self._f.closed:
+            self._f.close()
+
+
+# LADO SERVIDOR
+class RegistroSubidas:
+    # Subidas en curso (por id) y archivos ya completos esperando ser repartidos.
+    # Los parciales sobreviven a una desconexión (y a un reinicio del servidor) durante `ttl` segundos.
+    # Con un `almacen` los archivos completos se mueven ahí (una copia por contenido) en vez de quedar sueltos.
+    # `max_tamano` (bytes) y `max_por_usuario` (subidas abiertas a la vez) se chequean antes de abrir nada
+    # en disco; 0 desactiva cada uno.
+    def __init__(self, directorio="transferencias", ttl=3600, almacen=None, max_tamano=0, max_por_usuario=0):
+        self.directorio = directorio
+        self.ttl = ttl
+        self.almacen = almacen
+        self.max_tamano = max_tamano
+        self.max_por_usuario = max_por_usuario
+        self._en_curso = {}     # id -> (remitente, destinatario, nombre, tamano, ReceptorArchivo)
+        self._completas = {}    # id -> Subida
+        self._lock = threading.Lock()
+        self._ultima_limpieza = 0
+        os.makedirs(directorio, exist_ok=True)
+
+    def _ruta(self, id_transferencia, parcial=False):
+        return os.path.join(self.directorio, id_transferencia + (".parte" if parcial else ""))
+
+    def iniciar(self, remitente, id_transferencia, destinatario, nombre, tamano):
+        # Devuelve desde qué offset tiene que seguir el emisor (0 si es nueva)
+        validar_id(id_transferencia)
+        self._validar_tamano(tamano)
+        self.limpiar()
+        with self._lock:
+            actual = self._en_curso.get(id_transferencia)
+            if actual:
+                if actual[0] != remitente:
+                    raise ErrorProtocolo("La transferencia pertenece a otro usuario")
+                actual[4].cerrar()
+            elif self.max_por_usuario and sum(1 for a in self._en_curso.values() if a[0] == remitente) >= self.max_por_usuario:
+                raise ErrorProtocolo(f"Ya hay {self.max_por_usuario} subidas en curso. Espera a que termine alguna.")
+            receptor = ReceptorArchivo(self._ruta(id_transferencia, parcial=True), tamano)
+            self._en_curso[id_transferencia] = (remitente, destinatario, nombre, tamano, receptor)
+            return receptor.recibido
+
+    def bloque(self, remitente, carga):
+        id_transferencia, offset, datos = desempaquetar_bloque(carga)
+        with self._lock:
+            actual = self._en_curso.get(id_transferencia)
+        if not actual or actual[0] != remitente:
+            raise ErrorProtocolo("Bloque de una transferencia desconocida")
+        return id_transferencia, actual[4].escribir(offset, datos)
+
+    def finalizar(self, remitente, id_transferencia, sha256):
+        with self._lock:
+            actual = self._en_curso.pop(id_transferencia, None)
+        if not actual or actual[0] != remitente:
+            raise ErrorProtocolo("Fin de una transferencia desconocida")
+        _, destinatario, nombre, tamano, receptor = actual
+        receptor.terminar(sha256, self._ruta(id_transferencia))
+        return self._registrar(Subida(id_transferencia, remitente, destinatario, nombre, tamano,
+                                      self._guardar(id_transferencia, sha256), sha256))
+
+    def guardar_completo(self, remitente, destinatario, nombre, contenido):
+        # Para archivos que llegaron enteros en una sola trama (clientes viejos): se pasan a disco igual
+        self._validar_tamano(len(contenido))
+        id_transferencia = nuevo_id()
+        ruta = self._ruta(id_transferencia)
+        with open(ruta, "wb") as f:
+            f.write(contenido)
+        sha256 = hashlib.sha256(contenido).hexdigest()
+        return self._registrar(Subida(id_transferencia, remitente, destinatario, nombre, len(contenido),
+                                      self._guardar(id_transferencia, sha256), sha256))
+
+    def _validar_tamano(self, tamano):
+        if tamano < 0:
+            raise ErrorProtocolo("Tamaño de archivo inválido")
+        if self.max_tamano and tamano > self.max_tamano:
+            raise ErrorProtocolo(f"El archivo supera el máximo de {self.max_tamano} bytes")
+
+    def _guardar(self, id_transferencia, sha256):
+        # Devuelve la ruta definitiva del archivo completo
+        if self.almacen is None:
+            return self._ruta(id_transferencia)
+        return self.almacen.guardar(self._ruta(id_transferencia), sha256)
+
+    def _registrar(self, subida):
+        with self._lock:
+            self._completas[subida.id] = subida
+        return subida
+
+    def completa(self, id_transferencia):
+        # Se entrega una sola vez (al repartirla), así el registro no crece con cada archivo
+        with self._lock:
+            return self._completas.pop(id_transferencia, None)
+
+    def abandonar(self, remitente):
+        # Cierra los archivos de las subidas de un usuario que se desconectó; los parciales quedan para reanudar
+        with self._lock:
+            for id_transferencia, actual in list(self._en_curso.items()):
+                if actual[0] == remitente:
+                    actual[4].cerrar()
+                    del self._en_curso[id_transferencia]
+
+    def limpiar(self):
+        # Borra parciales abandonados y archivos ya repartidos con más de `ttl` segundos
+        ahora = time.time()
+        if ahora - self._ultima_limpieza < 60:
+            return
+        self._ultima_limpieza = ahora
+        if self.almacen is not None:
+            self.almacen.limpiar()
+        with self._lock:
+            activos = set(self._en_curso)
+            for nombre in os.listdir(self.directorio):
+                id_transferencia = nombre.split(".")[0]
+                ruta = os.path.join(self.directorio, nombre)
+                if id_transferencia in activos:
+                    continue
+                try:
+                    if ahora - os.path.getmtime(ruta) > self.ttl:
+                        os.remove(ruta)
+                        self._completas.pop(id_transferencia, None)
+                except OSError:
+                    pass
+
+
+def abrir_descarga(almacen, carga):
+    # Atiende un T_ARCHIVO_PEDIR: devuelve el objeto abierto, desde qué offset mandarlo y la trama
+    # T_ARCHIVO_DATOS que va antes del contenido. ValueError / FileNotFoundError si no está en el almacén.
+    sha256, offset = desempaquetar_campos(carga, 2)
+    archivo = almacen.abrir(sha256)
+    tamano = os.fstat(archivo.fileno()).st_size
+    cabecera = codificar_trama(T_ARCHIVO_DATOS, empaquetar_campos(sha256, str(tamano)))
+    return archivo, min(int(offset), tamano), cabecera
+
+
+def referencia_de(subida):
+    return empaquetar_campos(subida.remitente, subida.nombre, subida.sha256, str(subida.tamano))
+
+
+def bloques_archivo(modo, subida, codec=None):
+    # Generador con los bytes a mandar a un destinatario, leyendo el archivo de a un bloque.
+    # El escritor de la cola de salida lo recorre recién cuando le toca, así la memoria no depende del tamaño.
+    # Con compresión negociada los bloques se comprimen, salvo que el archivo ya venga comprimido (JPG, PDF...).
+    if modo == MODO_LEGADO:
+        # Un cliente viejo espera "FILE:remitente:nombre:<base64>": se manda el base64 por partes
+        yield f"FILE:{subida.remitente}:{subida.nombre}:".encode("utf-8")
+        with open(subida.ruta, "rb") as f:
+            for datos in iter(lambda: f.read(BLOQUE_LEGADO), b""):
+                yield base64.b64encode(datos)
+        return
+
+    if codec is not None and ya_comprimido(nombre=subida.nombre):
+        codec = None
+    # El sha256 va ya en el INICIO: si la conexión se corta a mitad, el cliente pide el resto al almacén
+    yield codificar_para(modo, T_ARCHIVO_INICIO,
+                         empaquetar_campos(subida.id, subida.remitente, subida.nombre, str(subida.tamano), subida.sha256))
+    offset = 0
+    with open(subida.ruta, "rb") as f:
+        for datos in iter(lambda: f.read(TAMANO_BLOQUE), b""):
+            yield codificar_para(modo, T_ARCHIVO_BLOQUE, empaquetar_bloque(subida.id, offset, datos), codec=codec)
+            offset += len(datos)
+    yield codificar_para(modo, T_ARCHIVO_FIN, empaquetar_campos(subida.id, subida.sha256))
+
+
+# LADO CLIENTE
+def _recibir_exacto(sock, cantidad):
+    datos = bytearray()
+    while len(datos) < cantidad:
+        parte = sock.recv(cantidad - len(datos))
+        if not parte:
+            raise ConnectionError("El servidor cerró la conexión")
+        datos += parte
+    return bytes(datos)
+
+
+def descargar_referencia(direccion, referencia, carpeta, espera=30.0):
+    # Pide un archivo compartido por una conexión propia (no frena el chat) y lo guarda en `carpeta`.
+    # Si un intento anterior quedó a medias, sigue desde lo que ya estaba en disco.
+    os.makedirs(carpeta, exist_ok=True)
+    receptor = ReceptorArchivo(os.path.join(carpeta, f".{referencia.sha256}.parte"), referencia.tamano)
+    try:
+        with socket.create_connection(direccion, timeout=espera) as sock:
+            sock.recv(1024)  # el pedido de alias en texto plano: en esta conexión no se usa
+            sock.sendall(codificar_trama(T_ARCHIVO_PEDIR, empaquetar_campos(referencia.sha256, str(receptor.recibido))))
+            magia, _, tipo, _, longitud = CABECERA.unpack(_recibir_exacto(sock, CABECERA.size))
+            if magia != MAGIA or longitud > MAX_CARGA:
+                raise ErrorProtocolo("Respuesta inválida del servidor")
+            carga = _recibir_exacto(sock, longitud)
+            if tipo == T_ARCHIVO_ERROR:
+                raise ErrorProtocolo(desempaquetar_campos(carga, 2)[1].decode("utf-8"))
+            if tipo != T_ARCHIVO_DATOS:
+                raise ErrorProtocolo(f"Se esperaba el archivo y llegó una trama de tipo {tipo}")
+            # Detrás de la cabecera viene el contenido en crudo, desde el offset pedido hasta el final
+            while not receptor.completo():
+                datos = sock.recv(min(TAMANO_BLOQUE, receptor.tamano - receptor.recibido))
+                if not datos:
+                    raise ConnectionError("La descarga se cortó; se puede reintentar")
+                receptor.escribir(receptor.recibido, datos)
+        ruta = os.path.join(carpeta, os.path.basename(referencia.nombre))
+        receptor.terminar(referencia.sha256, ruta)
+        return ruta
+    finally:
+        receptor.cerrar()
+
+
+class EmisorArchivo:
+    # Sube un archivo por bloques respetando una ventana de bytes sin confirmar.
+    # Se puede llamar a enviar() otra vez tras una reconexión: retoma desde el offset que confirme el servidor.
+    # cortar() despierta al envío en curso para que termine y deje lugar al que sigue por la conexión nueva.
+    def __init__(self, destinatario, ruta):
+        self.id = nuevo_id()
+        self.destinatario = destinatario
+        self.ruta = ruta
+        self.nombre = os.path.basename(ruta)
+        self.tamano = os.path.getsize(ruta)
+        self.sha256 = calcular_sha256(ruta)
+        self.confirmado = -1
+        self.terminado = False
+        self.error = None
+        self.cortado = False
+        self._cond = threading.Condition()
+        self._enviando = threading.Lock()  # un solo enviar() a la vez: el de la conexión vieja termina antes
+
+    def enviar(self, conexion, espera=30.0):
+        with self._enviando:
+            with self._cond:
+                self.confirmado = -1
+                self.error = None
+                self.cortado = False
+            conexion.enviar(T_ARCHIVO_INICIO,
+                            empaquetar_campos(self.id, self.destinatario, self.nombre, str(self.tamano)))
+            # El servidor contesta con el offset desde donde seguir
+            offset = self._esperar(lambda: self.confirmado >= 0, espera)
+            with open(self.ruta, "rb") as f:
+                f.seek(offset)
+                for datos in iter(lambda: f.read(TAMANO_BLOQUE), b""):
+                    self._esperar(lambda: offset - self.confirmado < VENTANA, espera)
+                    conexion.enviar(T_ARCHIVO_BLOQUE, empaquetar_bloque(self.id, offset, datos))
+                    offset += len(datos)
+            self._esperar(lambda: self.confirmado >= self.tamano, espera)
+            conexion.enviar(T_ARCHIVO_FIN, empaquetar_campos(self.id, self.sha256))
+            self._esperar(lambda: self.terminado, espera)
+
+    def _esperar(self, condicion, espera):
+        with self._cond:
+            if not self._cond.wait_for(lambda: condicion() or self.error, espera):
+                raise TimeoutError("El servidor no confirmó la transferencia a tiempo")
+            if self.error:
+                raise RuntimeError(self.error)
+            return self.confirmado
+
+    # Llamados desde el hilo que recibe mensajes
+    def confirmar(self, offset):
+        with self._cond:
+            self.confirmado = max(self.confirmado, offset)
+            self._cond.notify_all()
+
+    def finalizar(self):
+        with self._cond:
+            self.terminado = True
+            self._cond.notify_all()
+
+    def fallar(self, motivo):
+        with self._cond:
+            self.error = motivo
+            self._cond.notify_all()
+
+    def cortar(self):
+        with self._cond:
+            self.cortado = True
+            self.error = "Se cortó la conexión con el servidor"
+            self._cond.notify_all()
+
+
+class GestorTransferencias:
+    # Lado cliente: subidas propias en curso y descargas que van llegando del servidor.
+    def __init__(self, carpeta="recibidos"):
+        self.carpeta = carpeta
+        self.envios = {}     # id -> EmisorArchivo
+        self.descargas = {}  # id -> (remitente, nombre, ReceptorArchivo, sha256)
+
+    def referencia(self, trama):
+        # Archivo compartido que todavía no se descargó (T_ARCHIVO_REF)
+        remitente, nombre, sha256, tamano = desempaquetar_campos(trama.carga, 4)
+        return Referencia(remitente, os.path.basename(nombre), sha256, int(tamano.decode("ascii")))
+
+    def descargar(self, direccion, referencia):
+        return descargar_referencia(direccion, referencia, self.carpeta)
+
+    def nuevo_envio(self, destinatario, ruta):
+        emisor = EmisorArchivo(destinatario, ruta)
+        self.envios[emisor.id] = emisor
+        return emisor
+
+    def cortar(self):
+        # Se cortó la conexión con el servidor. Las subidas se frenan pero quedan en `envios`, para volver a
+        # llamar a enviar() por la conexión nueva. Las descargas que el servidor estaba empujando se cierran
+        # y se devuelven como Referencias: el resto se pide al almacén (descargar_referencia sigue desde lo
+        # que ya está en disco, por eso el parcial pasa a llamarse por su sha256).
+        for emisor in list(self.envios.values()):
+            emisor.cortar()
+        pendientes = []
+        for id_transferencia, (remitente, nombre, receptor, sha256) in list(self.descargas.items()):
+            del self.descargas[id_transferencia]
+            receptor.cerrar()
+            if not sha256:
+                continue  # un servidor viejo no lo manda: no hay cómo pedir el resto
+            os.replace(receptor.ruta, os.path.join(self.carpeta, f".{sha256}.parte"))
+            pendientes.append(Referencia(remitente, nombre, sha256, receptor.tamano))
+        return pendientes
+
+    def procesar(self, trama, callback_mensaje):
+        # Atiende una trama de transferencia. Devuelve True si la trama era de este tipo.
+        if trama.tipo not in TIPOS_TRANSFERENCIA:
+            return False
+
+        if trama.tipo == T_ARCHIVO_BLOQUE:
+            id_transferencia, offset, datos = desempaquetar_bloque(trama.carga)
+            if id_transferencia in self.descargas:
+                self.descargas[id_transferencia][2].escribir(offset, datos)
+            return True
+
+        if trama.tipo == T_ARCHIVO_ACK:
+            id_transferencia, offset = desempaquetar_campos(trama.carga, 2)
+            if id_transferencia in self.envios:
+                self.envios[id_transferencia].confirmar(int(offset))
+            return True
+
+        if trama.tipo == T_ARCHIVO_ERROR:
+            id_transferencia, motivo = desempaquetar_campos(trama.carga, 2)
+            motivo = motivo.decode("utf-8")
+            if id_transferencia in self.envios:
+                self.envios.pop(id_transferencia).fallar(motivo)
+            elif id_transferencia in self.descargas:
+                self.descargas.pop(id_transferencia)[2].cerrar()
+            callback_mensaje(f"⚠ Error en la transferencia de archivo: {motivo}")
+            return True
+
+        if trama.tipo == T_ARCHIVO_INICIO:
+            id_transferencia, remitente, nombre, resto = desempaquetar_campos(trama.carga, 4)
+            # El sha256 es un quinto campo opcional (ver bloques_archivo)
+            tamano, _, sha256 = resto.partition(SEPARADOR)
+            validar_id(id_transferencia)
+            os.makedirs(self.carpeta, exist_ok=True)
+            parcial = os.path.join(self.carpeta, f".{id_transferencia}.parte")
+            if os.path.exists(parcial):
+                os.remove(parcial)
+            self.descargas[id_transferencia] = (remitente, os.path.basename(nombre),
+                                                ReceptorArchivo(parcial, int(tamano)), sha256.decode("ascii"))
+            return True
+
+        # T_ARCHIVO_FIN: o confirma una subida propia o cierra una descarga
+        id_transferencia, sha256 = desempaquetar_campos(trama.carga, 2)
+        if id_transferencia in self.envios:
+            self.envios.pop(id_transferencia).finalizar()
+        elif id_transferencia in self.descargas:
+            remitente, nombre, receptor, _ = self.descargas.pop(id_transferencia)
+            ruta = os.path.join(self.carpeta, nombre)
+            try:
+                receptor.terminar(sha256.decode("ascii"), ruta)
+                callback_mensaje(f"📁 Archivo recibido de {remitente}: {nombre}\nGuardado en: {ruta}")
+            except ErrorProtocolo as e:
+                callback_mensaje(f"⚠ Archivo de {remitente} descartado: {e}")
+        return True